@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 # All required dependencies and imports
-import hmac
 import hashlib
 import base64
-import json
-import random
-import time
 import datetime
-import threading
-import decimal
-from concurrent.futures import ThreadPoolExecutor
-from urllib.parse import unquote, urlparse, parse_qs
+import struct
+import time
+from urllib.parse import urlparse, parse_qs
+
+from Websocket.keep_live_thread_pool_executor import KeepLiveThreadPoolExecutor
+from Websocket.keepalive import LAPI_KEEPALIVE
+from Websocket.admission import AdmissionRejected
+from Websocket.deflate import DEFLATE
+from Websocket.engine import ENGINE, LAPI_REGISTER, LAPI_UNREGISTER, Handshake, frames
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY
+from Websocket.reassembly import CLOSE_TRY_AGAIN_LATER, MAX_MESSAGE_SIZE
+
+log = getLogger("handler")
 
 # Dummy implementations of Netty related classes and utilities
 
@@ -28,15 +34,15 @@ class Channel:
         return self._remote_address
 
     def writeAndFlush(self, msg):
-        # In this simulation, simply print the message being sent.
-        print("Sending message:", msg)
+        # In this simulation, simply log the message being sent.
+        log.debug("Sending message: %s", msg, remote=self._remote_address)
 
     def write(self, msg):
-        # In this simulation, simply print the message being written.
-        print("Writing message:", msg)
+        # In this simulation, simply log the message being written.
+        log.debug("Writing message: %s", msg, remote=self._remote_address)
 
     def close(self):
-        print("Closing channel with remote address:", self._remote_address)
+        log.debug("Closing channel", remote=self._remote_address)
 
 class ChannelHandlerContext:
     def __init__(self, channel):
@@ -57,8 +63,10 @@ class DecoderResult:
         return self._success
 
 class FullHttpRequest:
-    def __init__(self, uri, headers, decoder_success=True):
+    def __init__(self, uri, headers, decoder_success=True, method="GET", content=b''):
         self.uri = uri
+        self.method = method
+        self.content = content  # bytes
         self._headers = headers  # dictionary
         self._decoder_result = DecoderResult(decoder_success)
 
@@ -86,8 +94,14 @@ class HttpVersion:
     HTTP_1_1 = "HTTP/1.1"
 
 class HttpResponseStatus:
+    SWITCHING_PROTOCOLS = "101 Switching Protocols"
     BAD_REQUEST = "400 Bad Request"
     UNAUTHORIZED = "401 Unauthorized"
+    SERVICE_UNAVAILABLE = "503 Service Unavailable"
+    NOT_FOUND = "404 Not Found"
+    METHOD_NOT_ALLOWED = "405 Method Not Allowed"
+    REQUEST_ENTITY_TOO_LARGE = "413 Request Entity Too Large"
+    UPGRADE_REQUIRED = "426 Upgrade Required"
     # For successful responses, we use 200 OK
     OK = "200 OK"
 
@@ -163,9 +177,11 @@ class QueryStringDecoder:
         return self._parameters
 
 class WebSocketFrame:
-    # Base class for WebSocket frames.
-    def __init__(self, content=b''):
+    # Base class for WebSocket frames. A message streamed by the frame codec arrives as a
+    # first frame with finalFragment False and ContinuationWebSocketFrames up to the final one.
+    def __init__(self, content=b'', finalFragment=True):
         self.content = content
+        self.finalFragment = finalFragment
 
 class CloseWebSocketFrame(WebSocketFrame):
     def __init__(self, content=b''):
@@ -183,21 +199,65 @@ class PongWebSocketFrame(WebSocketFrame):
     def __init__(self, content=b''):
         super().__init__(content)
 
+class BinaryWebSocketFrame(WebSocketFrame):
+    def __init__(self, content=b'', finalFragment=True):
+        super().__init__(content, finalFragment)
+
+class ContinuationWebSocketFrame(WebSocketFrame):
+    def __init__(self, content=b'', finalFragment=True):
+        super().__init__(content, finalFragment)
+
 class TextWebSocketFrame(WebSocketFrame):
-    def __init__(self, text):
-        super().__init__(text.encode(CharsetUtil.UTF_8))
-        self._text = text
+    def __init__(self, text, finalFragment=True):
+        if isinstance(text, bytes):
+            # Already UTF-8 encoded, e.g. a pre-rendered response template or a streamed chunk
+            super().__init__(text, finalFragment)
+            self._text = None
+        else:
+            super().__init__(text.encode(CharsetUtil.UTF_8), finalFragment)
+            self._text = text
 
     def text(self):
+        if self._text is None:
+            self._text = self.content.decode(CharsetUtil.UTF_8)
         return self._text
 
 class WebSocketServerHandshaker:
+    # RFC 6455 handshake GUID used to derive Sec-WebSocket-Accept
+    WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    __slots__ = ("webSocketURL", "maxFramePayloadLength", "allowExtensions")
+
+    def __init__(self, webSocketURL=None, maxFramePayloadLength=65536, allowExtensions=False):
+        self.webSocketURL = webSocketURL
+        self.maxFramePayloadLength = maxFramePayloadLength
+        self.allowExtensions = allowExtensions
+
     def handshake(self, channel, req):
-        # Simulate handshake success and return a ChannelFuture
-        return ChannelFuture(success=True)
+        key = req.headers().get("Sec-WebSocket-Key")
+        if not key:
+            return ChannelFuture(success=False)
+        accept = base64.b64encode(hashlib.sha1((key + self.WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        res = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HttpResponseStatus.SWITCHING_PROTOCOLS)
+        res.headers()["Upgrade"] = "websocket"
+        res.headers()["Connection"] = "Upgrade"
+        res.headers()["Sec-WebSocket-Accept"] = accept
+        # permessage-deflate when LAPI_DEFLATE is on and the client offers it
+        negotiated = DEFLATE.negotiate(req.headers().get("Sec-WebSocket-Extensions")) if self.allowExtensions else None
+        deflate = None
+        if negotiated is not None:
+            res.headers()["Sec-WebSocket-Extensions"], deflate = negotiated
+        future = channel.writeAndFlush(res)
+        # A real channel swaps its HTTP codec for the WebSocket frame codec here,
+        # the simulated Channel has no pipeline and just keeps printing.
+        if hasattr(channel, "upgradeToWebSocket"):
+            channel.upgradeToWebSocket(self.maxFramePayloadLength, deflate)
+        return future if isinstance(future, ChannelFuture) else ChannelFuture(success=True)
 
     def close(self, channel, frame):
-        print("Closing WebSocket connection for channel:", channel.remoteAddress())
+        # Echo the close frame back and drop the connection once it is flushed
+        channel.writeAndFlush(frame)
+        channel.close()
 
 class WebSocketServerHandshakerFactory:
     def __init__(self, webSocketURL, subprotocols, allowExtensions, maxFrameSize):
@@ -207,65 +267,60 @@ class WebSocketServerHandshakerFactory:
         self.maxFrameSize = maxFrameSize
 
     def newHandshaker(self, req):
-        # In this simulation, always return a new handshaker.
-        return WebSocketServerHandshaker()
+        # Only RFC 6455 (version 13) is supported, like Netty's WebSocketServerHandshaker13.
+        version = req.headers().get("Sec-WebSocket-Version", "13")
+        if version != "13":
+            return None
+        return WebSocketServerHandshaker(self.webSocketURL, self.maxFrameSize, self.allowExtensions)
 
     @staticmethod
     def sendUnsupportedVersionResponse(channel):
-        print("Sending unsupported WebSocket version response to channel:", channel.remoteAddress())
-
-# Dummy implementations for external classes
-
-class WebsocketReq:
-    # Simulated WebsocketReq class with a getRequestURL method.
-    def __init__(self, **kwargs):
-        # We assume the requestURL field is provided with exact key 'requestURL'
-        # If key "requestURL" is not present, use empty string.
-        self.requestURL = kwargs.get("requestURL", "")
-
-    def getRequestURL(self):
-        return self.requestURL
-
-class KeepLiveThread(threading.Thread):
-    # Simulated keep alive thread
-    def __init__(self, channel, jsonObject):
-        threading.Thread.__init__(self)
-        self.channel = channel
-        self.jsonObject = jsonObject
-
-    def run(self):
-        # Simulated keep alive processing.
-        print("Executing KeepLiveThread for channel:", self.channel.remoteAddress())
-        print("Keep alive data:", self.jsonObject)
-
-class KeepLiveThreadPoolExecutor:
-    # Simulated thread pool executor for keep alive threads
-    EXECUTOR_SERVICE = ThreadPoolExecutor(max_workers=10)
+        res = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HttpResponseStatus.UPGRADE_REQUIRED)
+        res.headers()["Sec-WebSocket-Version"] = "13"
+        HttpUtil.setContentLength(res, 0)
+        channel.writeAndFlush(res)
+        channel.close()
 
 # Main WebSocketHandler class translation
 
 class WebSocketHandler:
+    # One instance per connection, slotted: everything shared lives on the class
+    __slots__ = ("handshaker", "deviceCode", "pendingAdmission", "stream")
+
     # Processing class for websocket handshake
     def __init__(self):
         self.handshaker = None
-    # Authentication key (consistent with device settings)
-    SECRET = "123456"
+        self.deviceCode = None
+        self.pendingAdmission = None
+        # Sink of the message being received in chunks, see LapiEngine.openStream
+        self.stream = None
+    # The LAPI protocol itself, this handler only carries it over the native pipeline
+    engine = ENGINE
 
     # Registration interface
-    LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
+    LAPI_REGISTER = LAPI_REGISTER
     # Keep alive interface
-    LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
+    LAPI_KEEPALIVE = LAPI_KEEPALIVE
     # Close connection
-    LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+    LAPI_UNREGISTER = LAPI_UNREGISTER
+    # Exported on the admin listener (LAPI_METRICS_PORT), protocol outcomes are counted by the engine
+    connectionsOpen = REGISTRY.gauge("lapi_connections_open", "Connections currently open")
+    connectionsAccepted = REGISTRY.counter("lapi_connections_accepted", "Connections accepted")
+    handlerExceptions = REGISTRY.counter("lapi_handler_exceptions", "Exceptions raised by the handler")
+    handshakeSeconds = REGISTRY.histogram("lapi_handshake_seconds", "Seconds spent in handleHttpRequest")
+    frameSeconds = REGISTRY.histogram("lapi_frame_seconds", "Seconds spent in handleWebSocketRequest")
 
     def channelRead(self, ctx, msg):
+        started = time.perf_counter()
         try:
             # WebSocket connection request, accessed via HTTP request
             if isinstance(msg, FullHttpRequest):
                 self.handleHttpRequest(ctx, msg)
+                self.handshakeSeconds.observe(time.perf_counter() - started)
             # WebSocket business processing, handling messages from WebSocket clients
             elif isinstance(msg, WebSocketFrame):
                 self.handleWebSocketRequest(ctx, msg)
+                self.frameSeconds.observe(time.perf_counter() - started)
         finally:
             ReferenceCountUtil.release(msg)
 
@@ -274,18 +329,30 @@ class WebSocketHandler:
     Retrieve the channle of the client and manage it in ChannelGroup
     """
     def handlerAdded(self, ctx):
-        print(ctx.channel().remoteAddress(), "The device is connected, and its IP address is:", ctx.channel().remoteAddress())
+        self.connectionsAccepted.inc()
+        self.connectionsOpen.inc()
+        log.debug("The device is connected", remote=ctx.channel().remoteAddress())
 
     def handlerRemoved(self, ctx):
         channelIP = ctx.channel().remoteAddress()
-        print(ctx.channel().remoteAddress(), "The device has been removed, and its IP address is:", channelIP)
+        self.connectionsOpen.dec()
+        if self.pendingAdmission is not None:
+            # Free the queue slot of a registration still waiting for admission
+            self.pendingAdmission.cancel()
+            self.pendingAdmission = None
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream = None
+        if self.handshaker is not None and self.deviceCode is not None:
+            self.engine.detach(self.deviceCode, ctx.channel())
+        log.info("The device has been removed", device=self.deviceCode, remote=channelIP)
 
     def channelActive(self, ctx):
         # add connections
-        print("Client join connection:", ctx.channel().remoteAddress(), "\n")
+        log.debug("Client join connection", remote=ctx.channel().remoteAddress())
 
     def channelInactive(self, ctx):
-        print("Client disconnected:", ctx.channel().remoteAddress(), "\n")
+        log.debug("Client disconnected", device=self.deviceCode, remote=ctx.channel().remoteAddress())
 
     def channelReadComplete(self, ctx):
         ctx.flush()
@@ -303,7 +370,9 @@ class WebSocketHandler:
 
     # connection exception
     def exceptionCaught(self, ctx, cause):
-        print("Exception occurred:", str(cause), "\n")
+        self.handlerExceptions.inc()
+        log.error("Exception occurred: %s", cause, exc_info=cause,
+                  device=self.deviceCode, remote=ctx.channel().remoteAddress())
         ctx.channel().close()
 
     """
@@ -314,63 +383,64 @@ class WebSocketHandler:
     @param req
     """
     def handleHttpRequest(self, ctx, req):
-        addr = ctx.channel().remoteAddress()
-        # For simulation, we assume addr is a string IP address.
-        currentIP = addr if isinstance(addr, str) else addr
+        currentIP = ctx.channel().remoteAddress()
         uri = req.uri
         # Device request to establish connection
-        print(currentIP, "Receive handshake requests, url=" + uri)
-        object = {}
-
+        # The path only, Register queries carry Signs and Tickets
+        log.info("Receive handshake requests", route=uri.partition("?")[0], remote=currentIP)
         # HTTP decoding failed, specify the transmission protocol to the server as Upgrade: websocket
-        if (not req.decoderResult().isSuccess()) or (req.headers().get("Upgrade") != "websocket"):
-            response = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HttpResponseStatus.BAD_REQUEST)
-            sendHttpResponse(self, ctx, req, response)
-            print("Not a request to establish a connection")
+        upgrade = req.decoderResult().isSuccess() and (req.headers().get("Upgrade") or "").lower() == "websocket"
+        match = self.engine.route(req.method, uri, upgrade, currentIP)
+        if isinstance(match, Handshake):
+            self.sendHandshake(ctx, req, match)
+            return
+        # Admission first, so a registration storm is queued or shed before any HMAC work
+        try:
+            admitted = self.engine.admit(currentIP)
+        except AdmissionRejected as e:
+            self.sendHandshake(ctx, req, self.engine.shed(e, match, currentIP))
             return
-        elif self.LAPI_REGISTER == uri:
-            object["Nonce"] = self.getCnonce()
-            fullHttpResponse = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HttpResponseStatus.UNAUTHORIZED,
-                                                         Unpooled.copiedBuffer(json.dumps(object), CharsetUtil.UTF_8))
-            fullHttpResponse.headers()["Content-Type"] = "application/json; charset=UTF-8"
-            sendHttpResponse(self, ctx, req, fullHttpResponse)
+        if admitted.done():
+            self.processRegister(ctx, req, match)
             return
-        elif self.LAPI_REGISTER + "?Vendor" in uri:
-            print(currentIP, "Device initiates second registration")
-            # Get request parameters
-            decoder = QueryStringDecoder(req.uri)
-            parameters = decoder.parameters()
-            Vendor = parameters.get("Vendor", [""])[0]
-            DeviceType = parameters.get("DeviceType", [""])[0]
-            Devicecode = parameters.get("DeviceCode", [""])[0]
-            Algorithm = parameters.get("Algorithm", [""])[0]
-            Nonce = parameters.get("Nonce", [""])[0]
-            Cnonce = parameters.get("Cnonce", [""])[0] if "Cnonce" in parameters else ""
-            Sign = parameters.get("Sign", [""])[0]
-            decodedUrl = unquote(Sign, encoding=CharsetUtil.UTF_8)
-            decodedUrl = decodedUrl.replace(" ", "+")
-            print("Certified Signature:" + decodedUrl)
-            pstr = Vendor + "/" + DeviceType + "/" + Devicecode + "/" + Algorithm + "/" + Nonce
-            # Generate server-side signature
-            sha256_HMAC = hmac.new(self.SECRET.encode("utf-8"), digestmod=hashlib.sha256)
-            sha256_HMAC.update(pstr.encode("utf-8"))
-            hash_bytes = sha256_HMAC.digest()
-            encodeStr = base64.b64encode(hash_bytes).decode("utf-8")
-            if encodeStr != decodedUrl:
-                print("Authentication failed:" + encodeStr)
-                object["Nonce"] = self.getCnonce()
-                fullHttpResponse = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HttpResponseStatus.UNAUTHORIZED,
-                                                             Unpooled.copiedBuffer(json.dumps(object), CharsetUtil.UTF_8))
-                fullHttpResponse.headers()["Content-Type"] = "application/json; charset=UTF-8"
-                sendHttpResponse(self, ctx, req, fullHttpResponse)
-                return
-            else:
-                print("Authentication successful")
-                object["Cnonce"] = Cnonce
-                object["Resign"] = encodeStr
+        self.pendingAdmission = admitted
+        admitted.add_done_callback(lambda future: self.onAdmitted(future, ctx, req, match))
 
+    def onAdmitted(self, future, ctx, req, match):
+        self.pendingAdmission = None
+        if not future.cancelled() and ctx.channel().isActive():
+            self.processRegister(ctx, req, match)
+
+    """
+    Two-step device registration, decided by the engine: a 401 challenge, or an upgrade
+    with the Cnonce/Resign (or fresh Ticket) as the first frame
+    """
+    def processRegister(self, ctx, req, match):
+        currentIP = ctx.channel().remoteAddress()
+        result = self.engine.register(match, currentIP)
+        if not result.upgrade:
+            self.sendHandshake(ctx, req, result)
+            return
+        self.deviceCode = result.deviceCode
+        if self.handshake(ctx, req, result.text()):
+            self.engine.attach(result, ctx.channel(), currentIP, self)
+
+    """
+    HTTP answer to a handshake the engine did not upgrade
+    """
+    def sendHandshake(self, ctx, req, result):
+        content = Unpooled.copiedBuffer(result.text(), CharsetUtil.UTF_8) if result.body is not None else b""
+        response = DefaultFullHttpResponse(HttpVersion.HTTP_1_1, HTTP_STATUS[result.status], content)
+        response.headers().update(result.headers)
+        sendHttpResponse(self, ctx, req, response)
+
+    """
+    Upgrade the connection and send the registration result as the first text frame,
+    True when the connection was upgraded
+    """
+    def handshake(self, ctx, req, text):
         # Handle handshake accordingly and create a factory class for websocket handshake
-        wsFactory = WebSocketServerHandshakerFactory(self.getWebSocketLocation(req), None, False, 65535 * 100)
+        wsFactory = WebSocketServerHandshakerFactory(self.getWebSocketLocation(req), None, True, MAX_MESSAGE_SIZE)
         # Create handshake class based on factory class and HTTP request
         self.handshaker = wsFactory.newHandshaker(req)
         if self.handshaker is None:
@@ -380,7 +450,9 @@ class WebSocketHandler:
             # Construct a handshake response message through it and return it to the client
             future = self.handshaker.handshake(ctx.channel(), req)
             if future.isSuccess():
-                ctx.channel().writeAndFlush(TextWebSocketFrame(json.dumps(object)).text())
+                ctx.channel().writeAndFlush(TextWebSocketFrame(text).text())
+                return True
+        return False
 
     """
     Receive WebSocket requests
@@ -391,33 +463,66 @@ class WebSocketHandler:
     """
     def handleWebSocketRequest(self, ctx, req):
         currentIP = ctx.channel().remoteAddress()
-        # Receive WebSocket requests, format conversion
-        jsonObject = json.loads(TextWebSocketFrame(req.content.decode(CharsetUtil.UTF_8)).text())
-        websocketReq = WebsocketReq(**jsonObject)
 
         # Determine whether it is a command to close the link
         if isinstance(req, CloseWebSocketFrame):
             # Close websocket connection
+            frames.labels("close").inc()
             self.handshaker.close(ctx.channel(), req.retain())
-            print(ctx.channel().remoteAddress(), "Disconnect")
+            log.info("Disconnect", device=self.deviceCode, remote=currentIP)
             return
         # Determine if it is a Ping message
         if isinstance(req, PingWebSocketFrame):
-            ctx.channel().write(PongWebSocketFrame(req.content).content)
+            frames.labels("ping").inc()
+            ctx.channel().writeAndFlush(PongWebSocketFrame(req.content))
+            return
+        # Unsolicited pongs are allowed as a unidirectional heartbeat, nothing to answer
+        if isinstance(req, PongWebSocketFrame):
+            frames.labels("pong").inc()
+            return
+        # The rest of a text message streamed by the frame codec
+        if isinstance(req, ContinuationWebSocketFrame):
+            self.streamChunk(ctx, req)
             return
         # This example supports text messages, not binary messages
         if not isinstance(req, TextWebSocketFrame):
             raise UnsupportedOperationException("Currently only supports text messages, not binary messages")
         if (ctx is None) or (self.handshaker is None) or (hasattr(ctx, "isRemoved") and ctx.isRemoved()):
             raise Exception("Handshake not successful yet, unable to send WebSocket message to device")
-
-        if self.LAPI_KEEPALIVE == websocketReq.getRequestURL():
-            print("The server received a device's keep alive request:" + websocketReq.getRequestURL())
-            # Use threads to receive keep alive information
-            keepLiveThread = KeepLiveThread(ctx.channel(), jsonObject)
-            KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.submit(keepLiveThread.run)
-        elif self.LAPI_UNREGISTER == websocketReq.getRequestURL():
-            print(currentIP, "Device disconnected")
+        if not req.finalFragment:
+            # Large or fragmented message, its first chunk picks where the chunks go
+            self.stream = self.engine.openStream(ctx.channel(), self.deviceCode, req.content)
+            self.streamChunk(ctx, req)
+            return
+        # Keepalive replies are written right here on the channel's event loop
+        reply = self.engine.frame(ctx.channel(), self.deviceCode, req.content)
+        if reply is not None:
+            ctx.channel().writeAndFlush(TextWebSocketFrame(reply))
+
+    def streamChunk(self, ctx, req):
+        stream = self.stream
+        if stream is None:
+            # The message was refused, the connection is closing
+            return
+        if stream.feed(req.content) is False:
+            self.stream = None
+            ctx.channel().writeAndFlush(CloseWebSocketFrame(struct.pack("!H", CLOSE_TRY_AGAIN_LATER)))
+            ctx.channel().close()
+            return
+        if req.finalFragment:
+            self.stream = None
+            reply = stream.finish()
+            if reply is not None:
+                ctx.channel().writeAndFlush(TextWebSocketFrame(reply))
+
+# Engine statuses as the simulated Netty response statuses
+HTTP_STATUS = {
+    Handshake.BAD_REQUEST: HttpResponseStatus.BAD_REQUEST,
+    Handshake.UNAUTHORIZED: HttpResponseStatus.UNAUTHORIZED,
+    Handshake.NOT_FOUND: HttpResponseStatus.NOT_FOUND,
+    Handshake.METHOD_NOT_ALLOWED: HttpResponseStatus.METHOD_NOT_ALLOWED,
+    Handshake.SERVICE_UNAVAILABLE: HttpResponseStatus.SERVICE_UNAVAILABLE,
+}
 
 def sendHttpResponse(self, ctx, req, res):
     # BAD_QUEST (400) Response message returned by client request error
@@ -475,21 +580,6 @@ def sendHttpResponse(handler, ctx, req, res):
         if isinstance(cf, ChannelFuture):
             cf.addListener(CloseListener())
 
-"""
-Calculate the cnonce value, which is used for authentication
-"""
-@staticmethod
-def getCnonce():
-    d = random.random()
-    d1 = time.time()
-    x = d * d1
-    # Use Decimal to format the number without decimals
-    df = decimal.Decimal(x).to_integral_value(rounding=decimal.ROUND_HALF_UP)
-    return str(df)
-
-# Attach getCnonce to WebSocketHandler class
-WebSocketHandler.getCnonce = staticmethod(getCnonce)
-
 # Custom Exception to replicate Java's UnsupportedOperationException
 class UnsupportedOperationException(Exception):
     pass
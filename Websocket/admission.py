@@ -0,0 +1,233 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+# Registrations admitted per second across all devices, and the burst allowed above it
+# (LAPI_REGISTER_RATE, LAPI_REGISTER_BURST)
+REGISTER_RATE = float(os.environ.get("LAPI_REGISTER_RATE", 100))
+REGISTER_BURST = float(os.environ.get("LAPI_REGISTER_BURST", 100))
+# Per source IP, generous enough for a handful of cameras behind one NAT (LAPI_REGISTER_IP_RATE,
+# LAPI_REGISTER_IP_BURST). A registration costs one token, taken by its challenge
+REGISTER_IP_RATE = float(os.environ.get("LAPI_REGISTER_IP_RATE", 5))
+REGISTER_IP_BURST = float(os.environ.get("LAPI_REGISTER_IP_BURST", 20))
+# Handshakes allowed to wait for a global token (LAPI_REGISTER_QUEUE_SIZE)
+REGISTER_QUEUE_SIZE = int(os.environ.get("LAPI_REGISTER_QUEUE_SIZE", 1024))
+# Per-IP buckets kept, least recently used are dropped beyond this (LAPI_REGISTER_MAX_IPS)
+REGISTER_MAX_IPS = int(os.environ.get("LAPI_REGISTER_MAX_IPS", 65536))
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a registration is shed. retryAfter is the suggested delay in seconds,
+    for a Retry-After header or a 1013 "Try Again Later" close.
+    """
+
+    def __init__(self, reason, retryAfter):
+        super().__init__("%s, retry after %ss" % (reason, retryAfter))
+        self.reason = reason
+        self.retryAfter = retryAfter
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now):
+        """
+        Take one token: 0 on success, else the seconds until one is available.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """
+        Give back a token taken for a request that was shed further on.
+        """
+        self.tokens = min(self.burst, self.tokens + 1)
+
+class _Admitted:
+    """
+    What request() returns for a request admitted at once: a done future that needs no
+    event loop, so synchronous callers (the WebSocketHandler demo) are admitted too.
+    """
+
+    __slots__ = ()
+
+    def done(self):
+        return True
+
+    def cancelled(self):
+        return False
+
+    def cancel(self):
+        return False
+
+    def result(self):
+        return True
+
+    def exception(self):
+        return None
+
+    def add_done_callback(self, callback, *, context=None):
+        callback(self)
+
+    def __await__(self):
+        return True
+        yield
+
+ADMITTED = _Admitted()
+
+class RegistrationAdmission:
+    """
+    Admission control in front of the Register handlers.
+
+    Each source IP has a token bucket and every request takes a token from it; an IP over
+    its rate is shed straight away. A signed Register whose Nonce is consumed gets its
+    token back (refund()), so an honest registration costs one token, its challenge's.
+    Requests within the IP rate take a token from the global bucket when one is free and
+    no one is waiting, otherwise they join a bounded queue served round robin across IPs, so one busy NAT
+    cannot starve everyone else. The queue is drained by one loop timer at the global rate.
+    A full queue sheds too. Shed requests get AdmissionRejected with a retry-after hint, so
+    a restart storm turns into a steady registration rate instead of a thundering herd.
+    """
+
+    def __init__(self, rate=REGISTER_RATE, burst=REGISTER_BURST, ipRate=REGISTER_IP_RATE, ipBurst=REGISTER_IP_BURST,
+                 queueSize=REGISTER_QUEUE_SIZE, maxIps=REGISTER_MAX_IPS, clock=time.monotonic):
+        self.ipRate = ipRate
+        self.ipBurst = ipBurst
+        self.queueSize = queueSize
+        self.maxIps = maxIps
+        self.clock = clock
+        self._global = TokenBucket(rate, burst, clock())
+        self._buckets = OrderedDict()  # ip -> TokenBucket, least recently used first
+        self._waiting = OrderedDict()  # ip -> deque of futures, served round robin
+        self._queued = 0
+        self._handle = None
+        self._admitted = 0
+        self._dequeued = 0
+        self._enqueued = 0
+        self._shedIp = 0
+        self._shedQueue = 0
+        self._cancelled = 0
+
+    def request(self, ip):
+        """
+        Future resolved once ip may register; already done when admitted at once. Raises
+        AdmissionRejected when the request is shed. Cancel the future if the connection
+        goes away while it waits.
+        """
+        now = self.clock()
+        bucket = self._bucket(ip, now)
+        wait = bucket.take(now)
+        if wait:
+            self._shedIp += 1
+            raise AdmissionRejected("Too many registrations from " + str(ip), _seconds(wait))
+        if not self._queued and not self._global.take(now):
+            self._admitted += 1
+            return ADMITTED
+        if self._queued >= self.queueSize:
+            self._shedQueue += 1
+            # Shed for the server's sake, the IP keeps its token for the retry
+            bucket.refund()
+            raise AdmissionRejected("Registration queue is full", _seconds(self._queued / self._global.rate))
+        # Only a request that waits needs the loop, the drain timer runs on it
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiters = self._waiting.get(ip)
+        if waiters is None:
+            waiters = self._waiting[ip] = deque()
+        waiters.append(future)
+        self._queued += 1
+        self._enqueued += 1
+        future.add_done_callback(self._onDone)
+        self._schedule(loop, now)
+        return future
+
+    async def acquire(self, ip):
+        """
+        Wait until ip may register, raises AdmissionRejected when shed.
+        """
+        await self.request(ip)
+
+    def refund(self, ip):
+        """
+        Give ip back the token of a signed Register whose Nonce was just consumed: the
+        challenge that issued the Nonce already paid for the registration.
+        """
+        bucket = self._buckets.get(ip)
+        if bucket is not None:
+            bucket.refund()
+
+    def _bucket(self, ip, now):
+        buckets = self._buckets
+        bucket = buckets.get(ip)
+        if bucket is None:
+            bucket = buckets[ip] = TokenBucket(self.ipRate, self.ipBurst, now)
+            if len(buckets) > self.maxIps:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(ip)
+        return bucket
+
+    def _onDone(self, future):
+        # Results are counted by _drain, only waiters that gave up land here
+        if future.cancelled():
+            self._queued -= 1
+            self._cancelled += 1
+
+    def _schedule(self, loop, now):
+        if self._handle is None and self._queued:
+            bucket = self._global
+            bucket.refill(now)
+            delay = max(0, (1 - bucket.tokens) / bucket.rate)
+            self._handle = loop.call_later(delay, self._drain)
+
+    def _drain(self):
+        self._handle = None
+        now = self.clock()
+        bucket = self._global
+        bucket.refill(now)
+        waiting = self._waiting
+        while waiting and bucket.tokens >= 1:
+            ip, waiters = next(iter(waiting.items()))
+            future = waiters.popleft()
+            if waiters:
+                waiting.move_to_end(ip)
+            else:
+                del waiting[ip]
+            if future.done():
+                continue
+            bucket.tokens -= 1
+            self._queued -= 1
+            self._dequeued += 1
+            future.set_result(True)
+        self._schedule(asyncio.get_running_loop(), now)
+
+    def stats(self):
+        return {
+            "admitted": self._admitted + self._dequeued,
+            "admittedImmediately": self._admitted,
+            "queued": self._enqueued,
+            "queueDepth": self._queued,
+            "shed": self._shedIp + self._shedQueue,
+            "shedPerIp": self._shedIp,
+            "shedQueueFull": self._shedQueue,
+            "cancelled": self._cancelled,
+        }
+
+def _seconds(delay):
+    # Retry-After carries whole seconds
+    return max(1, int(math.ceil(delay)))
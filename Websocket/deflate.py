@@ -0,0 +1,258 @@
+import os
+import time
+import zlib
+
+from Websocket.metrics import REGISTRY
+
+EXTENSION = "permessage-deflate"
+# A sync flush ends in an empty stored block, stripped from every compressed message (RFC 7692 7.2.1)
+_TAIL = b"\x00\x00\xff\xff"
+# Raw DEFLATE windows zlib can produce and read, 2**9 to 2**15 bytes
+MIN_WINDOW_BITS = 9
+MAX_WINDOW_BITS = 15
+
+deflateMessages = REGISTRY.counter("lapi_deflate_messages", "Messages compressed (out) and inflated (in)", ("direction",))
+deflateSkipped = REGISTRY.counter("lapi_deflate_skipped", "Outbound messages sent uncompressed on a deflate connection",
+                                  ("reason",))
+deflateRawBytes = REGISTRY.counter("lapi_deflate_raw_bytes", "Uncompressed size of deflated messages", ("direction",))
+deflateWireBytes = REGISTRY.counter("lapi_deflate_wire_bytes", "Compressed size of deflated messages", ("direction",))
+deflateSeconds = REGISTRY.counter("lapi_deflate_cpu_seconds", "Seconds spent in zlib on the event loop", ("direction",))
+# Label children resolved once, they are bumped for every compressed message
+_outMessages, _outRaw, _outWire, _outSeconds = (metric.labels("out") for metric in
+                                                (deflateMessages, deflateRawBytes, deflateWireBytes, deflateSeconds))
+_inMessages, _inRaw, _inWire, _inSeconds = (metric.labels("in") for metric in
+                                            (deflateMessages, deflateRawBytes, deflateWireBytes, deflateSeconds))
+_skippedSmall = deflateSkipped.labels("small")
+_skippedRoute = deflateSkipped.labels("route")
+REGISTRY.gauge("lapi_deflate_ratio", "Compressed over uncompressed bytes of outbound deflated messages",
+               function=lambda: _outWire.value() / _outRaw.value() if _outRaw.value() else 0)
+
+class Uncompressed(bytes):
+    """
+    Frame payload to send as is on a deflate connection, for routes registered with
+    compress=False (keepalive replies, say, where zlib would only cost CPU).
+    """
+
+    __slots__ = ()
+
+def mustSkip(payload, minSize):
+    """
+    True when payload goes out uncompressed, as Netty's WebSocketExtensionFilter.
+    """
+    if isinstance(payload, Uncompressed):
+        _skippedRoute.inc()
+        return True
+    if len(payload) < minSize:
+        _skippedSmall.inc()
+        return True
+    return False
+
+def recordCompressed(rawSize, wireSize, seconds):
+    _outSeconds.inc(seconds)
+    _outMessages.inc()
+    _outRaw.inc(rawSize)
+    _outWire.inc(wireSize)
+
+def recordInflated(rawSize, wireSize, seconds):
+    _inSeconds.inc(seconds)
+    _inMessages.inc()
+    _inRaw.inc(rawSize)
+    _inWire.inc(wireSize)
+
+class DeflateSettings:
+    """
+    What this server offers for permessage-deflate (RFC 7692), from the environment:
+
+        LAPI_DEFLATE                    1 to negotiate the extension, off by default
+        LAPI_DEFLATE_MIN_SIZE           smaller messages go out uncompressed (1024)
+        LAPI_DEFLATE_LEVEL              zlib level, 1 fastest to 9 smallest (6)
+        LAPI_DEFLATE_CONTEXT_TAKEOVER   1 keeps a compressor per connection across messages
+        LAPI_DEFLATE_WINDOW_BITS        largest LZ77 window either side may use (15)
+
+    Without context takeover (the default) both sides start every message from an
+    empty window, so a connection holds no zlib state between messages: at tens of
+    thousands of idle cameras that is worth more than the better ratio of a kept window.
+    """
+
+    __slots__ = ("enabled", "minSize", "level", "contextTakeover", "windowBits")
+
+    def __init__(self, enabled=False, minSize=1024, level=6, contextTakeover=False, windowBits=MAX_WINDOW_BITS):
+        if not MIN_WINDOW_BITS <= windowBits <= MAX_WINDOW_BITS:
+            raise ValueError("Deflate window bits must be between %d and %d, not %d"
+                             % (MIN_WINDOW_BITS, MAX_WINDOW_BITS, windowBits))
+        self.enabled = enabled
+        self.minSize = minSize
+        self.level = level
+        self.contextTakeover = contextTakeover
+        self.windowBits = windowBits
+
+    @classmethod
+    def fromEnvironment(cls):
+        return cls(os.environ.get("LAPI_DEFLATE", "0") == "1",
+                   int(os.environ.get("LAPI_DEFLATE_MIN_SIZE", 1024)),
+                   int(os.environ.get("LAPI_DEFLATE_LEVEL", 6)),
+                   os.environ.get("LAPI_DEFLATE_CONTEXT_TAKEOVER", "0") == "1",
+                   int(os.environ.get("LAPI_DEFLATE_WINDOW_BITS", MAX_WINDOW_BITS)))
+
+    def negotiate(self, header):
+        """
+        Answer a Sec-WebSocket-Extensions request header: (response header value,
+        PerMessageDeflate) for the first acceptable permessage-deflate offer, None when
+        the extension is disabled or no offer can be accepted.
+        """
+        if not self.enabled or not header:
+            return None
+        for offer in header.split(","):
+            name, *items = offer.split(";")
+            if name.strip().lower() != EXTENSION:
+                continue
+            params = parseParams(items)
+            if params is None:
+                continue
+            accepted = self.accept(params)
+            if accepted is not None:
+                return accepted
+        return None
+
+    def accept(self, params):
+        serverNoTakeover = not self.contextTakeover or "server_no_context_takeover" in params
+        clientNoTakeover = not self.contextTakeover or "client_no_context_takeover" in params
+        serverBits = self.windowBits
+        if "server_max_window_bits" in params:
+            requested = params["server_max_window_bits"]
+            if requested is None or requested < MIN_WINDOW_BITS:
+                # zlib cannot compress into a 256 byte window
+                return None
+            serverBits = min(serverBits, requested)
+        response = [EXTENSION]
+        if serverNoTakeover:
+            response.append("server_no_context_takeover")
+        if clientNoTakeover:
+            response.append("client_no_context_takeover")
+        if serverBits < MAX_WINDOW_BITS or "server_max_window_bits" in params:
+            response.append("server_max_window_bits=%d" % serverBits)
+        if "client_max_window_bits" in params:
+            # Only a client that offered the parameter may be told to use a smaller window
+            clientBits = min(self.windowBits, params["client_max_window_bits"] or MAX_WINDOW_BITS)
+            response.append("client_max_window_bits=%d" % clientBits)
+        deflate = PerMessageDeflate(self.minSize, self.level, serverBits, serverNoTakeover, clientNoTakeover)
+        return "; ".join(response), deflate
+
+def parseParams(items):
+    """
+    {name: int or None} of one offer's parameters, None when the offer is malformed
+    (unknown or repeated parameter, bad window bits) and has to be declined.
+    """
+    params = {}
+    for item in items:
+        name, _, value = item.partition("=")
+        name = name.strip().lower()
+        value = value.strip().strip('"')
+        if name in params:
+            return None
+        if name in ("server_no_context_takeover", "client_no_context_takeover"):
+            if value:
+                return None
+            params[name] = None
+        elif name in ("server_max_window_bits", "client_max_window_bits"):
+            if not value:
+                if name == "server_max_window_bits":
+                    return None
+                params[name] = None
+                continue
+            if not value.isdigit() or not 8 <= int(value) <= MAX_WINDOW_BITS:
+                return None
+            params[name] = int(value)
+        else:
+            return None
+    return params
+
+class PerMessageDeflate:
+    """
+    permessage-deflate state of one native connection, as negotiated.
+
+    Without context takeover on a side no zlib object outlives a message: a compressor
+    or decompressor is created per message (cheaper in CPython than copying a pristine
+    shared one) and dropped with it. With takeover the connection keeps its own.
+    Messages under minSize and Uncompressed payloads are sent without RSV1, which
+    RFC 7692 allows per message.
+    """
+
+    __slots__ = ("minSize", "level", "windowBits", "serverNoTakeover", "clientNoTakeover", "_compressor",
+                 "_decompressor")
+
+    def __init__(self, minSize, level, windowBits, serverNoTakeover, clientNoTakeover):
+        self.minSize = minSize
+        self.level = level
+        self.windowBits = windowBits
+        self.serverNoTakeover = serverNoTakeover
+        self.clientNoTakeover = clientNoTakeover
+        self._compressor = None
+        self._decompressor = None
+
+    def mustSkip(self, payload):
+        return mustSkip(payload, self.minSize)
+
+    def compress(self, payload):
+        started = time.perf_counter()
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.windowBits)
+            if not self.serverNoTakeover:
+                self._compressor = compressor
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-4] if data.endswith(_TAIL) else data
+        recordCompressed(len(payload), len(data), time.perf_counter() - started)
+        return data
+
+    def decompress(self, data, maxSize):
+        """
+        Inflate one message, None when it would inflate past maxSize bytes.
+        """
+        return self.inflater().inflate(data, maxSize, True)
+
+    def inflater(self):
+        """
+        MessageInflater for the next incoming compressed message.
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-MAX_WINDOW_BITS)
+            if not self.clientNoTakeover:
+                self._decompressor = decompressor
+        return MessageInflater(decompressor)
+
+class MessageInflater:
+    """
+    Inflates one compressed message as its payload arrives, so a large message is never
+    held compressed and inflated at once.
+    """
+
+    __slots__ = ("_decompressor", "_rawSize", "_wireSize", "_seconds")
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+        self._rawSize = 0
+        self._wireSize = 0
+        self._seconds = 0.0
+
+    def inflate(self, data, room, final):
+        """
+        Inflated bytes of the next chunk of the message, None when they would be more than
+        room bytes. final is True for the chunk that ends the message.
+        """
+        started = time.perf_counter()
+        self._wireSize += len(data)
+        if final:
+            data = data + _TAIL
+        payload = self._decompressor.decompress(data, room + 1)
+        self._seconds += time.perf_counter() - started
+        if len(payload) > room or self._decompressor.unconsumed_tail:
+            return None
+        self._rawSize += len(payload)
+        if final:
+            recordInflated(self._rawSize, self._wireSize, self._seconds)
+        return payload
+
+# Read once per process, the native handshaker and the library transports negotiate with it
+DEFLATE = DeflateSettings.fromEnvironment()
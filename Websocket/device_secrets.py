@@ -0,0 +1,193 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+
+from Websocket.log import getLogger
+
+log = getLogger("secrets")
+
+# Secret of devices and vendors missing from the table, LAPI_SECRET overrides
+DEFAULT_SECRET = "123456"
+# Seconds between checks of the secrets file in watch()
+SECRETS_RELOAD_INTERVAL = 5
+
+class DeviceSecret:
+    """
+    One Register secret with its HMAC-SHA256 key schedule done once: the inner and outer
+    key pads live in a pre-keyed prototype, and every signature starts from a copy of it.
+    """
+
+    __slots__ = ("secret", "_prototype")
+
+    def __init__(self, secret):
+        self.secret = secret.encode("utf-8") if isinstance(secret, str) else bytes(secret)
+        self._prototype = hmac.new(self.secret, digestmod=hashlib.sha256)
+
+    def digest(self, message):
+        mac = self._prototype.copy()
+        mac.update(message)
+        return mac.digest()
+
+    def sign(self, vendor, deviceType, deviceCode, algorithm, nonce):
+        """
+        Base64 Sign of a Register request, also sent back as Resign.
+        """
+        return base64.b64encode(self.digest(signMessage(vendor, deviceType, deviceCode, algorithm, nonce))).decode("utf-8")
+
+    def __repr__(self):
+        return "DeviceSecret(<hidden>)"
+
+class SecretTable:
+    """
+    Register secrets by DeviceCode, then by Vendor, then a default.
+
+    Loaded from a JSON file
+
+        {"default": "...", "vendors": {"Uniview": "..."}, "devices": {"210235C3...": "..."}}
+
+    or an SQLite database (.db, .sqlite, .sqlite3) with a table
+
+        lapi_secrets(scope TEXT, name TEXT, secret TEXT)  -- scope is device, vendor or default
+
+    Lookups are dict probes on an immutable snapshot. reload() builds a complete new
+    snapshot, HMAC prototypes included, before swapping it in with one assignment, so
+    readers never see a half-loaded table; reloadAsync() and watch() do the file work in
+    the default executor and keep the event loop free while a large table is read.
+    """
+
+    def __init__(self, path=None, default=None):
+        self.path = path
+        self.default = default if default is not None else os.environ.get("LAPI_SECRET", DEFAULT_SECRET)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._state = ({}, {}, DeviceSecret(self.default))
+        if path:
+            self.reload()
+
+    def lookup(self, deviceCode, vendor=None):
+        """
+        DeviceSecret for a device: its own, else its vendor's, else the default.
+        """
+        devices, vendors, default = self._state
+        secret = devices.get(deviceCode)
+        if secret is None:
+            secret = vendors.get(vendor, default) if vendor else default
+        return secret
+
+    def sign(self, vendor, deviceType, deviceCode, algorithm, nonce):
+        return self.lookup(deviceCode, vendor).sign(vendor, deviceType, deviceCode, algorithm, nonce)
+
+    def verify(self, vendor, deviceType, deviceCode, algorithm, nonce, sign):
+        """
+        True if sign is the device's signature of the Register fields.
+        """
+        # Bytes, compare_digest raises on a str outside ASCII and sign comes from the device
+        return hmac.compare_digest(self.sign(vendor, deviceType, deviceCode, algorithm, nonce).encode(),
+                                   (sign or "").encode())
+
+    def verifyBatch(self, registrations):
+        """
+        Verify many captured Register requests, each a (vendor, deviceType, deviceCode,
+        algorithm, nonce, sign) tuple or a mapping with the LAPI query names. Returns a
+        list of booleans in input order, all checked against one table snapshot.
+        """
+        devices, vendors, default = self._state
+        compare = hmac.compare_digest
+        results = []
+        for registration in registrations:
+            if isinstance(registration, dict):
+                registration = tuple(registration.get(name, "") for name in
+                                     ("Vendor", "DeviceType", "DeviceCode", "Algorithm", "Nonce", "Sign"))
+            vendor, deviceType, deviceCode, algorithm, nonce, sign = registration
+            secret = devices.get(deviceCode)
+            if secret is None:
+                secret = vendors.get(vendor, default) if vendor else default
+            results.append(compare(secret.sign(vendor, deviceType, deviceCode, algorithm, nonce).encode(),
+                                   (sign or "").encode()))
+        return results
+
+    def reload(self):
+        """
+        Read the table again from path. Returns the number of device and vendor entries.
+        """
+        with self._lock:
+            # Remembered even if loading fails, a broken file is retried once it changes again
+            self._mtime = _mtime(self.path)
+            devices, vendors, default = _load(self.path)
+            self._state = (
+                {code: DeviceSecret(secret) for code, secret in devices.items()},
+                {name: DeviceSecret(secret) for name, secret in vendors.items()},
+                DeviceSecret(default if default is not None else self.default),
+            )
+            return len(devices) + len(vendors)
+
+    async def reloadAsync(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.reload)
+
+    def changed(self):
+        return _mtime(self.path) != self._mtime
+
+    async def watch(self, interval=SECRETS_RELOAD_INTERVAL):
+        """
+        Reload whenever the file changes, run as a task next to the server. A table that
+        fails to load is reported and the previous one stays in use.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await loop.run_in_executor(None, self.changed):
+                    count = await loop.run_in_executor(None, self.reload)
+                    log.info("Reloaded %d secrets from %s", count, self.path)
+            except Exception as e:
+                log.error("Secrets reload from %s failed: %s", self.path, e)
+
+    def __len__(self):
+        devices, vendors, _ = self._state
+        return len(devices) + len(vendors)
+
+    def __contains__(self, deviceCode):
+        return deviceCode in self._state[0]
+
+def signMessage(vendor, deviceType, deviceCode, algorithm, nonce):
+    return f"{vendor}/{deviceType}/{deviceCode}/{algorithm}/{nonce}".encode("utf-8")
+
+def getSecretTable(path=None, default=None):
+    """
+    Secret table from path, else from the file named by LAPI_SECRETS, else the default
+    secret alone.
+    """
+    return SecretTable(path or os.environ.get("LAPI_SECRETS") or None, default)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _load(path):
+    if os.path.splitext(path)[1].lower() in (".db", ".sqlite", ".sqlite3"):
+        return _loadSqlite(path)
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return dict(data.get("devices", {})), dict(data.get("vendors", {})), data.get("default")
+
+def _loadSqlite(path):
+    devices, vendors, default = {}, {}, None
+    connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    try:
+        for scope, name, secret in connection.execute("SELECT scope, name, secret FROM lapi_secrets"):
+            if scope == "device":
+                devices[name] = secret
+            elif scope == "vendor":
+                vendors[name] = secret
+            elif scope == "default":
+                default = secret
+    finally:
+        connection.close()
+    return devices, vendors, default
@@ -0,0 +1,373 @@
+import hmac
+import json
+import time
+from urllib.parse import unquote
+
+from Websocket.admission import AdmissionRejected, RegistrationAdmission
+from Websocket.deflate import DEFLATE, Uncompressed
+from Websocket.device_secrets import getSecretTable
+from Websocket.json_codec import DEFAULT_CODEC
+from Websocket.keepalive import LAPI_KEEPALIVE, KeepAliveStage, keepAliveSeconds, keepAlives
+from Websocket.liveness import DeviceLivenessTracker
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY
+from Websocket.nonce_store import NonceStore, getNonceStore, remoteHost
+from Websocket.reassembly import MessageBuffer, messagesStreamed
+from Websocket.registry import DeviceRegistry
+from Websocket.resumption import ResumptionTickets
+from Websocket.route_peek import peekPrefixURL, peekRequest
+from Websocket.routes import RouteTable
+
+log = getLogger("engine")
+
+# Registration interface
+LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
+# Close connection
+LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+
+# Protocol outcomes, the same series whichever transport carried the request
+handshakeRequests = REGISTRY.counter("lapi_handshake_requests", "Handshake HTTP requests by outcome", ("outcome",))
+registrations = REGISTRY.counter("lapi_registrations", "Register requests by result", ("result",))
+registerVerifySeconds = REGISTRY.histogram("lapi_register_verify_seconds", "Seconds to verify a Register signature")
+frames = REGISTRY.counter("lapi_frames", "WebSocket frames received by route or frame type", ("route",))
+
+class Handshake:
+    """
+    Answer to a handshake request: UPGRADE with the first text frame to send once the
+    connection is a WebSocket, or an HTTP status (401 challenge, 503 shed, 400/404/405)
+    with its body and headers.
+    """
+
+    __slots__ = ("status", "body", "headers", "deviceCode", "vendor", "deviceType")
+
+    UPGRADE = 101
+    BAD_REQUEST = 400
+    UNAUTHORIZED = 401
+    NOT_FOUND = 404
+    METHOD_NOT_ALLOWED = 405
+    SERVICE_UNAVAILABLE = 503
+
+    def __init__(self, status, body=None, headers=None, deviceCode=None, vendor="", deviceType=""):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.deviceCode = deviceCode
+        self.vendor = vendor
+        self.deviceType = deviceType
+
+    @property
+    def upgrade(self):
+        return self.status == self.UPGRADE
+
+    def text(self):
+        """
+        Body as JSON text, "" when there is none.
+        """
+        return json.dumps(self.body) if self.body is not None else ""
+
+    def __repr__(self):
+        return "Handshake(status=%d, deviceCode=%r)" % (self.status, self.deviceCode)
+
+class LapiEngine:
+    """
+    The LAPI device protocol without a transport: Register challenge, HMAC check and
+    resumption tickets, admission, the device registry and liveness, keepalive and
+    unregister frames.
+
+    A transport hands over what it parsed and writes back what it is given:
+    handshake()/route()+admit()+register() turn a request into a Handshake, attach()
+    and detach() bracket an upgraded connection, frame() turns a text frame into the
+    reply bytes. The connection objects a transport passes in only need a close() that
+    starts closing without blocking, it is called when a device expires, unregisters or
+    registers again elsewhere, and a send() that queues a text frame without blocking
+    and returns whether it was queued, for push().
+    """
+
+    # LAPI endpoints, handshake URIs and frame RequestURLs are each one dict lookup
+    httpRoutes = RouteTable()
+    frameRoutes = RouteTable()
+
+    def __init__(self, secretTable=None, nonceStore=None, resumptionTickets=None, deviceRegistry=None,
+                 registerAdmission=None, livenessTracker=None, keepAliveStage=None, jsonCodec=DEFAULT_CODEC):
+        # Authentication keys by DeviceCode, then Vendor, consistent with device settings (LAPI_SECRETS, LAPI_SECRET)
+        self.secretTable = secretTable or getSecretTable()
+        # Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+        self.nonceStore = nonceStore or getNonceStore()
+        # Lets a registered device reconnect in one round trip (LAPI_TICKET_KEY, LAPI_TICKET_LIFETIME)
+        self.resumptionTickets = resumptionTickets or ResumptionTickets()
+        # Registered devices of this process by DeviceCode, Vendor, DeviceType and IP
+        self.deviceRegistry = deviceRegistry if deviceRegistry is not None else DeviceRegistry()
+        # Paces Register requests: per-IP token buckets, a fair queue and 503 when shedding
+        self.registerAdmission = registerAdmission or RegistrationAdmission()
+        # Missed-heartbeat detection for every device of this process
+        self.livenessTracker = livenessTracker or DeviceLivenessTracker()
+        self.livenessTracker.addListener(lambda event, key: log.info("Device liveness: %s", event, device=key))
+        # Builds the KeepAliveRspAO reply, blockingWork runs on the shared executor after it
+        self.keepAliveStage = keepAliveStage or KeepAliveStage()
+        # Frame JSON codec, stdlib or an accelerated backend (LAPI_JSON_CODEC)
+        self.jsonCodec = jsonCodec
+
+    def useWorkers(self, workers):
+        """
+        Called before forking workers processes onto one port: a per-process nonce store
+        is swapped for the stateless one (or refused with LAPI_NONCE_MODE=store), as any
+        worker may receive the signed Register of a challenge another one issued.
+        """
+        if workers > 1 and isinstance(self.nonceStore, NonceStore):
+            self.nonceStore = getNonceStore(workers=workers)
+            log.info("Stateless Register nonces for %d workers", workers)
+
+    async def handshake(self, method, uri, upgrade, remote):
+        """
+        The whole handshake for transports that can await: route, wait for admission,
+        then register.
+        """
+        match = self.route(method, uri, upgrade, remote)
+        if isinstance(match, Handshake):
+            return match
+        try:
+            await self.admit(remote)
+        except AdmissionRejected as e:
+            return self.shed(e, match, remote)
+        return self.register(match, remote)
+
+    def route(self, method, uri, upgrade, remote):
+        """
+        RouteMatch of a handshake request, or the Handshake refusing it: 400 when it asks
+        for no WebSocket upgrade, 404 off the LAPI endpoints, 405 for another method.
+        """
+        if not upgrade:
+            handshakeRequests.labels("bad_request").inc()
+            log.warning("Not a request to establish a connection", route=uri, remote=remote)
+            return Handshake(Handshake.BAD_REQUEST)
+        match = self.httpRoutes.match(uri)
+        if match is None:
+            handshakeRequests.labels("not_found").inc()
+            log.warning("No LAPI endpoint", route=uri, remote=remote)
+            return Handshake(Handshake.NOT_FOUND)
+        if not match.allows(method):
+            handshakeRequests.labels("method_not_allowed").inc()
+            log.warning("%s is not allowed", method, route=match.path, remote=remote)
+            return Handshake(Handshake.METHOD_NOT_ALLOWED, headers={"Allow": match.route.allowHeader()})
+        handshakeRequests.labels("routed").inc()
+        return match
+
+    def admit(self, remote):
+        """
+        Admission first, so a registration storm is queued or shed before any HMAC work.
+        Every request takes a per-IP token, handleRegister() refunds a signed Register
+        once its Nonce is consumed. Returns a future done once the request may go on
+        (cancel it when the connection goes away first); raises AdmissionRejected when
+        shed, see shed().
+        """
+        admitted = self.registerAdmission.request(remoteHost(remote))
+        if not admitted.done():
+            registrations.labels("queued").inc()
+        return admitted
+
+    def shed(self, error, match, remote):
+        """
+        503 telling the device when to try registering again
+        """
+        registrations.labels("shed").inc()
+        log.warning("Registration shed: %s", error, route=match.path, remote=remote)
+        return Handshake(Handshake.SERVICE_UNAVAILABLE, headers={"Retry-After": str(error.retryAfter)})
+
+    def register(self, match, remote):
+        """
+        Handshake for an admitted request of a routed endpoint.
+        """
+        return match.handler(self, match, remote)
+
+    @httpRoutes.route(LAPI_REGISTER, methods=("GET",))
+    def handleRegister(self, match, remote):
+        """
+        Two-step device registration: a bare request gets a Nonce challenge (401), a
+        request carrying Vendor/DeviceType/DeviceCode/Algorithm/Nonce/Sign is verified and
+        upgraded, one carrying a Ticket resumes the device's session.
+        """
+        parameters = match.parameters()
+        if "Ticket" in parameters:
+            return self.resume(parameters, remote)
+        if "Vendor" not in parameters:
+            registrations.labels("challenged").inc()
+            return self.challenge(remote)
+        log.debug("Device initiates second registration", route=match.path, remote=remote)
+        vendor = parameters.get("Vendor", [""])[0]
+        deviceType = parameters.get("DeviceType", [""])[0]
+        deviceCode = parameters.get("DeviceCode", [""])[0]
+        algorithm = parameters.get("Algorithm", [""])[0]
+        nonce = parameters.get("Nonce", [""])[0]
+        cnonce = parameters.get("Cnonce", [""])[0]
+        sign = parameters.get("Sign", [""])[0]
+        # The Nonce must be one this server issued to the device and not used yet
+        if not self.nonceStore.consume(remoteHost(remote), nonce, deviceCode):
+            registrations.labels("nonce_rejected").inc()
+            log.warning("Unknown or expired Nonce: %s", nonce, device=deviceCode, remote=remote)
+            return self.challenge(remote, deviceCode)
+        # The challenge paid for this registration, a made-up Nonce keeps costing its IP
+        self.registerAdmission.refund(remoteHost(remote))
+        sign = unquote(sign, encoding="utf-8").replace(" ", "+")
+        log.debug("Certified Signature: %s", sign, device=deviceCode)
+        # Generate server-side signature with the device's pre-keyed HMAC
+        started = time.perf_counter()
+        expected = self.secretTable.sign(vendor, deviceType, deviceCode, algorithm, nonce)
+        registerVerifySeconds.observe(time.perf_counter() - started)
+        # Constant-time compare; bytes, since a str Sign outside ASCII makes compare_digest raise
+        if not hmac.compare_digest(expected.encode(), sign.encode()):
+            registrations.labels("auth_failed").inc()
+            log.warning("Authentication failed", device=deviceCode, remote=remote)
+            return self.challenge(remote, deviceCode)
+        log.info("Authentication successful", device=deviceCode, remote=remote)
+        registrations.labels("registered").inc()
+        return Handshake(Handshake.UPGRADE, {
+            "Cnonce": cnonce,
+            "Resign": expected,
+            "Ticket": self.resumptionTickets.issue(deviceCode, vendor, deviceType),
+        }, deviceCode=deviceCode, vendor=vendor, deviceType=deviceType)
+
+    def resume(self, parameters, remote):
+        """
+        Reconnect with a resumption ticket: upgrade straight away and hand out a fresh
+        ticket, an invalid or expired one falls back to the Nonce challenge
+        """
+        deviceCode = parameters.get("DeviceCode", [""])[0]
+        claims = self.resumptionTickets.verify(parameters["Ticket"][0], deviceCode)
+        if claims is None:
+            registrations.labels("ticket_rejected").inc()
+            log.info("Resumption ticket rejected, full registration required", device=deviceCode, remote=remote)
+            return self.challenge(remote, deviceCode)
+        log.info("Device resumed its session", device=claims.deviceCode, remote=remote)
+        registrations.labels("resumed").inc()
+        return Handshake(Handshake.UPGRADE,
+                         {"Ticket": self.resumptionTickets.issue(claims.deviceCode, claims.vendor, claims.deviceType)},
+                         deviceCode=claims.deviceCode, vendor=claims.vendor, deviceType=claims.deviceType)
+
+    def challenge(self, remote, deviceCode=""):
+        """
+        401 carrying a fresh Nonce, remembered for this device's IP (and DeviceCode once known)
+        """
+        return Handshake(Handshake.UNAUTHORIZED, {"Nonce": self.nonceStore.issue(remoteHost(remote), deviceCode)},
+                         {"Content-Type": "application/json; charset=UTF-8"})
+
+    def attach(self, handshake, connection, remote, handler=None):
+        """
+        Start tracking a device whose connection was upgraded: index it by DeviceCode and
+        give it a heartbeat deadline. A previous connection of the same device is stale
+        (the device would not register again over a live one) and is closed.
+        """
+        deviceCode = handshake.deviceCode
+        previous = self.deviceRegistry.add(deviceCode, connection, handshake.vendor, handshake.deviceType,
+                                           remote, handler)
+        if previous is not None:
+            log.info("Device reconnected, closing its old connection from %s:%s", previous.ip, previous.port,
+                     device=deviceCode, remote=remote)
+            previous.connection.close()
+        self.livenessTracker.register(deviceCode, connection.close)
+
+    def detach(self, deviceCode, connection):
+        """
+        Forget a device's connection once it is gone, a newer connection of the same
+        device is left alone.
+        """
+        self.livenessTracker.remove(deviceCode, connection.close)
+        self.deviceRegistry.remove(deviceCode, connection)
+
+    def push(self, deviceCode, message):
+        """
+        Send a text frame (dict, str or UTF-8 bytes) to a device registered with this
+        process. Never waits for the device: False when it is not connected here or its
+        connection is over its outbound high-water mark.
+        """
+        session = self.deviceRegistry.get(deviceCode)
+        if session is None:
+            return False
+        if isinstance(message, dict):
+            message = self.jsonCodec.dumpsBytes(message)
+        return session.connection.send(message)
+
+    def frame(self, connection, deviceCode, payload):
+        """
+        Handle one text frame (str or UTF-8 bytes) of an attached device. Returns the reply
+        as UTF-8 bytes, None when there is nothing to answer. Replies of routes registered
+        with compress=False are Uncompressed when permessage-deflate is enabled.
+        """
+        # Routed on URL and Cseq peeked from the frame, the JSON body is only decoded if a
+        # handler reads Method or Data
+        request = peekRequest(payload, self.jsonCodec)
+        match = self.frameRoutes.match(request.getRequestURL())
+        if match is None:
+            frames.labels("unmatched").inc()
+            return None
+        frames.labels(match.path).inc()
+        # Routes without a method list accept any, so a lazily decoded request stays undecoded
+        if match.route.methods is not None and not match.allows(request.Method):
+            log.warning("Method not allowed", route=match.path, device=deviceCode)
+            return None
+        if match.route.stream:
+            # A stream route is fed a message that arrived whole as its only chunk
+            consumer = match.handler(self, connection, deviceCode, match)
+            if consumer.feed(payload.encode("utf-8") if isinstance(payload, str) else payload) is False:
+                return None
+            return consumer.finish()
+        reply = match.handler(self, connection, deviceCode, request)
+        if reply is not None and DEFLATE.enabled and not match.route.compress:
+            reply = Uncompressed(reply)
+        return reply
+
+    def openStream(self, connection, deviceCode, chunk):
+        """
+        Sink for a message arriving in chunks (UTF-8 bytes), picked from its first chunk.
+
+        A frame route registered with stream=True whose RequestURL is in that chunk is
+        called as handler(engine, connection, deviceCode, match) and returns a consumer:
+        feed(chunk) for every chunk (False refuses the message), finish() once it is
+        complete, returning the reply bytes or None, and abort() when the connection goes
+        away first. Any other message is joined by a MessageBuffer under the process
+        reassembly budget and then goes through frame().
+        """
+        match = self.frameRoutes.match(peekPrefixURL(chunk))
+        if match is None or not match.route.stream:
+            return MessageBuffer(self, connection, deviceCode)
+        frames.labels(match.path).inc()
+        messagesStreamed.inc()
+        return match.handler(self, connection, deviceCode, match)
+
+    # Heartbeats are small and frequent, compressing them would only cost CPU
+    @frameRoutes.route(LAPI_KEEPALIVE, compress=False)
+    def handleKeepalive(self, connection, deviceCode, request):
+        started = time.perf_counter()
+        self.livenessTracker.keepalive(deviceCode)
+        reply = self.keepAliveStage.respondBytes(request)
+        latency = time.perf_counter() - started
+        keepAlives.inc()
+        keepAliveSeconds.observe(latency)
+        # INFO heartbeats are rate limited per route (LAPI_LOG_RATE)
+        log.info("The server received a device's keep alive request", route=request.getRequestURL(),
+                 device=deviceCode, cseq=request.Cseq, latency=latency)
+        if self.keepAliveStage.blockingWork is not None:
+            self.keepAliveStage.offload(self.keepAliveStage.blockingWork, request, deviceCode)
+        return reply
+
+    @frameRoutes.route(LAPI_UNREGISTER)
+    def handleUnregister(self, connection, deviceCode, request):
+        log.info("Device unregistered", device=deviceCode)
+        connection.close()
+        return None
+
+# Shared by every transport of this process
+ENGINE = LapiEngine()
+
+# Read from the shared engine at scrape time
+REGISTRY.gauge("lapi_devices_registered", "Devices registered on this process",
+               function=lambda: len(ENGINE.deviceRegistry))
+REGISTRY.gauge("lapi_register_queue_depth", "Register requests waiting for admission",
+               function=lambda: ENGINE.registerAdmission.stats()["queueDepth"])
+REGISTRY.gauge("lapi_devices_online", "Devices whose heartbeats are on time",
+               function=lambda: ENGINE.livenessTracker.stats()["online"])
+REGISTRY.gauge("lapi_devices_late", "Devices that missed their heartbeat deadline",
+               function=lambda: ENGINE.livenessTracker.stats()["late"])
+REGISTRY.counterFunction("lapi_devices_expired", "Devices closed after missing heartbeats",
+                         function=lambda: ENGINE.livenessTracker.stats()["expired"])
+REGISTRY.counterFunction("lapi_register_shed", "Register requests shed by admission control",
+                         function=lambda: ENGINE.registerAdmission.stats()["shed"])
@@ -0,0 +1,136 @@
+import json
+import os
+
+from Websocket.messages import WebsocketReq, WebsocketRsp
+
+# Optional accelerated backends, the stdlib codec is always available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+class JsonCodec:
+    """
+    Stdlib json backend. Every backend exposes the same API, takes str or bytes and
+    raises json.JSONDecodeError on bad input so callers keep a single except clause.
+    """
+
+    name = "json"
+    # Route on a peek at the raw frame (route_peek) instead of a full decode. Only worth
+    # it when the decoder is slower than a Python-level scan of the frame.
+    peekRoutes = True
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def dumpsBytes(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def decodeRequest(self, data):
+        """
+        Decode a text frame straight into a WebsocketReq.
+        """
+        return WebsocketReq.fromDict(self._object(data))
+
+    def decodeResponse(self, data):
+        return WebsocketRsp.fromDict(self._object(data))
+
+    def encodeResponse(self, rsp):
+        return self.dumps(rsp.toDict())
+
+    def _object(self, data):
+        obj = self.loads(data)
+        if not isinstance(obj, dict):
+            raise _decodeError("Expected a JSON object", data)
+        return obj
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+    peekRoutes = False
+
+    def loads(self, data):
+        # orjson.JSONDecodeError already subclasses json.JSONDecodeError
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def dumpsBytes(self, obj):
+        return orjson.dumps(obj)
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+    peekRoutes = False
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+
+    def loads(self, data):
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise _decodeError(str(e), data) from e
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).decode("utf-8")
+
+    def dumpsBytes(self, obj):
+        return self._encoder.encode(obj)
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+    peekRoutes = False
+
+    def loads(self, data):
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            raise _decodeError(str(e), data) from e
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    def dumpsBytes(self, obj):
+        return self.dumps(obj).encode("utf-8")
+
+def _decodeError(msg, data):
+    doc = data if isinstance(data, str) else bytes(data).decode("utf-8", "replace")
+    return json.JSONDecodeError(msg, doc, 0)
+
+# Backends importable in this environment, fastest first
+CODECS = {"json": JsonCodec}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+if msgspec is not None:
+    CODECS["msgspec"] = MsgspecCodec
+if ujson is not None:
+    CODECS["ujson"] = UjsonCodec
+PREFERENCE = ("orjson", "msgspec", "ujson", "json")
+
+def getCodec(name=None):
+    """
+    Codec by name, else the one named by LAPI_JSON_CODEC, else the fastest available.
+    """
+    name = name or os.environ.get("LAPI_JSON_CODEC")
+    if name:
+        if name not in CODECS:
+            raise ValueError("JSON codec %r is not available, installed: %s" % (name, ", ".join(CODECS)))
+        return CODECS[name]()
+    for candidate in PREFERENCE:
+        if candidate in CODECS:
+            return CODECS[candidate]()
+
+# Process-wide codec used by the server variants
+DEFAULT_CODEC = getCodec()
@@ -38,11 +38,14 @@
 
 
 # ---------------------------------------
-import threading
 import concurrent.futures
+import os
 import queue
+import threading
 import time
 
+from Websocket.metrics import REGISTRY
+
 class AtomicInteger:
     def __init__(self, initial=0):
         self.value = initial
@@ -54,21 +57,254 @@ class AtomicInteger:
             self.value += 1
             return current
 
+    def incrementAndGet(self):
+        with self._lock:
+            self.value += 1
+            return self.value
+
+    def get(self):
+        return self.value
+
+class RejectedExecutionException(Exception):
+    pass
+
+# Rejection policies, same contract as java.util.concurrent.RejectedExecutionHandler:
+# rejectedExecution(task, executor) is called once the queue is full and max threads are busy.
+class AbortPolicy:
+    # Reject with an exception, the executor has already counted it in getRejectedCount()
+    def rejectedExecution(self, task, executor):
+        task.cancel()
+        raise RejectedExecutionException("Task rejected from %s" % executor)
+
+class CallerRunsPolicy:
+    # Run the task in the submitting thread. On the event loop this blocks the loop,
+    # so it only suits tasks that are cheap or callers that are not the loop thread.
+    def rejectedExecution(self, task, executor):
+        if executor.isShutdown():
+            task.cancel()
+        else:
+            task.run()
+
+class DiscardOldestPolicy:
+    # Drop the oldest queued task and retry, a stale heartbeat is worth less than a fresh one
+    def rejectedExecution(self, task, executor):
+        if executor.isShutdown():
+            task.cancel()
+            return
+        try:
+            oldest = executor.getQueue().get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            if oldest is None:
+                # Sentinels are only queued by shutdown(), which raced in: a worker still
+                # needs this one to exit, and the task can no longer run
+                executor.getQueue().put(None)
+                task.cancel()
+                return
+            oldest.cancel()
+        executor.execute(task)
+
+class DiscardPolicy:
+    # Silently drop the rejected task
+    def rejectedExecution(self, task, executor):
+        task.cancel()
+
+# Unit of work queued on the executor, completes a concurrent.futures.Future
+class _WorkItem:
+    __slots__ = ("future", "fn", "args", "kwargs", "queuedAt")
+
+    def __init__(self, future, fn, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.queuedAt = time.perf_counter()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+    def cancel(self):
+        self.future.cancel()
+
 class KeepLiveThreadPoolExecutor:
     THREAD_NUM = AtomicInteger(1)
     CORE_POOL_SIZE = 50
     MAX_POOL_SIZE = 100
-    KEEP_ALIVE_TIME = 5  # Note: Not directly applicable in Python
+    KEEP_ALIVE_TIME = 5  # Seconds an idle thread above the core size waits before exiting
     QUEUE_SIZE = 1000
 
-    # Use the ThreadPoolExecutor for thread management
-    def __init__(self):
-        self.executor_service = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_POOL_SIZE)
+    # Process-wide instance shared by every handler, assigned below the class
+    EXECUTOR_SERVICE = None
+
+    # Same sizing rules as java.util.concurrent.ThreadPoolExecutor: start core threads first,
+    # then queue up to queueSize tasks, then grow to maxPoolSize, then reject.
+    def __init__(self, corePoolSize=CORE_POOL_SIZE, maxPoolSize=MAX_POOL_SIZE,
+                 keepAliveTime=KEEP_ALIVE_TIME, queueSize=QUEUE_SIZE,
+                 rejectedHandler=None, threadFactory=None, waitTime=None, runTime=None):
+        if corePoolSize < 0 or maxPoolSize <= 0 or maxPoolSize < corePoolSize or keepAliveTime < 0:
+            raise ValueError("Invalid pool sizing")
+        self.corePoolSize = corePoolSize
+        self.maxPoolSize = maxPoolSize
+        self.keepAliveTime = keepAliveTime
+        self.queueSize = queueSize
+        self.rejectedHandler = rejectedHandler or DiscardOldestPolicy()
+        self.threadFactory = threadFactory or self.NVRThreadFactory("KeepLiveThreadPool")
+        # Optional histograms of the seconds a task waited for a thread and then ran
+        self.waitTime = waitTime
+        self.runTime = runTime
+        self._allowCoreThreadTimeOut = False
+        self._resetState()
+
+    def _resetState(self):
+        # Capacity is enforced under _lock, the queue itself is unbounded so
+        # shutdown can always enqueue its wake-up sentinels.
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # Signalled under _lock when the last worker exits after shutdown
+        self._termination = threading.Condition(self._lock)
+        self._poolSize = 0
+        self._activeCount = 0
+        self._largestPoolSize = 0
+        self._completedTaskCount = 0
+        self._rejectedCount = AtomicInteger(0)
+        self._shutdown = False
+
+    def allowCoreThreadTimeOut(self, value):
+        self._allowCoreThreadTimeOut = value
 
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.execute(_WorkItem(future, fn, args, kwargs))
+        return future
+
+    def execute(self, task):
+        with self._lock:
+            if not self._shutdown:
+                if self._poolSize < self.corePoolSize:
+                    self._addWorker(task)
+                    return
+                if self._queue.qsize() < self.queueSize:
+                    self._queue.put(task)
+                    if self._poolSize == 0:
+                        self._addWorker(None)
+                    return
+                if self._poolSize < self.maxPoolSize:
+                    self._addWorker(task)
+                    return
+        self._rejectedCount.incrementAndGet()
+        self.rejectedHandler.rejectedExecution(task, self)
+
+    # Kept for callers of the original API, the target runs on a pool thread directly
     def create_thread(self, target, *args, **kwargs):
-        thread_name = f"KeepLiveThreadPool-{self.THREAD_NUM.getAndIncrement()}"
-        thread = threading.Thread(target=target, args=args, kwargs=kwargs, name=thread_name)
-        self.executor_service.submit(thread.start)
+        return self.submit(target, *args, **kwargs)
+
+    def _addWorker(self, firstTask):
+        # Caller holds _lock
+        self._poolSize += 1
+        self._largestPoolSize = max(self._largestPoolSize, self._poolSize)
+        thread = self.threadFactory.newThread(lambda: self._runWorker(firstTask))
+        thread.daemon = True
+        thread.start()
+
+    def _runWorker(self, task):
+        while True:
+            if task is None:
+                task = self._getTask()
+                if task is None:
+                    return
+            with self._lock:
+                self._activeCount += 1
+            started = time.perf_counter()
+            if self.waitTime is not None and hasattr(task, "queuedAt"):
+                self.waitTime.observe(started - task.queuedAt)
+            try:
+                task.run()
+            finally:
+                if self.runTime is not None:
+                    self.runTime.observe(time.perf_counter() - started)
+                with self._lock:
+                    self._activeCount -= 1
+                    self._completedTaskCount += 1
+                task = None
+
+    def _getTask(self):
+        while True:
+            with self._lock:
+                timed = self._allowCoreThreadTimeOut or self._poolSize > self.corePoolSize
+            try:
+                task = self._queue.get(timeout=self.keepAliveTime) if timed else self._queue.get()
+            except queue.Empty:
+                with self._lock:
+                    # Reap the idle thread unless it is needed to keep the pool at core size,
+                    # never leave queued work without a thread to run it
+                    if (self._allowCoreThreadTimeOut or self._poolSize > self.corePoolSize) and \
+                            (self._poolSize > 1 or self._queue.empty()):
+                        self._workerExited()
+                        return None
+                continue
+            if task is None:
+                # Shutdown sentinel
+                with self._lock:
+                    self._workerExited()
+                return None
+            return task
+
+    def _workerExited(self):
+        # Caller holds _lock
+        self._poolSize -= 1
+        if self._poolSize == 0:
+            self._termination.notify_all()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            workers = self._poolSize
+        # Queued tasks still run, one sentinel per worker follows them
+        for _ in range(workers):
+            self._queue.put(None)
+        if wait:
+            self.awaitTermination()
+
+    def awaitTermination(self, timeout=None):
+        """
+        Block until every worker has exited after shutdown(), True unless timeout
+        seconds passed first.
+        """
+        with self._termination:
+            return self._termination.wait_for(lambda: self._poolSize == 0, timeout)
+
+    def isShutdown(self):
+        return self._shutdown
+
+    def getQueue(self):
+        return self._queue
+
+    def getPoolSize(self):
+        return self._poolSize
+
+    def getActiveCount(self):
+        return self._activeCount
+
+    def getLargestPoolSize(self):
+        return self._largestPoolSize
+
+    def getCompletedTaskCount(self):
+        return self._completedTaskCount
+
+    def getRejectedCount(self):
+        return self._rejectedCount.get()
+
+    def __str__(self):
+        return "KeepLiveThreadPoolExecutor[pool=%d, active=%d, queued=%d, completed=%d, rejected=%d]" % (
+            self._poolSize, self._activeCount, self._queue.qsize(), self._completedTaskCount, self.getRejectedCount())
 
     class NVRThreadFactory:
         def __init__(self, namePrefix):
@@ -78,10 +314,30 @@ class KeepLiveThreadPoolExecutor:
             thread_name = f"{self.namePrefix}-{KeepLiveThreadPoolExecutor.THREAD_NUM.getAndIncrement()}"
             return threading.Thread(target=r, name=thread_name)
 
+KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE = KeepLiveThreadPoolExecutor(
+    waitTime=REGISTRY.histogram("lapi_executor_task_wait_seconds", "Seconds keep alive tasks waited for a pool thread"),
+    runTime=REGISTRY.histogram("lapi_executor_task_run_seconds", "Seconds keep alive tasks ran on a pool thread"))
+# Read at scrape time, no bookkeeping on the submit path
+REGISTRY.gauge("lapi_executor_queue_depth", "Keep alive tasks queued for a pool thread",
+               function=lambda: KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.getQueue().qsize())
+REGISTRY.gauge("lapi_executor_threads", "Threads of the keep alive pool",
+               function=lambda: KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.getPoolSize())
+REGISTRY.gauge("lapi_executor_active_threads", "Pool threads running a keep alive task",
+               function=lambda: KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.getActiveCount())
+REGISTRY.counterFunction("lapi_executor_tasks_completed", "Keep alive tasks the pool has run",
+                         function=lambda: KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.getCompletedTaskCount())
+REGISTRY.counterFunction("lapi_executor_tasks_rejected", "Keep alive tasks the pool rejected when full",
+                         function=lambda: KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE.getRejectedCount())
+# Forked workers (see worker_group.py) inherit none of the parent's threads, start from an empty pool
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE._resetState)
+
 def sample_task(arg):
     print(f"Task running with argument: {arg}")
 
 if __name__ == "__main__":
-    executor = KeepLiveThreadPoolExecutor()
+    executor = KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE
     executor.create_thread(sample_task, "Test Argument 1")
     executor.create_thread(sample_task, "Test Argument 2")
+    executor.shutdown(wait=True)
+    print(executor)
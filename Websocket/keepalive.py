@@ -0,0 +1,158 @@
+import asyncio
+import json
+import time
+
+from Websocket.keep_live_thread_pool_executor import KeepLiveThreadPoolExecutor
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY
+
+log = getLogger("keepalive")
+
+# Keep alive interface
+LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
+# Seconds advertised to the device in KeepAliveRspAO.Timeout
+KEEP_ALIVE_TIMEOUT = 60
+# WebsocketCodeEnum.SUCCESS
+SUCCESS_CODE = 0
+SUCCESS_STRING = "Succeed"
+
+# Heartbeats answered by any transport, and the seconds from receipt to the reply being written
+keepAlives = REGISTRY.counter("lapi_keepalives", "Keep alive requests answered")
+keepAliveSeconds = REGISTRY.histogram("lapi_keepalive_seconds", "Seconds to answer a keep alive request")
+
+def keepAliveResponse(cseq, timeout=KEEP_ALIVE_TIMEOUT, responseString=SUCCESS_STRING):
+    """
+    WebsocketRsp carrying a KeepAliveRspAO, as a plain dict ready for json.dumps.
+    """
+    return {
+        "ResponseURL": LAPI_KEEPALIVE,
+        "ResponseCode": SUCCESS_CODE,
+        "ResponseString": responseString,
+        "Cseq": cseq,
+        "Data": {
+            "Timestamp": int(time.time()),
+            "Timeout": timeout,
+        },
+    }
+
+class KeepAliveResponseTemplate:
+    """
+    Pre-rendered keep alive response for one (ResponseURL, ResponseCode, ResponseString, Timeout).
+
+    Only Cseq and Timestamp vary between heartbeats, so the constant JSON around them is
+    rendered once and a reply is a join of five pieces with no JSON encoder call.
+    Produces the same document as json.dumps(keepAliveResponse(...)).
+    """
+
+    _CSEQ = "@@Cseq@@"
+    _TIMESTAMP = "@@Timestamp@@"
+    _cache = {}
+    # (second, text, bytes) shared by every template, the timestamp changes once a second
+    _now = (None, None, None)
+
+    def __init__(self, responseURL, responseCode, responseString, timeout):
+        document = {
+            "ResponseURL": responseURL,
+            "ResponseCode": responseCode,
+            "ResponseString": responseString,
+            "Cseq": self._CSEQ,
+            "Data": {"Timestamp": self._TIMESTAMP, "Timeout": timeout},
+        }
+        head, rest = json.dumps(document).split(json.dumps(self._CSEQ))
+        middle, tail = rest.split(json.dumps(self._TIMESTAMP))
+        self._text = (head, middle, tail)
+        self._bytes = tuple(part.encode("utf-8") for part in self._text)
+
+    @classmethod
+    def get(cls, responseURL=LAPI_KEEPALIVE, responseCode=SUCCESS_CODE, responseString=SUCCESS_STRING,
+            timeout=KEEP_ALIVE_TIMEOUT):
+        key = (responseURL, responseCode, responseString, timeout)
+        template = cls._cache.get(key)
+        if template is None:
+            template = cls._cache[key] = cls(responseURL, responseCode, responseString, timeout)
+        return template
+
+    @classmethod
+    def _timestamp(cls):
+        now = int(time.time())
+        cached = cls._now
+        if cached[0] != now:
+            text = str(now)
+            cached = cls._now = (now, text, text.encode("ascii"))
+        return cached
+
+    @staticmethod
+    def _encodeCseq(cseq):
+        if type(cseq) is int:
+            return str(cseq)
+        # Devices normally send an integer, anything else goes through the encoder
+        return json.dumps(cseq)
+
+    def render(self, cseq):
+        """
+        UTF-8 bytes of the response, for transports that write bytes (the native pipeline).
+        """
+        head, middle, tail = self._bytes
+        return b"".join((head, self._encodeCseq(cseq).encode("ascii"), middle, self._timestamp()[2], tail))
+
+    def renderText(self, cseq):
+        """
+        The response as str, for send()/send_str() style transports.
+        """
+        head, middle, tail = self._text
+        return "".join((head, self._encodeCseq(cseq), middle, self._timestamp()[1], tail))
+
+class KeepAliveStage:
+    """
+    Answers heartbeats on the connection's own event loop.
+
+    The response is built and written inline, heartbeats never wait for a thread.
+    Work that genuinely blocks (database writes, calls into device SDKs) goes to
+    blockingWork, which runs on the shared KeepLiveThreadPoolExecutor after the reply.
+    """
+
+    def __init__(self, timeout=KEEP_ALIVE_TIMEOUT, responseString=SUCCESS_STRING, blockingWork=None, executor=None):
+        self.timeout = timeout
+        self.responseString = responseString
+        self.blockingWork = blockingWork
+        self.executor = executor or KeepLiveThreadPoolExecutor.EXECUTOR_SERVICE
+        self.template = KeepAliveResponseTemplate.get(LAPI_KEEPALIVE, SUCCESS_CODE, responseString, timeout)
+
+    def respond(self, request):
+        """
+        Serialized keep alive response for a WebsocketReq (or request dict).
+        """
+        return self.template.renderText(_cseq(request))
+
+    def respondBytes(self, request):
+        """
+        Same response as UTF-8 bytes, ready for a text frame.
+        """
+        return self.template.render(_cseq(request))
+
+    async def handle(self, send, jsonObject, *context):
+        """
+        Reply through the connection's send coroutine, then offload blockingWork(jsonObject, *context).
+        """
+        started = time.perf_counter()
+        await send(self.respond(jsonObject))
+        keepAlives.inc()
+        keepAliveSeconds.observe(time.perf_counter() - started)
+        if self.blockingWork is not None:
+            self.offload(self.blockingWork, jsonObject, *context)
+
+    def offload(self, fn, *args):
+        """
+        Run fn(*args) on the executor and return an asyncio future bound to the running loop,
+        so the result (or exception) is handed back on the loop thread.
+        """
+        future = asyncio.wrap_future(self.executor.submit(fn, *args))
+        future.add_done_callback(_reportFailure)
+        return future
+
+def _cseq(request):
+    return request.get("Cseq") if isinstance(request, dict) else request.Cseq
+
+def _reportFailure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("Error during keep-alive processing: %s", future.exception(), route=LAPI_KEEPALIVE)
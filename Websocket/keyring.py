@@ -0,0 +1,79 @@
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+class KeyRing:
+    """
+    Server MAC keys: the first signs, all of them verify.
+
+    Keys come from the argument, else from the environment variable named by
+    environ (comma separated hex, newest first), else a random per-process key
+    that forked workers inherit. Nodes that must verify each other's tokens share
+    the variable. rotate() puts a new signing key in front and keeps the previous
+    ones verifying, so tokens already handed out stay valid until they expire.
+    """
+
+    def __init__(self, keys=None, environ=None, keep=3):
+        if keys is None:
+            keys = _environKeys(environ) or [secrets.token_bytes(32)]
+        if not keys:
+            raise ValueError("KeyRing needs at least one key")
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._install(list(keys))
+
+    def _install(self, keys):
+        byId = {}  # key id -> keys with that id, ids are one byte and may collide
+        for key in keys:
+            byId.setdefault(keyId(key), []).append(key)
+        # One tuple swap, readers never see a half-rotated ring
+        self._state = (keys, keyId(keys[0]), byId)
+
+    @property
+    def signing(self):
+        return self._state[0][0]
+
+    @property
+    def signingId(self):
+        return self._state[1]
+
+    def signer(self):
+        """
+        (key id, signing key) from one read of the ring, a concurrent rotate() cannot pair
+        the id of one key with the other key.
+        """
+        keys, signingId, _ = self._state
+        return signingId, keys[0]
+
+    def keys(self):
+        return list(self._state[0])
+
+    def candidates(self, keyIdByte):
+        """
+        Keys a token stamped with this key id may have been signed with.
+        """
+        return self._state[2].get(keyIdByte, ())
+
+    def rotate(self, key=None):
+        """
+        Sign with key (random if None) from now on, keeping keep - 1 previous keys. Returns key.
+        """
+        key = key or secrets.token_bytes(32)
+        with self._lock:
+            self._install(([key] + [old for old in self._state[0] if old != key])[:max(self.keep, 1)])
+        return key
+
+    def mac(self, key, message, size):
+        return hmac.new(key, message, hashlib.sha256).digest()[:size]
+
+    def verify(self, keyIdByte, message, tag):
+        return any(hmac.compare_digest(tag, self.mac(key, message, len(tag))) for key in self.candidates(keyIdByte))
+
+def keyId(key):
+    return hashlib.sha256(key).digest()[0]
+
+def _environKeys(environ):
+    value = os.environ.get(environ, "") if environ else ""
+    return [bytes.fromhex(key.strip()) for key in value.split(",") if key.strip()]
@@ -0,0 +1,116 @@
+import asyncio
+
+from Websocket.keepalive import KEEP_ALIVE_TIMEOUT
+from Websocket.log import getLogger
+from Websocket.timing_wheel import HierarchicalTimingWheel
+
+log = getLogger("liveness")
+
+class DeviceLivenessTracker:
+    """
+    Tracks the last /LAPI/V1.0/System/UpServer/Keepalive of every device on one timing wheel.
+
+    Each keepalive reschedules the device's deadline in O(1). A device that stays silent
+    for lateAfter seconds is marked late; at timeout seconds it is marked expired, its
+    close callback is called and the "expired" event is emitted. One loop timer drives
+    the whole wheel, no per-connection asyncio.sleep.
+    """
+
+    ONLINE = "online"
+    LATE = "late"
+    EXPIRED = "expired"
+
+    def __init__(self, timeout=KEEP_ALIVE_TIMEOUT, lateAfter=None, tickDuration=1.0, wheel=None):
+        self.timeout = timeout
+        self.lateAfter = timeout / 2 if lateAfter is None else lateAfter
+        self.tickDuration = tickDuration
+        self.wheel = wheel or HierarchicalTimingWheel(tickDuration)
+        self._states = {}   # device key -> ONLINE / LATE
+        self._closers = {}  # device key -> callable closing the device's connection
+        self._late = 0
+        self._expired = 0
+        self._listeners = []
+        self._handle = None
+
+    def addListener(self, listener):
+        """
+        listener(event, key) is called with "late", "expired" or "online" (recovered from late).
+        """
+        self._listeners.append(listener)
+
+    def register(self, key, close=None):
+        """
+        Start tracking a device, close() is called if it expires.
+        """
+        if close is not None:
+            self._closers[key] = close
+        self.keepalive(key)
+
+    def keepalive(self, key):
+        self._ensureStarted()
+        if self._states.get(key) == self.LATE:
+            self._late -= 1
+            self._emit(self.ONLINE, key)
+        self._states[key] = self.ONLINE
+        self.wheel.schedule(key, self.lateAfter, self._onLate)
+
+    def remove(self, key, close=None):
+        """
+        Stop tracking a device that disconnected or unregistered. When close is given the
+        entry is only dropped if it still belongs to that connection, so a stale connection
+        going away does not untrack the device's new one.
+        """
+        if close is not None and key in self._closers and self._closers[key] != close:
+            return
+        if self._states.pop(key, None) == self.LATE:
+            self._late -= 1
+        self._closers.pop(key, None)
+        self.wheel.cancel(key)
+
+    def state(self, key):
+        return self._states.get(key)
+
+    def stats(self):
+        return {
+            "online": len(self._states) - self._late,
+            "late": self._late,
+            "expired": self._expired,
+        }
+
+    def _onLate(self, key):
+        self._states[key] = self.LATE
+        self._late += 1
+        self.wheel.schedule(key, max(self.timeout - self.lateAfter, 0), self._onExpired)
+        self._emit(self.LATE, key)
+
+    def _onExpired(self, key):
+        if self._states.pop(key, None) == self.LATE:
+            self._late -= 1
+        self._expired += 1
+        close = self._closers.pop(key, None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                log.error("Error closing expired device: %s", e, device=key)
+        self._emit(self.EXPIRED, key)
+
+    def _emit(self, event, key):
+        for listener in self._listeners:
+            try:
+                listener(event, key)
+            except Exception as e:
+                log.error("Liveness listener failed: %s", e, device=key)
+
+    def _ensureStarted(self):
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self.tickDuration, self._onTick)
+
+    def _onTick(self):
+        self.wheel.advance()
+        self._handle = asyncio.get_running_loop().call_later(self.tickDuration, self._onTick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
@@ -0,0 +1,332 @@
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# Events waiting for the writer thread; beyond this they are dropped, never blocking the loop
+LOG_QUEUE_SIZE = 65536
+# Structured fields an event may carry, in output order
+FIELDS = ("device", "route", "remote", "latency", "cseq")
+# Events formatted per write() by the writer thread
+LOG_BATCH_SIZE = 512
+# Heartbeats dominate the traffic, their INFO events are rate limited by default
+DEFAULT_RATE_LIMITS = {"/LAPI/V1.0/System/UpServer/Keepalive": 20}
+
+class LogEvent:
+    """
+    What a log call leaves on the queue: message, arguments and fields, formatted later
+    by the writer thread.
+    """
+
+    __slots__ = ("created", "levelno", "name", "msg", "args", "fields", "exc_info")
+
+    def __init__(self, levelno, name, msg, args, fields, exc_info=None):
+        self.created = time.time()
+        self.levelno = levelno
+        self.name = name
+        self.msg = msg
+        self.args = args
+        self.fields = fields
+        self.exc_info = exc_info
+
+    @property
+    def levelname(self):
+        return logging.getLevelName(self.levelno)
+
+    def getMessage(self):
+        msg = str(self.msg)
+        return msg % self.args if self.args else msg
+
+class StructuredLogger:
+    """
+    Logger taking structured fields as keywords:
+
+        log.info("Keep alive", device=code, route=url, latency=elapsed)
+
+    Levels come from the stdlib logger of the same name, so logging.getLogger("lapi")
+    .setLevel() still applies. A disabled level costs one cached isEnabledFor() lookup:
+    no event is built and %-style arguments are never formatted, so pass values as
+    arguments, not f-strings. Events of a sampled or rate limited route are dropped
+    before they are built as well.
+    """
+
+    __slots__ = ("logger", "name")
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.name = logger.name
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args, exc_info=None, **fields):
+        if self.logger.isEnabledFor(level):
+            self._emit(level, msg, args, exc_info, fields)
+
+    def debug(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(DEBUG):
+            self._emit(DEBUG, msg, args, None, fields)
+
+    def info(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(INFO):
+            self._emit(INFO, msg, args, None, fields)
+
+    def warning(self, msg, *args, exc_info=None, **fields):
+        if self.logger.isEnabledFor(WARNING):
+            self._emit(WARNING, msg, args, exc_info, fields)
+
+    def error(self, msg, *args, exc_info=None, **fields):
+        if self.logger.isEnabledFor(ERROR):
+            self._emit(ERROR, msg, args, exc_info, fields)
+
+    def exception(self, msg, *args, **fields):
+        self.error(msg, *args, exc_info=True, **fields)
+
+    def _emit(self, level, msg, args, exc_info, fields):
+        writer = _writer if _writer is not None else _start()
+        route = fields.get("route")
+        if route is not None and level < WARNING:
+            dropped = writer.sampler.allow(route)
+            if dropped is None:
+                return
+            if dropped:
+                fields["dropped"] = dropped
+        if isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+        elif exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        writer.put(LogEvent(level, self.name, msg, args, fields, exc_info))
+
+class RouteSampler:
+    """
+    Thins events per route: sampling keeps one event in N, rateLimits caps events per
+    second with a token bucket. Routes are compared without their query string.
+    """
+
+    def __init__(self, sampling=None, rateLimits=None, clock=time.monotonic):
+        self.sampling = dict(sampling or {})
+        self.rateLimits = dict(rateLimits or {})
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._seen = {}     # route -> events seen, for 1 in N sampling
+        self._buckets = {}  # route -> [tokens, updated]
+        self._dropped = {}  # route -> dropped since the last event kept
+        self.total = 0
+
+    def allow(self, route):
+        """
+        None to drop the event, else how many were dropped for route since the last one kept.
+        """
+        route = route.partition("?")[0]
+        every = self.sampling.get(route)
+        rate = self.rateLimits.get(route)
+        if every is None and rate is None:
+            return 0
+        with self._lock:
+            keep = True
+            if every and every > 1:
+                seen = self._seen[route] = self._seen.get(route, 0) + 1
+                keep = seen % every == 1
+            if keep and rate is not None:
+                now = self.clock()
+                bucket = self._buckets.get(route)
+                if bucket is None:
+                    bucket = self._buckets[route] = [rate, now]
+                bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                keep = bucket[0] >= 1
+                if keep:
+                    bucket[0] -= 1
+            if not keep:
+                self._dropped[route] = self._dropped.get(route, 0) + 1
+                self.total += 1
+                return None
+            return self._dropped.pop(route, 0)
+
+class StructuredFormatter:
+    """
+    One line per event: logfmt style "key=value" pairs, or a JSON object when asJson is set.
+    """
+
+    def __init__(self, asJson=False):
+        self.asJson = asJson
+
+    def format(self, event):
+        fields = [("time", _timestamp(event.created)), ("level", event.levelname), ("logger", event.name),
+                  ("msg", event.getMessage())]
+        extra = event.fields
+        if extra:
+            for name in FIELDS:
+                value = extra.get(name)
+                if value is not None:
+                    if name == "latency":
+                        value = round(value * 1000, 3)
+                        name = "latency_ms"
+                    elif name == "remote" and isinstance(value, tuple) and len(value) >= 2:
+                        value = "%s:%s" % value[:2]
+                    fields.append((name, value))
+            fields.extend((name, value) for name, value in extra.items() if name not in FIELDS)
+        if event.exc_info:
+            fields.append(("exc", "".join(traceback.format_exception(*event.exc_info)).rstrip()))
+        if self.asJson:
+            return json.dumps(dict(fields), default=str, ensure_ascii=False)
+        return " ".join("%s=%s" % (name, _quote(value)) for name, value in fields)
+
+class LogWriter:
+    """
+    Background thread writing queued events. Callers append to a bounded deque and wake
+    the thread; it formats what is waiting in batches, each written with one write() and
+    flush(), so a slow terminal or pipe only ever stalls this thread. Events arriving
+    while the queue is full are counted as dropped.
+    """
+
+    def __init__(self, stream=None, formatter=None, sampler=None, queueSize=LOG_QUEUE_SIZE):
+        self.stream = stream
+        self.formatter = formatter or StructuredFormatter()
+        self.sampler = sampler or RouteSampler()
+        self.queueSize = queueSize
+        self.dropped = 0
+        self.written = 0
+        self._events = deque()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="lapi-log-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, event):
+        if len(self._events) >= self.queueSize:
+            self.dropped += 1
+            return
+        self._events.append(event)
+        if not self._wake.is_set():
+            self._wake.set()
+
+    def _run(self):
+        events = self._events
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            while events:
+                self._write(events)
+            if self._stopping and not events:
+                return
+
+    def _write(self, events):
+        lines = []
+        while events and len(lines) < LOG_BATCH_SIZE:
+            event = events.popleft()
+            try:
+                lines.append(self.formatter.format(event))
+            except Exception as e:
+                lines.append("level=ERROR logger=lapi.log msg=%s" % _quote("Unformattable event %r: %s" % (event.msg, e)))
+        try:
+            stream = self.stream or sys.stdout
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+            self.written += len(lines)
+        except Exception:
+            self.dropped += len(lines)
+
+    def stop(self):
+        """
+        Write everything queued, then end the thread.
+        """
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+
+    def stats(self):
+        return {"queued": len(self._events), "written": self.written, "dropped": self.dropped,
+                "sampled": self.sampler.total}
+
+_lock = threading.Lock()
+_writer = None
+_config = None
+
+def setupLogging(level=None, stream=None, asJson=None, sampling=None, rateLimits=None, queueSize=LOG_QUEUE_SIZE):
+    """
+    Send every "lapi" logger through one LogWriter. Defaults come from LAPI_LOG_LEVEL
+    (INFO), LAPI_LOG_FORMAT (text or json), LAPI_LOG_SAMPLE and LAPI_LOG_RATE, the last
+    two as "route=N,route=N". Calling it again replaces the configuration.
+    """
+    global _writer, _config
+    if level is None:
+        level = os.environ.get("LAPI_LOG_LEVEL", "INFO")
+    if asJson is None:
+        asJson = os.environ.get("LAPI_LOG_FORMAT", "text").lower() == "json"
+    if sampling is None:
+        sampling = _routeNumbers(os.environ.get("LAPI_LOG_SAMPLE", ""))
+    if rateLimits is None:
+        rateLimits = dict(DEFAULT_RATE_LIMITS, **_routeNumbers(os.environ.get("LAPI_LOG_RATE", "")))
+    with _lock:
+        shutdownLogging()
+        _config = dict(level=level, stream=stream, asJson=asJson, sampling=sampling, rateLimits=rateLimits,
+                       queueSize=queueSize)
+        logging.getLogger("lapi").setLevel(level.upper() if isinstance(level, str) else level)
+        _writer = LogWriter(stream, StructuredFormatter(asJson), RouteSampler(sampling, rateLimits), queueSize)
+        return _writer
+
+def shutdownLogging():
+    """
+    Stop the writer thread after it has written everything queued.
+    """
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+def getLogger(name):
+    """
+    StructuredLogger for "lapi.<name>". The writer thread starts with the first event.
+    """
+    root = logging.getLogger("lapi")
+    if root.level == logging.NOTSET:
+        root.setLevel(os.environ.get("LAPI_LOG_LEVEL", "INFO").upper())
+    return StructuredLogger(logging.getLogger("lapi." + name))
+
+def stats():
+    writer = _writer
+    return writer.stats() if writer is not None else {"queued": 0, "written": 0, "dropped": 0, "sampled": 0}
+
+def _start():
+    with _lock:
+        if _writer is not None:
+            return _writer
+    return setupLogging(**(_config or {}))
+
+def _routeNumbers(value):
+    numbers = {}
+    for item in value.split(","):
+        route, sep, number = item.rpartition("=")
+        if sep and route.strip():
+            numbers[route.strip()] = float(number) if "." in number else int(number)
+    return numbers
+
+def _timestamp(created):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(created)) + ".%03d" % (created % 1 * 1000)
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return text
+
+def _afterForkInChild():
+    # The writer thread does not survive fork(), a worker process starts its own on first use
+    global _lock, _writer
+    _lock = threading.Lock()
+    _writer = None
+
+atexit.register(shutdownLogging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_afterForkInChild)
@@ -0,0 +1,75 @@
+# LAPI WebSocket message types. Plain __slots__ classes: no per-instance __dict__,
+# and unknown fields in a device's JSON are ignored instead of raising TypeError.
+
+class KeepAliveRspAO:
+    __slots__ = ("Timestamp", "Timeout")
+
+    def __init__(self, Timestamp=0, Timeout=0):
+        self.Timestamp = Timestamp
+        self.Timeout = Timeout
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d.get("Timestamp", 0), d.get("Timeout", 0))
+
+    def toDict(self):
+        return {"Timestamp": self.Timestamp, "Timeout": self.Timeout}
+
+    def __repr__(self):
+        return "KeepAliveRspAO(Timestamp=%r, Timeout=%r)" % (self.Timestamp, self.Timeout)
+
+class WebsocketReq:
+    __slots__ = ("RequestURL", "Method", "Cseq", "Data")
+
+    def __init__(self, RequestURL="", Method=None, Cseq=None, Data=None):
+        self.RequestURL = RequestURL
+        self.Method = Method
+        self.Cseq = Cseq
+        self.Data = Data
+
+    @classmethod
+    def fromDict(cls, d):
+        # Devices and server variants disagree on the casing of the URL key
+        url = d.get("RequestURL")
+        if url is None:
+            url = d.get("requestURL", "")
+        return cls(url, d.get("Method"), d.get("Cseq"), d.get("Data"))
+
+    def toDict(self):
+        return {"RequestURL": self.RequestURL, "Method": self.Method, "Cseq": self.Cseq, "Data": self.Data}
+
+    def getRequestURL(self):
+        return self.RequestURL
+
+    def __repr__(self):
+        return "WebsocketReq(RequestURL=%r, Method=%r, Cseq=%r, Data=%r)" % (
+            self.RequestURL, self.Method, self.Cseq, self.Data)
+
+class WebsocketRsp:
+    __slots__ = ("ResponseURL", "ResponseCode", "ResponseString", "Cseq", "Data")
+
+    def __init__(self, ResponseURL="", ResponseCode=0, ResponseString="", Cseq=None, Data=None):
+        self.ResponseURL = ResponseURL
+        self.ResponseCode = ResponseCode
+        self.ResponseString = ResponseString
+        self.Cseq = Cseq
+        self.Data = Data
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d.get("ResponseURL", ""), d.get("ResponseCode", 0), d.get("ResponseString", ""),
+                   d.get("Cseq"), d.get("Data"))
+
+    def toDict(self):
+        data = self.Data
+        return {
+            "ResponseURL": self.ResponseURL,
+            "ResponseCode": self.ResponseCode,
+            "ResponseString": self.ResponseString,
+            "Cseq": self.Cseq,
+            "Data": data.toDict() if hasattr(data, "toDict") else data,
+        }
+
+    def __repr__(self):
+        return "WebsocketRsp(ResponseURL=%r, ResponseCode=%r, ResponseString=%r, Cseq=%r, Data=%r)" % (
+            self.ResponseURL, self.ResponseCode, self.ResponseString, self.Cseq, self.Data)
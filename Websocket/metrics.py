@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import math
+import os
+import threading
+
+from Websocket.log import getLogger
+
+log = getLogger("metrics")
+
+# Seconds, from a cached heartbeat reply to a Register stuck behind a storm
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Admin listener for GET /metrics, worker N of a WorkerGroup listens on port + N; 0 disables it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_getIdent = threading.get_ident
+
+class _Metric:
+    """
+    Base of every metric: a name, help text and, with labelnames, children per label values.
+
+    Recording is lock-free: every thread writes its own cell, a small list only that thread
+    ever mutates, and a scrape sums the cells. The lock is only taken the first time a
+    thread records to a metric, and when a new label combination appears.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help="", labelnames=(), labelvalues=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = tuple(labelvalues)
+        self._lock = threading.Lock()
+        self._cells = {}     # thread ident -> cell
+        self._children = {}  # label values -> child metric
+
+    def labels(self, *values):
+        """
+        Child for one combination of label values. Look children up once and keep them,
+        values seen by a metric are never forgotten, so keep their number bounded.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s expects labels %s" % (self.name, self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child(tuple(str(value) for value in values))
+        return child
+
+    def _child(self, labelvalues):
+        return type(self)(self.name, self.help, (), labelvalues)
+
+    def _cell(self):
+        cell = self._cells.get(_getIdent())
+        if cell is None:
+            with self._lock:
+                cell = self._cells[_getIdent()] = self._newCell()
+        return cell
+
+    def _newCell(self):
+        return [0]
+
+    def _series(self):
+        """
+        (labelvalues, metric) for every series to export.
+        """
+        if self.labelnames:
+            return sorted(self._children.items())
+        return [(self.labelvalues, self)]
+
+    def samples(self):
+        """
+        (suffix, labels, value) of every sample, labels a list of (name, value).
+        """
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        cell = self._cells.get(_getIdent())
+        if cell is None:
+            cell = self._cell()
+        cell[0] += amount
+
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells.values()))
+
+    def samples(self):
+        for labelvalues, metric in self._series():
+            yield "_total", list(zip(self.labelnames, labelvalues)), metric.value()
+
+class Gauge(_Metric):
+    """
+    Gauge moved with inc()/dec() from any thread, or read from function at scrape time.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help="", labelnames=(), labelvalues=(), function=None):
+        super().__init__(name, help, labelnames, labelvalues)
+        self.function = function
+        self._offset = 0
+
+    def inc(self, amount=1):
+        cell = self._cells.get(_getIdent())
+        if cell is None:
+            cell = self._cell()
+        cell[0] += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._offset = value - sum(cell[0] for cell in self._cells.values())
+
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._offset + sum(cell[0] for cell in list(self._cells.values()))
+
+    def samples(self):
+        for labelvalues, metric in self._series():
+            yield "", list(zip(self.labelnames, labelvalues)), metric.value()
+
+class CounterFunction(Counter):
+    """
+    Counter whose total is kept elsewhere, e.g. a pool's completed task count.
+    """
+
+    def __init__(self, name, help="", function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def value(self):
+        return self.function()
+
+class Histogram(_Metric):
+    """
+    Fixed-bucket histogram. observe() is a bisect over the upper bounds and two in-place
+    additions to the calling thread's cell [bucket counts..., +Inf count, sum].
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help="", labelnames=(), labelvalues=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames, labelvalues)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self, labelvalues):
+        return type(self)(self.name, self.help, (), labelvalues, self.buckets)
+
+    def _newCell(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cells.get(_getIdent())
+        if cell is None:
+            cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """
+        (cumulative counts per bucket including +Inf, sum)
+        """
+        totals = [0] * (len(self.buckets) + 2)
+        for cell in list(self._cells.values()):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        cumulative, running = [], 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-1]
+
+    def samples(self):
+        for labelvalues, metric in self._series():
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative, total = metric.snapshot()
+            for bound, count in zip(self.buckets + (math.inf,), cumulative):
+                yield "_bucket", labels + [("le", _formatValue(bound))], count
+            yield "_count", labels, cumulative[-1]
+            yield "_sum", labels, total
+
+class MetricsRegistry:
+    """
+    Named metrics of this process, rendered in the Prometheus text format. Asking for a
+    name again returns the metric already registered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, help="", labelnames=()):
+        return self._register(name, Counter, help=help, labelnames=labelnames)
+
+    def gauge(self, name, help="", labelnames=(), function=None):
+        return self._register(name, Gauge, help=help, labelnames=labelnames, function=function)
+
+    def counterFunction(self, name, help="", function=None):
+        return self._register(name, CounterFunction, help=help, function=function)
+
+    def histogram(self, name, help="", labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(name, Histogram, help=help, labelnames=labelnames, buckets=buckets)
+
+    def _register(self, name, cls, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError("%s is already registered as a %s" % (name, metric.kind))
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        for name, metric in metrics:
+            lines.append("# HELP %s %s" % (name, metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (name, metric.kind))
+            try:
+                for suffix, labels, value in metric.samples():
+                    lines.append("%s%s%s %s" % (name, suffix, _formatLabels(labels), _formatValue(value)))
+            except Exception as e:
+                log.error("Metric %s failed to render: %s", name, e)
+        return "\n".join(lines) + "\n"
+
+# Process-wide registry every module records to
+REGISTRY = MetricsRegistry()
+# Further plain text pages of the admin listener, path -> function returning the page
+ADMIN_PAGES = {}
+
+class MetricsServer:
+    """
+    Minimal HTTP/1.1 admin listener on the server's own event loop: GET /metrics answers
+    with REGISTRY in the Prometheus text format, the paths of ADMIN_PAGES with their
+    page, anything else gets a 404. Rendering runs on the loop, it is a walk over a few
+    dozen series.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or REGISTRY
+        self.server = None
+
+    async def start(self, host=None, port=None):
+        host, port = metricsAddress(host, port)
+        if not port:
+            return None
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            # Metrics are optional, a taken admin port must not keep the devices out
+            log.warning("Metrics listener on %s:%s failed to start: %s", host, port, e)
+            return None
+        log.info("Metrics available on http://%s:%s/metrics", host, port)
+        return self.server
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, _, rest = request.partition(b" ")
+            path = rest.partition(b" ")[0].partition(b"?")[0].decode("latin-1")
+            page = ADMIN_PAGES.get(path)
+            if method in (b"GET", b"HEAD") and path == "/metrics":
+                body = self.registry.render().encode("utf-8")
+                status = b"200 OK"
+                contentType = CONTENT_TYPE.encode("ascii")
+            elif method in (b"GET", b"HEAD") and page is not None:
+                body, status, contentType = page().encode("utf-8"), b"200 OK", b"text/plain; charset=utf-8"
+            else:
+                body, status, contentType = b"Not Found\n", b"404 Not Found", b"text/plain"
+            writer.write(b"HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                         % (status, contentType, len(body)))
+            if method != b"HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+def metricsAddress(host=None, port=None):
+    """
+    (host, port) of the admin listener from LAPI_METRICS_HOST and LAPI_METRICS_PORT, the
+    port shifted by LAPI_WORKER_INDEX so every worker process is scraped on its own.
+    """
+    host = host or os.environ.get("LAPI_METRICS_HOST", METRICS_HOST)
+    if port is None:
+        port = int(os.environ.get("LAPI_METRICS_PORT", METRICS_PORT))
+    if port:
+        port += int(os.environ.get("LAPI_WORKER_INDEX", "0"))
+    return host, port
+
+async def startMetricsServer(host=None, port=None, registry=None):
+    """
+    Start the admin listener on the running loop. Returns the asyncio server, None when
+    disabled (LAPI_METRICS_PORT=0) or the port is taken.
+    """
+    return await MetricsServer(registry).start(host, port)
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for name, value in labels)
+
+def _formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,259 @@
+import os
+import secrets
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from Websocket.keyring import KeyRing
+
+# Seconds a Register challenge stays valid
+NONCE_TTL = 60
+# Outstanding challenges across all shards
+NONCE_CAPACITY = 65536
+NONCE_SHARDS = 16
+
+class _NonceShard:
+    """
+    One lock and one insertion-ordered dict of (deviceCode, ip, nonce) -> expiry.
+    Every entry gets the same TTL, so insertion order is expiry order and stale
+    challenges are dropped from the front in O(1) each.
+    """
+
+    __slots__ = ("lock", "entries", "capacity", "issued", "consumed", "rejected", "expired", "evicted")
+
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.capacity = capacity
+        self.issued = 0
+        self.consumed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def purge(self, now):
+        entries = self.entries
+        while entries:
+            key, expiresAt = next(iter(entries.items()))
+            if expiresAt > now:
+                break
+            del entries[key]
+            self.expired += 1
+
+class NonceStore:
+    """
+    Outstanding Register challenges, bounded and expiring.
+
+    A challenge is bound to the device's IP and, once known, its DeviceCode, so
+    cameras behind one NAT each keep their own nonce. The first Register carries no
+    DeviceCode; its nonce is stored under the IP alone and accepted from any
+    DeviceCode at that IP. Nonces are single use: consume() removes the entry.
+
+    Memory is capped at capacity entries, the oldest challenge is evicted when a shard
+    is full, so a reconnect storm cannot grow the store. Shards are chosen by IP and
+    each has its own lock, so issue/consume from several threads rarely contend.
+    """
+
+    def __init__(self, capacity=NONCE_CAPACITY, ttl=NONCE_TTL, shards=NONCE_SHARDS, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._shards = tuple(_NonceShard(max(capacity // shards, 1)) for _ in range(shards))
+
+    def _shard(self, ip):
+        return self._shards[hash(ip) % len(self._shards)]
+
+    def issue(self, ip, deviceCode="", nonce=None):
+        """
+        Challenge for ip (and deviceCode when known): a random nonce, or the one given,
+        remembered until it is consumed or expires.
+        """
+        if nonce is None:
+            nonce = secrets.token_hex(16)
+        self.add(ip, nonce, deviceCode)
+        return nonce
+
+    def add(self, ip, nonce, deviceCode=""):
+        """
+        Remember nonce for ip/deviceCode. False, and no change, if it is already held.
+        """
+        key = (deviceCode or "", ip, nonce)
+        shard = self._shard(ip)
+        with shard.lock:
+            now = self.clock()
+            shard.purge(now)
+            entries = shard.entries
+            if key in entries:
+                return False
+            entries[key] = now + self.ttl
+            while len(entries) > shard.capacity:
+                entries.popitem(last=False)
+                shard.evicted += 1
+            shard.issued += 1
+        return True
+
+    def consume(self, ip, nonce, deviceCode=""):
+        """
+        True if nonce is an unexpired challenge issued to this ip/deviceCode. The
+        challenge is used up either way a match is found; unknown nonces cost one lookup.
+        """
+        if not nonce:
+            return False
+        shard = self._shard(ip)
+        with shard.lock:
+            now = self.clock()
+            shard.purge(now)
+            entries = shard.entries
+            expiresAt = entries.pop((deviceCode or "", ip, nonce), None)
+            if expiresAt is None and deviceCode:
+                expiresAt = entries.pop(("", ip, nonce), None)
+            if expiresAt is None or expiresAt <= now:
+                shard.rejected += 1
+                return False
+            shard.consumed += 1
+            return True
+
+    def purge(self):
+        """
+        Drop expired challenges from every shard. issue() and consume() already purge
+        the shard they touch; this is for an idle periodic sweep.
+        """
+        now = self.clock()
+        for shard in self._shards:
+            with shard.lock:
+                shard.purge(now)
+
+    def stats(self):
+        totals = {"size": 0, "issued": 0, "consumed": 0, "rejected": 0, "expired": 0, "evicted": 0}
+        for shard in self._shards:
+            with shard.lock:
+                totals["size"] += len(shard.entries)
+                totals["issued"] += shard.issued
+                totals["consumed"] += shard.consumed
+                totals["rejected"] += shard.rejected
+                totals["expired"] += shard.expired
+                totals["evicted"] += shard.evicted
+        return totals
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+class StatelessNonceStore:
+    """
+    Register challenges that carry their own proof, so any worker or node can check them.
+
+    A nonce is hex of key id (1 byte) | issue time (4) | random (8) | MAC (12), the MAC being
+    HMAC-SHA256 under a server key over the other fields and the device's IP. Checking it
+    needs only the key: the MAC proves this server (or a peer sharing LAPI_NONCE_KEY) issued
+    it to that IP, the embedded time proves it is fresh. No challenge state is kept, so a
+    device may be challenged by one process and register on another without sticky routing.
+    getNonceStore() picks it whenever several workers share the port; nodes behind one load
+    balancer select it with LAPI_NONCE_MODE=stateless and share LAPI_NONCE_KEY.
+
+    keys: a KeyRing, or a list with the signing key first and older keys after it that
+    are still accepted, so nodes rotate without failing challenges already in flight.
+    By default the ring is read from LAPI_NONCE_KEY (comma separated hex, newest first).
+
+    Freshness alone cannot make a nonce single use. A small per-process NonceStore
+    (replayCache) remembers nonces consumed here until they expire; a nonce replayed to a
+    different node within its TTL is still accepted, which the Sign covering it makes
+    useless to anyone who cannot also compute the device's signature.
+    """
+
+    _HEADER = struct.Struct(">BI8s")
+    _MAC_SIZE = 12
+    SIZE = _HEADER.size + _MAC_SIZE
+
+    def __init__(self, keys=None, ttl=NONCE_TTL, skew=5, replayCache=True, clock=time.time):
+        self.keyRing = keys if isinstance(keys, KeyRing) else KeyRing(keys, environ="LAPI_NONCE_KEY")
+        self.ttl = ttl
+        self.skew = skew
+        self.clock = clock
+        self._replay = NonceStore(ttl=ttl + skew) if replayCache else None
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._consumed = 0
+        self._rejected = 0
+
+    def issue(self, ip, deviceCode="", nonce=None):
+        """
+        Fresh signed challenge for ip. deviceCode is accepted for interface parity with
+        NonceStore; it is unknown at the first Register, so the nonce binds the IP only.
+        """
+        keyRing = self.keyRing
+        signingId, signingKey = keyRing.signer()
+        header = self._HEADER.pack(signingId, int(self.clock()), secrets.token_bytes(8))
+        with self._lock:
+            self._issued += 1
+        return (header + keyRing.mac(signingKey, header + str(ip).encode("utf-8"), self._MAC_SIZE)).hex()
+
+    def consume(self, ip, nonce, deviceCode=""):
+        """
+        True if nonce was issued to ip by a holder of one of the keys, within ttl, and
+        has not been consumed by this process before.
+        """
+        if self._verify(ip, nonce) and (self._replay is None or self._replay.add(ip, nonce)):
+            with self._lock:
+                self._consumed += 1
+            return True
+        with self._lock:
+            self._rejected += 1
+        return False
+
+    def _verify(self, ip, nonce):
+        if not nonce or len(nonce) != 2 * self.SIZE:
+            return False
+        try:
+            raw = bytes.fromhex(nonce)
+        except ValueError:
+            return False
+        header, mac = raw[:self._HEADER.size], raw[self._HEADER.size:]
+        keyId, issuedAt, _ = self._HEADER.unpack(header)
+        if not self.keyRing.verify(keyId, header + str(ip).encode("utf-8"), mac):
+            return False
+        age = self.clock() - issuedAt
+        return -self.skew <= age <= self.ttl
+
+    def purge(self):
+        if self._replay is not None:
+            self._replay.purge()
+
+    def stats(self):
+        with self._lock:
+            totals = {"size": 0, "issued": self._issued, "consumed": self._consumed,
+                      "rejected": self._rejected, "expired": 0, "evicted": 0}
+        if self._replay is not None:
+            replay = self._replay.stats()
+            totals["size"] = replay["size"]
+            totals["expired"] = replay["expired"]
+            totals["evicted"] = replay["evicted"]
+        return totals
+
+    def __len__(self):
+        return len(self._replay) if self._replay is not None else 0
+
+NONCE_STORES = {"store": NonceStore, "stateless": StatelessNonceStore}
+
+def getNonceStore(mode=None, workers=None, **options):
+    """
+    Challenge store by mode, else the one named by LAPI_NONCE_MODE, else "stateless"
+    when several workers (workers, else LAPI_WORKERS) share the port and "store" for one.
+    "store" keeps each challenge in this process, "stateless" lets any process holding
+    the same LAPI_NONCE_KEY verify it. "store" is refused with more than one worker: a
+    device's challenge and its signed Register land on whichever worker accepts them.
+    """
+    workers = workers or int(os.environ.get("LAPI_WORKERS") or 1)
+    mode = mode or os.environ.get("LAPI_NONCE_MODE") or ("stateless" if workers > 1 else "store")
+    if mode not in NONCE_STORES:
+        raise ValueError("Nonce mode %r is not supported, choose from: %s" % (mode, ", ".join(NONCE_STORES)))
+    if mode == "store" and workers > 1:
+        raise ValueError("Nonce mode 'store' keeps challenges in one process, %d workers need 'stateless'" % workers)
+    return NONCE_STORES[mode](**options)
+
+def remoteHost(address):
+    """
+    Host part of a peer address, challenges must survive the device reconnecting from a new port.
+    """
+    if isinstance(address, (tuple, list)) and address:
+        return address[0]
+    return address
@@ -0,0 +1,117 @@
+import asyncio
+import os
+from collections import deque
+
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY
+
+log = getLogger("outbound")
+
+# Bytes a connection may have waiting to go out (LAPI_OUTBOUND_HIGH_WATER), and what
+# happens to one over it (LAPI_OUTBOUND_POLICY): "close" evicts the connection, "drop"
+# keeps it and discards new frames until it is back under the low-water mark
+OUTBOUND_HIGH_WATER = 256 * 1024
+OUTBOUND_POLICY = "close"
+OUTBOUND_POLICIES = ("close", "drop")
+
+outboundWrites = REGISTRY.counter("lapi_outbound_writes", "Transport writes of queued outbound frames")
+outboundFrames = REGISTRY.counter("lapi_outbound_frames", "Outbound frames written")
+outboundDropped = REGISTRY.counter("lapi_outbound_dropped_frames", "Frames dropped for connections over the high-water mark")
+outboundEvictions = REGISTRY.counter("lapi_outbound_evictions", "Connections closed for not keeping up with their output")
+
+def outboundLimits(highWater=None, policy=None):
+    """
+    (highWater, lowWater, policy) from the arguments, else LAPI_OUTBOUND_HIGH_WATER and
+    LAPI_OUTBOUND_POLICY. The low-water mark is a quarter of the high one.
+    """
+    if highWater is None:
+        highWater = int(os.environ.get("LAPI_OUTBOUND_HIGH_WATER", OUTBOUND_HIGH_WATER))
+    policy = policy or os.environ.get("LAPI_OUTBOUND_POLICY") or OUTBOUND_POLICY
+    if policy not in OUTBOUND_POLICIES:
+        raise ValueError("Outbound policy %r is not supported, choose from: %s" % (policy, ", ".join(OUTBOUND_POLICIES)))
+    return highWater, highWater // 4, policy
+
+class OutboundQueue:
+    """
+    Bounded outbound queue of one connection, drained by its own writer task.
+
+    put() never waits: a frame is appended and the writer woken. The writer takes every
+    frame queued since its last write and hands them to send() as one list, which the
+    backend puts on the wire in a single transport write (as SocketChannel's writelines)
+    before waiting for the transport to drain, so one slow device holds at most highWater
+    bytes here plus the library's own write buffer. A frame is always queued behind an
+    empty queue; past highWater the policy applies: "close" calls onEvict() once, "drop"
+    discards frames until the queue is under the low-water mark again.
+    """
+
+    __slots__ = ("send", "onEvict", "highWater", "lowWater", "policy", "frames", "size", "dropping", "closed",
+                 "_ready", "_task")
+
+    def __init__(self, send, onEvict, highWater=None, policy=None):
+        self.send = send
+        self.onEvict = onEvict
+        self.highWater, self.lowWater, self.policy = outboundLimits(highWater, policy)
+        self.frames = deque()
+        self.size = 0
+        self.dropping = False
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def put(self, frame):
+        """
+        Queue a frame (str or UTF-8 bytes of a text frame). False when it was not queued.
+        """
+        if self.closed:
+            return False
+        size = len(frame)
+        if self.dropping:
+            if self.size > self.lowWater:
+                outboundDropped.inc()
+                return False
+            self.dropping = False
+        # Only bytes already waiting count against the connection, one large reply is not a backlog
+        if self.frames and self.size + size > self.highWater:
+            if self.policy == "drop":
+                self.dropping = True
+                outboundDropped.inc()
+                return False
+            outboundEvictions.inc()
+            log.warning("Outbound queue over %d bytes, closing the connection", self.highWater)
+            self.close()
+            self.onEvict()
+            return False
+        self.frames.append(frame)
+        self.size += size
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        frames = self.frames
+        while not self.closed:
+            await self._ready.wait()
+            self._ready.clear()
+            if not frames:
+                continue
+            batch = list(frames)
+            frames.clear()
+            self.size = 0
+            outboundWrites.inc()
+            outboundFrames.inc(len(batch))
+            try:
+                await self.send(batch)
+            except Exception:
+                # The connection is gone, its handler sees that on its next read
+                self.close()
+
+    def close(self):
+        """
+        Stop the writer and forget queued frames.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        self.size = 0
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
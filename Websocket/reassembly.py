@@ -0,0 +1,80 @@
+import os
+
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY
+
+log = getLogger("reassembly")
+
+# Largest message a device may send, compressed or not (LAPI_MAX_MESSAGE_SIZE)
+MAX_MESSAGE_SIZE = int(os.environ.get("LAPI_MAX_MESSAGE_SIZE", 65535 * 100))
+# Bytes all connections of a process may hold in partly received messages (LAPI_REASSEMBLY_BUDGET)
+REASSEMBLY_BUDGET = int(os.environ.get("LAPI_REASSEMBLY_BUDGET", 64 * 1024 * 1024))
+# Close codes (RFC 6455 7.4.1 and the IANA registry)
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_TRY_AGAIN_LATER = 1013
+
+messagesRejected = REGISTRY.counter("lapi_messages_rejected", "Messages refused while being received", ("reason",))
+messagesStreamed = REGISTRY.counter("lapi_messages_streamed", "Messages handed to a stream route chunk by chunk")
+
+class ReassemblyBudget:
+    """
+    Bytes of partly received messages held by every connection of this process.
+
+    A message arriving in pieces is only joined while the whole process stays under
+    limit, so a burst of devices uploading large messages at once costs at most limit
+    bytes of RSS instead of their sum. Used from the event loop thread only.
+    """
+
+    __slots__ = ("limit", "used")
+
+    def __init__(self, limit=REASSEMBLY_BUDGET):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size):
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size):
+        self.used -= size
+
+# Shared by every connection of the process
+REASSEMBLY = ReassemblyBudget()
+REGISTRY.gauge("lapi_reassembly_bytes", "Bytes held in partly received messages", function=lambda: REASSEMBLY.used)
+
+class MessageBuffer:
+    """
+    Joins the chunks of one message for a route that takes it whole, then hands it to
+    LapiEngine.frame(). feed() returns False once the process reassembly budget is
+    spent, the connection is then closed with CLOSE_TRY_AGAIN_LATER.
+    """
+
+    __slots__ = ("engine", "connection", "deviceCode", "buffer", "budget")
+
+    def __init__(self, engine, connection, deviceCode, budget=REASSEMBLY):
+        self.engine = engine
+        self.connection = connection
+        self.deviceCode = deviceCode
+        self.buffer = bytearray()
+        self.budget = budget
+
+    def feed(self, chunk):
+        if not self.budget.reserve(len(chunk)):
+            messagesRejected.labels("budget").inc()
+            log.warning("Reassembly budget of %d bytes spent, refusing a message", self.budget.limit,
+                        device=self.deviceCode)
+            self.abort()
+            return False
+        self.buffer += chunk
+        return True
+
+    def finish(self):
+        message = bytes(self.buffer)
+        self.abort()
+        return self.engine.frame(self.connection, self.deviceCode, message)
+
+    def abort(self):
+        self.budget.release(len(self.buffer))
+        self.buffer = bytearray()
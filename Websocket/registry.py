@@ -0,0 +1,172 @@
+import threading
+
+from Websocket.nonce_store import remoteHost
+from Websocket.session import DeviceSession
+
+class DeviceRegistry:
+    """
+    Registered devices of this process by DeviceCode, with secondary indexes by Vendor,
+    DeviceType and remote IP.
+
+    Each device is one DeviceSession. add(), remove() and discard() are O(1): an index
+    maps a key to the single session holding it or, once shared, to a dict of sessions by
+    DeviceCode, so a session leaves each of its buckets with one pop. Most IPs have one
+    device and cost no dict of their own. Connections are indexed the same way, a
+    connection registering several DeviceCodes holds all of them until it is discarded.
+    A device that reconnects replaces its session;
+    remove() with the old connection is then a no-op, so a stale connection going away
+    does not drop the device's new one.
+
+    Queries return snapshots (tuples) taken under the lock, safe to iterate while devices
+    come and go from other tasks or threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}      # DeviceCode -> DeviceSession
+        self._byVendor = {}     # Vendor -> DeviceSession, or {DeviceCode: DeviceSession} when shared
+        self._byDeviceType = {}
+        self._byIp = {}
+        self._byConnection = {}  # connection -> DeviceSession, or {DeviceCode: DeviceSession} when shared
+        self._replaced = 0
+
+    def add(self, deviceCode, connection, vendor="", deviceType="", remoteAddress=None, handler=None, **metadata):
+        """
+        Register deviceCode on connection. Returns the previous session when the device was
+        already registered on another connection, else None, so the caller may close it.
+        """
+        entry = DeviceSession(deviceCode, connection, vendor, deviceType, remoteAddress, handler)
+        if metadata:
+            entry.metadata.update(metadata)
+        with self._lock:
+            previous = self._devices.get(deviceCode)
+            if previous is not None:
+                self._unindex(previous)
+                if previous.connection is not connection:
+                    self._replaced += 1
+            self._devices[deviceCode] = entry
+            _index(self._byConnection, connection, entry)
+            _index(self._byVendor, entry.vendor, entry)
+            _index(self._byDeviceType, entry.deviceType, entry)
+            _index(self._byIp, entry.ip, entry)
+        return previous if previous is not None and previous.connection is not connection else None
+
+    def remove(self, deviceCode, connection=None):
+        """
+        Drop deviceCode, only if it is still registered on connection when that is given.
+        Returns the removed session or None.
+        """
+        with self._lock:
+            entry = self._devices.get(deviceCode)
+            if entry is None or (connection is not None and entry.connection is not connection):
+                return None
+            del self._devices[deviceCode]
+            self._unindex(entry)
+        return entry
+
+    def discard(self, connection):
+        """
+        Drop every device registered on connection, for transports that only know the
+        connection when it closes. Returns the removed sessions, () when there were none.
+        """
+        with self._lock:
+            bucket = self._byConnection.get(connection)
+            if bucket is None:
+                return ()
+            entries = (bucket,) if type(bucket) is DeviceSession else tuple(bucket.values())
+            for entry in entries:
+                del self._devices[entry.deviceCode]
+                self._unindex(entry)
+        return entries
+
+    def get(self, deviceCode):
+        return self._devices.get(deviceCode)
+
+    def connection(self, deviceCode):
+        """
+        Connection of a registered device, None when it is not connected to this process.
+        """
+        entry = self._devices.get(deviceCode)
+        return entry.connection if entry is not None else None
+
+    def byConnection(self, connection):
+        """
+        Devices registered on connection, usually one.
+        """
+        return self._bucket(self._byConnection, connection)
+
+    def byVendor(self, vendor):
+        return self._bucket(self._byVendor, vendor)
+
+    def byDeviceType(self, deviceType):
+        return self._bucket(self._byDeviceType, deviceType)
+
+    def byIp(self, ip):
+        """
+        Devices connected from ip, e.g. every camera behind one NAT.
+        """
+        return self._bucket(self._byIp, remoteHost(ip))
+
+    def snapshot(self):
+        with self._lock:
+            return tuple(self._devices.values())
+
+    def vendors(self):
+        """
+        {Vendor: number of devices}
+        """
+        with self._lock:
+            return {vendor: _size(bucket) for vendor, bucket in self._byVendor.items()}
+
+    def stats(self):
+        with self._lock:
+            return {"devices": len(self._devices), "vendors": len(self._byVendor), "ips": len(self._byIp),
+                    "replaced": self._replaced}
+
+    def _bucket(self, index, key):
+        with self._lock:
+            bucket = index.get(key)
+            if bucket is None:
+                return ()
+            return (bucket,) if type(bucket) is DeviceSession else tuple(bucket.values())
+
+    def _unindex(self, entry):
+        _unindex(self._byConnection, entry.connection, entry.deviceCode)
+        _unindex(self._byVendor, entry.vendor, entry.deviceCode)
+        _unindex(self._byDeviceType, entry.deviceType, entry.deviceCode)
+        _unindex(self._byIp, entry.ip, entry.deviceCode)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, deviceCode):
+        return deviceCode in self._devices
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+def _index(index, key, entry):
+    bucket = index.get(key)
+    if bucket is None or (type(bucket) is DeviceSession and bucket.deviceCode == entry.deviceCode):
+        index[key] = entry
+    elif type(bucket) is DeviceSession:
+        index[key] = {bucket.deviceCode: bucket, entry.deviceCode: entry}
+    else:
+        bucket[entry.deviceCode] = entry
+
+def _unindex(index, key, deviceCode):
+    bucket = index.get(key)
+    if bucket is None:
+        return
+    if type(bucket) is DeviceSession:
+        if bucket.deviceCode == deviceCode:
+            del index[key]
+        return
+    bucket.pop(deviceCode, None)
+    if len(bucket) == 1:
+        index[key] = next(iter(bucket.values()))
+    elif not bucket:
+        del index[key]
+
+def _size(bucket):
+    return 1 if type(bucket) is DeviceSession else len(bucket)
@@ -0,0 +1,113 @@
+import base64
+import binascii
+import os
+import struct
+import threading
+import time
+
+from Websocket.keyring import KeyRing
+
+# Seconds a resumption ticket stays valid, LAPI_TICKET_LIFETIME overrides
+TICKET_LIFETIME = 24 * 3600
+
+class TicketClaims:
+    __slots__ = ("deviceCode", "vendor", "deviceType", "issuedAt", "expiresAt")
+
+    def __init__(self, deviceCode, vendor, deviceType, issuedAt, expiresAt):
+        self.deviceCode = deviceCode
+        self.vendor = vendor
+        self.deviceType = deviceType
+        self.issuedAt = issuedAt
+        self.expiresAt = expiresAt
+
+    def __repr__(self):
+        return "TicketClaims(deviceCode=%r, vendor=%r, deviceType=%r, expiresAt=%r)" % (
+            self.deviceCode, self.vendor, self.deviceType, self.expiresAt)
+
+class ResumptionTickets:
+    """
+    Signed, time-limited tickets that let a registered device skip the Nonce challenge.
+
+    A successful Register returns a Ticket next to Cnonce/Resign. On reconnect the device
+    sends Register?DeviceCode=...&Ticket=... and is upgraded in one round trip, getting a
+    fresh ticket back, instead of the 401 challenge plus signed second request.
+
+    A ticket is URL-safe base64 of version | key id | issued | expires | Vendor, DeviceType,
+    DeviceCode | HMAC-SHA256 tag (16 bytes), so any process holding the keys verifies it
+    with no session state. Keys come from LAPI_TICKET_KEY (comma separated hex, newest
+    first); rotate() switches the signing key while tickets signed with the previous ones
+    keep working until they expire.
+    """
+
+    VERSION = 1
+    _HEADER = struct.Struct(">BBII")
+    _MAC_SIZE = 16
+
+    def __init__(self, keys=None, lifetime=None, skew=5, clock=time.time):
+        self.keyRing = keys if isinstance(keys, KeyRing) else KeyRing(keys, environ="LAPI_TICKET_KEY")
+        if lifetime is None:
+            lifetime = int(os.environ.get("LAPI_TICKET_LIFETIME", TICKET_LIFETIME))
+        self.lifetime = lifetime
+        self.skew = skew
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._resumed = 0
+        self._rejected = 0
+
+    def issue(self, deviceCode, vendor="", deviceType=""):
+        keyRing = self.keyRing
+        signingId, signingKey = keyRing.signer()
+        now = int(self.clock())
+        body = self._HEADER.pack(self.VERSION, signingId, now, now + self.lifetime) + \
+            "\n".join((vendor or "", deviceType or "", deviceCode)).encode("utf-8")
+        with self._lock:
+            self._issued += 1
+        raw = body + keyRing.mac(signingKey, body, self._MAC_SIZE)
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+    def verify(self, ticket, deviceCode=None):
+        """
+        TicketClaims of a valid, unexpired ticket, else None. When deviceCode is given the
+        ticket must have been issued to that device.
+        """
+        claims = self._decode(ticket)
+        if claims is None or (deviceCode and claims.deviceCode != deviceCode):
+            with self._lock:
+                self._rejected += 1
+            return None
+        with self._lock:
+            self._resumed += 1
+        return claims
+
+    def _decode(self, ticket):
+        if not ticket:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(ticket + "=" * (-len(ticket) % 4))
+        except (binascii.Error, ValueError):
+            return None
+        if len(raw) < self._HEADER.size + self._MAC_SIZE:
+            return None
+        body, tag = raw[:-self._MAC_SIZE], raw[-self._MAC_SIZE:]
+        version, keyId, issuedAt, expiresAt = self._HEADER.unpack_from(body)
+        if version != self.VERSION or not self.keyRing.verify(keyId, body, tag):
+            return None
+        now = self.clock()
+        if now >= expiresAt or issuedAt > now + self.skew:
+            return None
+        try:
+            vendor, deviceType, deviceCode = body[self._HEADER.size:].decode("utf-8").split("\n")
+        except ValueError:
+            return None
+        return TicketClaims(deviceCode, vendor, deviceType, issuedAt, expiresAt)
+
+    def rotate(self, key=None):
+        """
+        Sign new tickets with key (random if None), older keys keep verifying.
+        """
+        return self.keyRing.rotate(key)
+
+    def stats(self):
+        with self._lock:
+            return {"issued": self._issued, "resumed": self._resumed, "rejected": self._rejected}
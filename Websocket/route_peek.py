@@ -0,0 +1,108 @@
+import re
+
+from Websocket.json_codec import DEFAULT_CODEC
+
+# The shape devices actually send: URL, optional Method, Cseq, optional empty Data.
+# The pattern is a complete JSON grammar for that shape: JSON whitespace only, strings
+# without escapes or control characters, an integer Cseq without leading zeros. A full
+# match proves the frame is well formed with unique top-level keys in one regex call.
+# ~ stands for JSON whitespace and @ for a string body in the template below.
+_CANONICAL = (r'~\{~"[Rr]equestURL"~:~"(@)"~,~(?:"Method"~:~"@"~,~)?"Cseq"~:~(-?(?:0|[1-9][0-9]*))~'
+              r'(?:,~"Data"~:~(?:\{~\}|null)~)?\}~')
+# Strings hold no quote, backslash or control character, and in a bytes frame only
+# ASCII: anything else (escapes, UTF-8 that may be invalid) takes the full decode
+_TEXT_STRING = r'[^"\\\x00-\x1f]*'
+_BYTES_STRING = r'[^"\\\x00-\x1f\x80-\xff]*'
+# A top-level "RequestURL"/"requestURL" with a plain (escape-free) string value
+_URL = r'"[Rr]equestURL"\s*:\s*"([^"\\]*)"'
+
+def _canonical(string):
+    return _CANONICAL.replace("~", r"[ \t\n\r]*").replace("@", string)
+
+_BYTES = (re.compile(_canonical(_BYTES_STRING).encode("ascii")), re.compile(_URL.encode("ascii")))
+_TEXT = (re.compile(_canonical(_TEXT_STRING)), re.compile(_URL))
+
+def peekRoute(frame):
+    """
+    (requestURL, cseq) read straight from the raw frame without building a dict, or
+    None for any frame that is not the canonical heartbeat shape, which then gets the
+    full JSON decode (and its JSONDecodeError when malformed).
+    """
+    match = (_TEXT if isinstance(frame, str) else _BYTES)[0].fullmatch(frame)
+    if match is None:
+        return None
+    requestURL, cseq = match.groups()
+    if not isinstance(requestURL, str):
+        requestURL = requestURL.decode("ascii")
+    return requestURL, int(cseq)
+
+def peekPrefixURL(prefix):
+    """
+    RequestURL of a message from its first chunk, None unless the chunk already holds it
+    as a top-level key. Only used to pick a stream route, the rest is not seen yet.
+    """
+    match = _BYTES[1].search(prefix)
+    if match is None or not _topLevel(prefix, match.start(), b"{", b"}"):
+        return None
+    try:
+        return match.group(1).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+def _topLevel(frame, position, openBrace, closeBrace):
+    # Only the outer object has been opened before the key. Braces inside earlier
+    # string values also fail this check, which just means a full parse.
+    return frame.count(openBrace, 0, position) == 1 and frame.count(closeBrace, 0, position) == 0
+
+class LazyWebsocketReq:
+    """
+    WebsocketReq look-alike built from a peeked frame. RequestURL and Cseq are known
+    up front; Method and Data decode the frame on first access.
+    """
+
+    __slots__ = ("RequestURL", "Cseq", "_frame", "_codec", "_decoded")
+
+    def __init__(self, RequestURL, Cseq, frame, codec=DEFAULT_CODEC):
+        self.RequestURL = RequestURL
+        self.Cseq = Cseq
+        self._frame = frame
+        self._codec = codec
+        self._decoded = None
+
+    def _request(self):
+        if self._decoded is None:
+            self._decoded = self._codec.decodeRequest(self._frame)
+        return self._decoded
+
+    @property
+    def Method(self):
+        return self._request().Method
+
+    @property
+    def Data(self):
+        return self._request().Data
+
+    def isDecoded(self):
+        return self._decoded is not None
+
+    def toDict(self):
+        return self._request().toDict()
+
+    def getRequestURL(self):
+        return self.RequestURL
+
+    def __repr__(self):
+        return "LazyWebsocketReq(RequestURL=%r, Cseq=%r)" % (self.RequestURL, self.Cseq)
+
+def peekRequest(frame, codec=DEFAULT_CODEC):
+    """
+    Route-ready request for a text frame: a LazyWebsocketReq when the URL and Cseq
+    can be peeked, otherwise a fully decoded WebsocketReq. Codecs whose decoder
+    beats the peek (peekRoutes = False) always decode.
+    """
+    if not codec.peekRoutes:
+        return codec.decodeRequest(frame)
+    peeked = peekRoute(frame)
+    if peeked is None:
+        return codec.decodeRequest(frame)
+    return LazyWebsocketReq(peeked[0], peeked[1], frame, codec)
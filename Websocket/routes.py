@@ -0,0 +1,123 @@
+from urllib.parse import parse_qs
+
+class Route:
+    """
+    One LAPI endpoint: its path, the handler object called for it and the methods it accepts
+    (None accepts any method, which keeps frame routing from decoding a lazy request's Method).
+    compress=False sends the route's replies uncompressed on permessage-deflate connections.
+    A stream=True frame route gets the message as chunks instead of one joined frame.
+    """
+
+    __slots__ = ("path", "handler", "methods", "name", "compress", "stream")
+
+    def __init__(self, path, handler, methods=None, name=None, compress=True, stream=False):
+        self.path = path
+        self.handler = handler
+        self.methods = frozenset(method.upper() for method in methods) if methods is not None else None
+        self.name = name or getattr(handler, "__name__", path)
+        self.compress = compress
+        self.stream = stream
+
+    def allows(self, method):
+        return self.methods is None or (method or "").upper() in self.methods
+
+    def allowHeader(self):
+        """
+        Value for the Allow header of a 405 response.
+        """
+        return ", ".join(sorted(self.methods)) if self.methods is not None else ""
+
+    def __repr__(self):
+        return "Route(path=%r, name=%r, methods=%r)" % (self.path, self.name, self.methods)
+
+class RouteMatch:
+    __slots__ = ("route", "path", "query", "_parameters")
+
+    def __init__(self, route, path, query):
+        self.route = route
+        self.path = path
+        self.query = query
+        self._parameters = None
+
+    @property
+    def handler(self):
+        return self.route.handler
+
+    def allows(self, method):
+        return self.route.allows(method)
+
+    def parameters(self):
+        """
+        Query string as {name: [values]}, parsed on first use.
+        """
+        if self._parameters is None:
+            self._parameters = parse_qs(self.query) if self.query else {}
+        return self._parameters
+
+    def __repr__(self):
+        return "RouteMatch(route=%r, query=%r)" % (self.route, self.query)
+
+class RouteTable:
+    """
+    LAPI routes compiled into a dict keyed by exact path.
+
+    A lookup is one split of the query string plus one dict probe, however many
+    endpoints are registered, for both the HTTP handshake URI and the RequestURL of
+    every text frame. Handlers can be registered with add() or the route() decorator,
+    which leaves the function unchanged so it can sit in a class body:
+
+        routes = RouteTable()
+
+        @routes.route(LAPI_REGISTER, methods=("GET",))
+        def handleRegister(self, ctx, req, match): ...
+    """
+
+    def __init__(self):
+        self._routes = {}
+
+    def add(self, path, handler, methods=None, name=None, compress=True, stream=False):
+        if path in self._routes:
+            raise ValueError("Route %s is already registered to %s" % (path, self._routes[path].name))
+        route = self._routes[path] = Route(path, handler, methods, name, compress, stream)
+        return route
+
+    def route(self, path, methods=None, name=None, compress=True, stream=False):
+        def register(handler):
+            self.add(path, handler, methods, name, compress, stream)
+            return handler
+        return register
+
+    def get(self, path):
+        """
+        Route registered for exactly this path, or None.
+        """
+        return self._routes.get(path)
+
+    def match(self, uri):
+        """
+        RouteMatch for a request URI or frame RequestURL, None when no route has its path.
+        Method checks are left to the caller through RouteMatch.allows().
+        """
+        if not uri:
+            return None
+        route = self._routes.get(uri)
+        if route is not None:
+            return RouteMatch(route, uri, "")
+        path, _, query = uri.partition("?")
+        path = path.partition("#")[0]
+        route = self._routes.get(path)
+        if route is None:
+            return None
+        return RouteMatch(route, path, query.partition("#")[0])
+
+    def paths(self):
+        return list(self._routes)
+
+    def __contains__(self, path):
+        return path in self._routes
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __iter__(self):
+        return iter(self._routes.values())
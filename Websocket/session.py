@@ -0,0 +1,54 @@
+import sys
+import time
+
+from Websocket.nonce_store import remoteHost
+
+def intern(value):
+    """
+    One shared copy of a low-cardinality string (Vendor, DeviceType), "" for None.
+    """
+    return sys.intern(value) if value else ""
+
+class DeviceSession:
+    """
+    Everything kept per registered device, in one slotted object.
+
+    Vendor and DeviceType repeat across the fleet and are interned, so 50k cameras of
+    a handful of models share a handful of strings. The remote address is kept as the
+    IP and an int port rather than a tuple, timestamps are whole seconds, and
+    the metadata dict is only created for the devices that use it.
+    """
+
+    __slots__ = ("deviceCode", "vendor", "deviceType", "ip", "port", "connection", "handler",
+                 "registeredAt", "_metadata")
+
+    def __init__(self, deviceCode, connection, vendor="", deviceType="", remoteAddress=None, handler=None,
+                 registeredAt=None):
+        self.deviceCode = deviceCode
+        self.vendor = intern(vendor)
+        self.deviceType = intern(deviceType)
+        # Shared with the transport's peername, interning mostly unique IPs would only cost memory
+        self.ip = remoteHost(remoteAddress)
+        self.port = remoteAddress[1] if isinstance(remoteAddress, (tuple, list)) and len(remoteAddress) > 1 else 0
+        self.connection = connection
+        # The connection's handler instance, holding its protocol state
+        self.handler = handler
+        self.registeredAt = int(time.time()) if registeredAt is None else int(registeredAt)
+        self._metadata = None
+
+    @property
+    def remoteAddress(self):
+        return (self.ip, self.port) if self.ip is not None else None
+
+    @property
+    def metadata(self):
+        """
+        Free-form per-device data for callers, created on first use.
+        """
+        if self._metadata is None:
+            self._metadata = {}
+        return self._metadata
+
+    def __repr__(self):
+        return "DeviceSession(deviceCode=%r, vendor=%r, deviceType=%r, remoteAddress=%r)" % (
+            self.deviceCode, self.vendor, self.deviceType, self.remoteAddress)
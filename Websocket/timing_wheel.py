@@ -0,0 +1,108 @@
+import time
+
+# One scheduled deadline; the slot dict it lives in is kept so cancel/reschedule is O(1)
+class TimerTask:
+    __slots__ = ("key", "deadlineTick", "callback", "slot")
+
+    def __init__(self, key, deadlineTick, callback):
+        self.key = key
+        self.deadlineTick = deadlineTick
+        self.callback = callback
+        self.slot = None
+
+class HierarchicalTimingWheel:
+    """
+    Hierarchical timing wheel (Varghese & Lauck) keyed by an arbitrary hashable key.
+
+    Level 0 has wheelSize slots of tickDuration seconds, every higher level covers
+    wheelSize slots of the level below. schedule/cancel are O(1), advance costs one
+    slot visit per elapsed tick plus the cascade of timers moving down a level.
+    Timers further out than the top level are parked in its slots and re-placed on cascade.
+    """
+
+    def __init__(self, tickDuration=1.0, wheelSize=64, levels=4, clock=time.monotonic):
+        if tickDuration <= 0 or wheelSize < 2 or levels < 1:
+            raise ValueError("Invalid timing wheel geometry")
+        self.tickDuration = tickDuration
+        self.wheelSize = wheelSize
+        self.levels = levels
+        self.clock = clock
+        self._spans = [wheelSize ** level for level in range(levels)]
+        self._wheels = [[{} for _ in range(wheelSize)] for _ in range(levels)]
+        self._timers = {}
+        self._currentTick = int(clock() / tickDuration)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, delay, callback):
+        """
+        Fire callback(key) after delay seconds, replacing any timer already set for key.
+        """
+        deadlineTick = int((self.clock() + delay) / self.tickDuration + 0.999999)
+        task = self._timers.get(key)
+        if task is None:
+            task = self._timers[key] = TimerTask(key, deadlineTick, callback)
+        else:
+            del task.slot[key]
+            task.deadlineTick = deadlineTick
+            task.callback = callback
+        self._place(task)
+        return task
+
+    def cancel(self, key):
+        task = self._timers.pop(key, None)
+        if task is not None:
+            del task.slot[key]
+        return task is not None
+
+    def _place(self, task, cascading=False):
+        # Due now or in the past: fire on the next tick. While cascading, the current
+        # tick's level 0 slot has not fired yet and can still take the timer.
+        deadlineTick = max(task.deadlineTick, self._currentTick + (0 if cascading else 1))
+        for level, span in enumerate(self._spans):
+            if deadlineTick // span - self._currentTick // span < self.wheelSize:
+                break
+        slot = self._wheels[level][(deadlineTick // span) % self.wheelSize]
+        slot[task.key] = task
+        task.slot = slot
+
+    def advance(self, now=None):
+        """
+        Move the wheel up to now and run the callbacks of every expired timer.
+        Returns the number of timers fired.
+        """
+        targetTick = int((self.clock() if now is None else now) / self.tickDuration)
+        fired = 0
+        while self._currentTick < targetTick:
+            self._currentTick += 1
+            tick = self._currentTick
+            # Cascade higher levels first so timers land in the slot fired below
+            for level in range(self.levels - 1, 0, -1):
+                span = self._spans[level]
+                if tick % span:
+                    continue
+                index = (tick // span) % self.wheelSize
+                tasks = self._wheels[level][index]
+                if tasks:
+                    self._wheels[level][index] = {}
+                    for task in tasks.values():
+                        self._place(task, cascading=True)
+            index = tick % self.wheelSize
+            expired = self._wheels[0][index]
+            if not expired:
+                continue
+            self._wheels[0][index] = {}
+            for key, task in expired.items():
+                if task.deadlineTick > tick:
+                    # Parked beyond the top level, not due yet
+                    self._place(task)
+                    continue
+                del self._timers[key]
+                task.slot = None
+                fired += 1
+                task.callback(key)
+        return fired
@@ -0,0 +1,298 @@
+import asyncio
+import os
+import time
+import weakref
+
+from Websocket.deflate import DEFLATE, mustSkip, recordCompressed, recordInflated
+from Websocket.engine import ENGINE
+from Websocket.log import getLogger
+from Websocket.metrics import REGISTRY, startMetricsServer
+from Websocket.outbound import OutboundQueue
+from Websocket.reassembly import MAX_MESSAGE_SIZE
+from Websocket.watchdog import startWatchdog
+from Websocket.worker_group import WorkerGroup
+
+log = getLogger("transport")
+
+# Transport used when none is named (LAPI_BACKEND)
+DEFAULT_BACKEND = "native"
+# Largest message a device may send (LAPI_MAX_MESSAGE_SIZE), the libraries close with 1009 past it
+MAX_FRAME_SIZE = MAX_MESSAGE_SIZE
+
+# Same series as the native handler, whichever backend accepted the connection
+connectionsOpen = REGISTRY.gauge("lapi_connections_open", "Connections currently open")
+connectionsAccepted = REGISTRY.counter("lapi_connections_accepted", "Connections accepted")
+
+class AsyncConnection:
+    """
+    A websockets or aiohttp WebSocket as the engine sees it: close() only schedules the
+    close coroutine on the loop, send() queues a frame on the connection's OutboundQueue,
+    whose batches go out through sendFrames. A connection over the outbound high-water
+    mark is aborted under the "close" policy.
+    """
+
+    __slots__ = ("websocket", "transport", "outbound")
+
+    def __init__(self, websocket, transport, sendFrames):
+        self.websocket = websocket
+        self.transport = transport
+        self.outbound = OutboundQueue(sendFrames, self.abort)
+
+    def send(self, payload):
+        return self.outbound.put(payload)
+
+    def close(self):
+        asyncio.ensure_future(self.websocket.close())
+
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+class WebsocketsTransport:
+    """
+    The engine on the websockets library: the handshake is answered in process_request,
+    a refused one as a plain HTTP response, and the accepted connection carries frames.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or ENGINE
+        # Upgrades decided in process_request, waiting for their connection handler
+        self._accepted = weakref.WeakKeyDictionary()
+
+    async def processRequest(self, websocket, request):
+        upgrade = (request.headers.get("Upgrade") or "").lower() == "websocket"
+        result = await self.engine.handshake("GET", request.path, upgrade, websocket.remote_address)
+        if result.upgrade:
+            self._accepted[websocket] = result
+            return None
+        response = websocket.respond(result.status, result.text())
+        del response.headers["Content-Type"]
+        for name, value in result.headers.items():
+            response.headers[name] = value
+        return response
+
+    async def handle(self, websocket):
+        from websockets.exceptions import ConnectionClosed
+        result = self._accepted.pop(websocket, None)
+        if result is None:
+            return
+        remote = websocket.remote_address
+        connection = AsyncConnection(websocket, websocket.transport, self.sender(websocket))
+        connectionsAccepted.inc()
+        connectionsOpen.inc()
+        try:
+            await websocket.send(result.text())
+            self.engine.attach(result, connection, remote)
+            async for message in websocket:
+                if not isinstance(message, str):
+                    log.warning("Currently only supports text messages, not binary messages",
+                                device=result.deviceCode, remote=remote)
+                    await websocket.close(1003, "Text frames only")
+                    break
+                reply = self.engine.frame(connection, result.deviceCode, message)
+                if reply is not None:
+                    connection.send(reply)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            log.error("Exception occurred: %s", e, exc_info=e, device=result.deviceCode, remote=remote)
+        finally:
+            connection.outbound.close()
+            connectionsOpen.dec()
+            self.engine.detach(result.deviceCode, connection)
+            log.info("The device has been removed", device=result.deviceCode, remote=remote)
+
+    @staticmethod
+    def sender(websocket):
+        async def sendFrames(frames):
+            # One send context for the batch: the library encodes each frame (deflate included)
+            # and its bytes leave in one writelines instead of a transport write per frame.
+            # send_context checks the connection is open, then waits for the transport to drain
+            async with websocket.send_context():
+                protocol = websocket.protocol
+                for frame in frames:
+                    # Engine replies are UTF-8 bytes already, pushed messages may be str
+                    protocol.send_text(frame.encode("utf-8") if isinstance(frame, str) else frame)
+                websocket.transport.writelines(protocol.data_to_send())
+        return sendFrames
+
+    async def serve(self, host, port, reusePort=False):
+        from websockets.asyncio.server import serve
+        async with serve(self.handle, host, port, process_request=self.processRequest, compression=None,
+                         extensions=websocketsDeflate(DEFLATE), max_size=MAX_FRAME_SIZE, ping_interval=None,
+                         reuse_port=reusePort):
+            log.info("WebSocket server started successfully on %s:%s (websockets)", host, port)
+            await asyncio.Future()
+
+class AiohttpTransport:
+    """
+    The engine on aiohttp: one catch-all route answers the handshake, an upgraded
+    request becomes a WebSocketResponse carrying frames.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or ENGINE
+
+    async def handle(self, request):
+        from aiohttp import WSMsgType, web
+        remote = request.transport.get_extra_info("peername") if request.transport is not None else request.remote
+        upgrade = request.headers.get("Upgrade", "").lower() == "websocket"
+        result = await self.engine.handshake(request.method, request.raw_path, upgrade, remote)
+        if not result.upgrade:
+            return web.Response(status=result.status, body=result.text().encode("utf-8") or None, headers=result.headers)
+        # aiohttp compresses every data frame once deflate is negotiated, heartbeats included,
+        # so this backend declines the extension whatever LAPI_DEFLATE says
+        websocket = web.WebSocketResponse(compress=False, max_msg_size=MAX_FRAME_SIZE)
+        await websocket.prepare(request)
+        connection = AsyncConnection(websocket, request.transport, self.sender(websocket, request))
+        connectionsAccepted.inc()
+        connectionsOpen.inc()
+        try:
+            await websocket.send_str(result.text())
+            self.engine.attach(result, connection, remote)
+            async for message in websocket:
+                if message.type == WSMsgType.TEXT:
+                    reply = self.engine.frame(connection, result.deviceCode, message.data)
+                    if reply is not None:
+                        connection.send(reply)
+                elif message.type == WSMsgType.BINARY:
+                    log.warning("Currently only supports text messages, not binary messages",
+                                device=result.deviceCode, remote=remote)
+                    await websocket.close(code=1003, message=b"Text frames only")
+        except Exception as e:
+            log.error("Exception occurred: %s", e, exc_info=e, device=result.deviceCode, remote=remote)
+        finally:
+            connection.outbound.close()
+            connectionsOpen.dec()
+            self.engine.detach(result.deviceCode, connection)
+            log.info("The device has been removed", device=result.deviceCode, remote=remote)
+        return websocket
+
+    @staticmethod
+    def sender(websocket, request):
+        from Websocket.websocket import WebSocketFrameCodec, encodeFrame
+
+        async def sendFrames(frames):
+            # aiohttp writes every frame with its own transport.write, so the batch is framed
+            # here, as the native pipeline does, and leaves in one writelines. This backend
+            # never compresses, so the frames are plain text frames
+            if websocket.closed or request.transport is None or request.transport.is_closing():
+                raise ConnectionResetError("Cannot write to closing transport")
+            # Engine replies are UTF-8 bytes already, pushed messages may be str
+            request.transport.writelines([
+                encodeFrame(WebSocketFrameCodec.OPCODE_TEXT, frame.encode("utf-8") if isinstance(frame, str) else frame)
+                for frame in frames])
+            await request.writer.drain()
+        return sendFrames
+
+    async def serve(self, host, port, reusePort=False):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port, reuse_port=reusePort or None).start()
+            log.info("WebSocket server started successfully on %s:%s (aiohttp)", host, port)
+            await asyncio.Future()
+        finally:
+            await runner.cleanup()
+
+def websocketsDeflate(settings):
+    """
+    Server extensions for websockets: permessage-deflate negotiated with the native
+    pipeline's settings, skipping small and Uncompressed messages and counted on the same
+    lapi_deflate_* series. None when LAPI_DEFLATE is off.
+    """
+    if not settings.enabled:
+        return None
+    from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+    from websockets.frames import CONT, CTRL_OPCODES
+
+    class ThresholdDeflate(PerMessageDeflate):
+        def encode(self, frame):
+            # Replies are never fragmented, so a skipped message is a single frame without RSV1
+            if frame.opcode in CTRL_OPCODES or mustSkip(frame.data, settings.minSize):
+                return frame
+            started = time.perf_counter()
+            encoded = super().encode(frame)
+            recordCompressed(len(frame.data), len(encoded.data), time.perf_counter() - started)
+            return encoded
+
+        def decode(self, frame, *, max_size=None):
+            if not (frame.rsv1 or (frame.opcode is CONT and self.decode_cont_data)):
+                return super().decode(frame, max_size=max_size)
+            started = time.perf_counter()
+            decoded = super().decode(frame, max_size=max_size)
+            recordInflated(len(decoded.data), len(frame.data), time.perf_counter() - started)
+            return decoded
+
+    class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+        def process_request_params(self, params, accepted):
+            response, extension = super().process_request_params(params, accepted)
+            return response, ThresholdDeflate(extension.remote_no_context_takeover,
+                                              extension.local_no_context_takeover,
+                                              extension.remote_max_window_bits, extension.local_max_window_bits,
+                                              extension.compress_settings)
+
+    windowBits = settings.windowBits if settings.windowBits < 15 else None
+    return [ThresholdDeflateFactory(server_no_context_takeover=not settings.contextTakeover,
+                                    client_no_context_takeover=not settings.contextTakeover,
+                                    server_max_window_bits=windowBits, client_max_window_bits=windowBits,
+                                    compress_settings={"level": settings.level})]
+
+# Backends that run on an asyncio loop started here, "native" is Websocket/websocket.py's own pipeline
+BACKENDS = {"websockets": WebsocketsTransport, "aiohttp": AiohttpTransport}
+
+async def runTransport(transport, host, port, reusePort=False):
+    # Pick up edits to the secrets file without blocking the loop
+    secretTable = transport.engine.secretTable
+    watcher = asyncio.create_task(secretTable.watch()) if secretTable.path else None
+    # GET /metrics on the same loop (LAPI_METRICS_HOST, LAPI_METRICS_PORT, 0 disables)
+    await startMetricsServer()
+    # Reports callbacks that block the loop, on /metrics and /debug/stalls (LAPI_WATCHDOG_THRESHOLD)
+    startWatchdog()
+    try:
+        await transport.serve(host, port, reusePort)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+def serveBackend(backend, host, port, reusePort=False):
+    """
+    Runs one server process of backend with its own event loop.
+    """
+    asyncio.run(runTransport(BACKENDS[backend](), host, port, reusePort))
+
+def serve(host, port, workers=1, backend=None):
+    """
+    Serve the LAPI protocol on backend (LAPI_BACKEND, else "native"): "native",
+    "websockets" or "aiohttp". Devices see the same protocol on each.
+    """
+    backend = backend or os.environ.get("LAPI_BACKEND") or DEFAULT_BACKEND
+    if backend == "native":
+        from Websocket.websocket import Websocket
+        Websocket().run(host, port, workers)
+        return
+    if backend not in BACKENDS:
+        raise ValueError("Backend %r is not supported, choose from: native, %s" % (backend, ", ".join(BACKENDS)))
+    log.info("Starting websocket server...")
+    workerGroup = WorkerGroup(workers)
+    # Challenges must verify on whichever worker gets the signed Register
+    ENGINE.useWorkers(workerGroup.workers)
+    try:
+        if workerGroup.workers > 1:
+            # Every forked worker binds the same port with SO_REUSEPORT and runs its own loop
+            workerGroup.run(serveBackend, backend, host, port, True)
+        else:
+            serveBackend(backend, host, port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        workerGroup.shutdown()
+        log.info("Websocket Server closed.")
+
+# Run from the repository root: LAPI_BACKEND=aiohttp python -m Websocket.transports [workers]
+if __name__ == "__main__":
+    import sys
+    serve("127.0.0.1", 8080, int(sys.argv[1]) if len(sys.argv) > 1 else 1)
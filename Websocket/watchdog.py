@@ -0,0 +1,192 @@
+import asyncio
+import os
+import sys
+import sysconfig
+import threading
+import time
+from collections import deque
+
+from Websocket.log import getLogger
+from Websocket.metrics import ADMIN_PAGES, REGISTRY, LATENCY_BUCKETS
+
+log = getLogger("watchdog")
+
+# Seconds between loop heartbeats, and the scheduling lag that counts as a stall (LAPI_WATCHDOG_THRESHOLD, 0 disables)
+WATCHDOG_INTERVAL = 0.05
+WATCHDOG_THRESHOLD = 0.1
+# Stalls kept for the rolling report
+WATCHDOG_REPORT_SIZE = 100
+# Frames kept of a captured loop stack, innermost last
+STACK_DEPTH = 30
+
+loopLag = REGISTRY.histogram("lapi_loop_lag_seconds", "Scheduling lag of the event loop heartbeat", buckets=LATENCY_BUCKETS)
+loopStalls = REGISTRY.counter("lapi_loop_stalls", "Event loop stalls over the watchdog threshold by handler", ("handler",))
+loopStallSeconds = REGISTRY.counter("lapi_loop_stall_seconds", "Seconds the event loop was stalled by handler", ("handler",))
+
+# Library code is skipped when naming the handler that blocked the loop
+_LIBRARY_PATHS = tuple(sorted({os.path.normcase(path) for name, path in sysconfig.get_paths().items()
+                               if name in ("stdlib", "platstdlib", "purelib", "platlib")}, key=len, reverse=True))
+NOT_SAMPLED = "<not sampled>"
+
+class Stall:
+    """
+    One stall of the loop: when it was detected, how long the loop lagged, the innermost
+    application function on the loop thread's stack and that stack as "file:line function".
+    """
+
+    __slots__ = ("at", "duration", "handler", "stack")
+
+    def __init__(self, at, duration, handler, stack):
+        self.at = at
+        self.duration = duration
+        self.handler = handler
+        self.stack = stack
+
+    def __repr__(self):
+        return "Stall(duration=%.3f, handler=%r)" % (self.duration, self.handler)
+
+class LoopWatchdog:
+    """
+    Measures the scheduling lag of an event loop and catches what blocks it.
+
+    A timer on the loop beats every interval and records how late it ran. A helper thread
+    watches the beat: once it is overdue by threshold, the loop thread is stuck in some
+    callback, and the helper takes that thread's stack from sys._current_frames() while
+    it is still stuck. When the loop beats again the stall is complete, its length is
+    known, and it is counted per handler (the innermost function outside the standard
+    library and site-packages, e.g. handleWebSocketRequest or keep_alive_task), logged
+    and kept in a rolling report. The loop pays one timer callback per interval, the
+    helper thread only reads a float between stalls.
+    """
+
+    def __init__(self, loop=None, interval=WATCHDOG_INTERVAL, threshold=None, reportSize=WATCHDOG_REPORT_SIZE):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold if threshold is not None else float(
+            os.environ.get("LAPI_WATCHDOG_THRESHOLD", WATCHDOG_THRESHOLD))
+        self.stalls = deque(maxlen=reportSize)
+        self._loopThread = None
+        self._beat = None       # monotonic time of the last beat
+        self._expected = None   # when the next beat is due
+        self._captured = None   # (beat, handler, stack) taken by the helper during a stall
+        self._timer = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        """
+        Start beating on the loop (the running one when none was given) and watching it.
+        Returns self, or None when the threshold is 0.
+        """
+        if not self.threshold:
+            return None
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._started = time.time()
+        self._stop.clear()
+        self._beat = time.monotonic()
+        self._expected = self._beat + self.interval
+        self._timer = self.loop.call_later(self.interval, self._tick)
+        self._thread = threading.Thread(target=self._watch, name="lapi-loop-watchdog", daemon=True)
+        self._thread.start()
+        ADMIN_PAGES["/debug/stalls"] = self.report
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _tick(self):
+        now = time.monotonic()
+        if self._loopThread is None:
+            self._loopThread = threading.get_ident()
+        lag = max(now - self._expected, 0.0)
+        loopLag.observe(lag)
+        if lag >= self.threshold:
+            self._record(lag, self._beat)
+        self._beat = now
+        self._expected = now + self.interval
+        if not self._stop.is_set():
+            self._timer = self.loop.call_later(self.interval, self._tick)
+
+    def _record(self, lag, beat):
+        captured = self._captured
+        if captured is not None and captured[0] == beat:
+            handler, stack = captured[1], captured[2]
+        else:
+            # Shorter than the helper's polling period, the loop moved on before it looked
+            handler, stack = NOT_SAMPLED, ()
+        self._captured = None
+        self.stalls.append(Stall(time.time(), lag, handler, stack))
+        loopStalls.labels(handler).inc()
+        loopStallSeconds.labels(handler).inc(lag)
+        log.warning("Event loop blocked for %.3fs in %s", lag, handler, latency=lag,
+                    stack=" <- ".join(reversed(stack[-5:])) if stack else None)
+
+    def _watch(self):
+        period = min(self.interval, self.threshold) / 2
+        while not self._stop.wait(period):
+            beat = self._beat
+            if self._loopThread is None or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            captured = self._captured
+            if captured is not None and captured[0] == beat:
+                continue
+            frame = sys._current_frames().get(self._loopThread)
+            if frame is not None:
+                handler, stack = _describe(frame)
+                self._captured = (beat, handler, stack)
+            del frame
+
+    def report(self):
+        """
+        Rolling report as text: stalls per handler, then the most recent stalls with stacks.
+        """
+        byHandler = {}
+        stalls = list(self.stalls)
+        for stall in stalls:
+            count, total, longest = byHandler.get(stall.handler, (0, 0.0, 0.0))
+            byHandler[stall.handler] = (count + 1, total + stall.duration, max(longest, stall.duration))
+        lines = ["Event loop watchdog: threshold %.3fs, %d stalls kept since %s" % (
+            self.threshold, len(stalls), time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._started or time.time())))]
+        if not stalls:
+            return lines[0] + "\n"
+        lines.append("")
+        lines.append("%8s %10s %10s  %s" % ("stalls", "total s", "max s", "handler"))
+        for handler, (count, total, longest) in sorted(byHandler.items(), key=lambda item: -item[1][1]):
+            lines.append("%8d %10.3f %10.3f  %s" % (count, total, longest, handler))
+        for stall in reversed(stalls[-10:]):
+            lines.append("")
+            lines.append("%s blocked %.3fs in %s" % (
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stall.at)), stall.duration, stall.handler))
+            lines.extend("    " + entry for entry in stall.stack)
+        return "\n".join(lines) + "\n"
+
+def startWatchdog(loop=None, threshold=None):
+    """
+    LoopWatchdog for loop (the running loop by default) already started, None when
+    disabled with LAPI_WATCHDOG_THRESHOLD=0.
+    """
+    return LoopWatchdog(loop, threshold=threshold).start()
+
+def _describe(frame):
+    stack = []
+    handler = None
+    while frame is not None and len(stack) < STACK_DEPTH:
+        code = frame.f_code
+        name = getattr(code, "co_qualname", code.co_name)
+        stack.append("%s:%d %s" % (os.path.basename(code.co_filename), frame.f_lineno, name))
+        if handler is None and not _isLibrary(code.co_filename):
+            handler = name
+        frame = frame.f_back
+    stack.reverse()
+    return handler or "<library>", tuple(stack)
+
+def _isLibrary(filename):
+    return os.path.normcase(filename).startswith(_LIBRARY_PATHS) or filename.startswith("<")
@@ -1,38 +1,365 @@
 import asyncio
-import traceback
+import codecs
+import socket
+import struct
+import threading
+
+from Websocket.log import getLogger
+from Websocket.metrics import startMetricsServer
+from Websocket.outbound import outboundDropped, outboundEvictions, outboundFrames, outboundLimits, outboundWrites
+from Websocket.reassembly import messagesRejected
+from Websocket.watchdog import startWatchdog
+from Websocket.worker_group import WorkerGroup
+from Websocket.WebSocketHandler import (
+    BinaryWebSocketFrame,
+    ChannelFuture,
+    CloseWebSocketFrame,
+    ContinuationWebSocketFrame,
+    FullHttpRequest,
+    FullHttpResponse,
+    PingWebSocketFrame,
+    PongWebSocketFrame,
+    TextWebSocketFrame,
+    WebSocketHandler,
+)
+
+log = getLogger("server")
 
 # Define ChannelOption with required options
 class ChannelOption:
     SO_BACKLOG = "SO_BACKLOG"
     SO_KEEPALIVE = "SO_KEEPALIVE"
+    SO_REUSEPORT = "SO_REUSEPORT"
+    # (high, low, policy) as returned by outboundLimits()
+    WRITE_BUFFER_WATER_MARK = "WRITE_BUFFER_WATER_MARK"
 
 # Dummy implementation of NioServerSocketChannel to preserve class naming
 class NioServerSocketChannel:
     pass
 
+# Per-handler context, gives a handler access to its neighbours in the pipeline
+class DefaultChannelHandlerContext:
+    __slots__ = ("_pipeline", "name", "handler", "_removed")
+
+    def __init__(self, pipeline, name, handler):
+        self._pipeline = pipeline
+        self.name = name
+        self.handler = handler
+        self._removed = False
+
+    def channel(self):
+        return self._pipeline.channel
+
+    def pipeline(self):
+        return self._pipeline
+
+    def isRemoved(self):
+        return self._removed
+
+    # Inbound events travel head -> tail
+    def fireChannelRead(self, msg):
+        self._pipeline._invokeNext(self, "channelRead", msg)
+
+    def fireChannelReadComplete(self):
+        self._pipeline._invokeNext(self, "channelReadComplete")
+
+    def fireExceptionCaught(self, cause):
+        self._pipeline._invokeNext(self, "exceptionCaught", cause)
+
+    # Outbound writes travel tail -> head and end up in the channel's write buffer
+    def write(self, msg):
+        self._pipeline._writePrev(self, msg)
+
+    def writeAndFlush(self, msg):
+        self.write(msg)
+        return self.flush()
+
+    def flush(self):
+        return self._pipeline.channel.flush()
+
 # Implementation of Pipeline to add handlers
 class Pipeline:
-    def __init__(self):
-        self.handlers = []
+    __slots__ = ("channel", "handlers")
+
+    def __init__(self, channel=None):
+        self.channel = channel
+        self.handlers = []  # list of DefaultChannelHandlerContext, head first
+
     def addLast(self, name, handler):
-        self.handlers.append((name, handler))
-
-# Dummy implementation of SocketChannel
-class SocketChannel:
-    def __init__(self, reader, writer):
-        self.reader = reader
-        self.writer = writer
-        self._pipeline = Pipeline()
+        ctx = DefaultChannelHandlerContext(self, name, handler)
+        self.handlers.append(ctx)
+        if hasattr(handler, "handlerAdded"):
+            handler.handlerAdded(ctx)
+        return self
+
+    def get(self, name):
+        for ctx in self.handlers:
+            if ctx.name == name:
+                return ctx.handler
+        return None
+
+    def context(self, name):
+        for ctx in self.handlers:
+            if ctx.name == name:
+                return ctx
+        return None
+
+    def remove(self, name):
+        ctx = self.context(name)
+        if ctx is None:
+            return None
+        self.handlers.remove(ctx)
+        ctx._removed = True
+        if hasattr(ctx.handler, "handlerRemoved"):
+            ctx.handler.handlerRemoved(ctx)
+        return ctx.handler
+
+    def replace(self, oldName, newName, handler):
+        old = self.context(oldName)
+        index = self.handlers.index(old)
+        ctx = DefaultChannelHandlerContext(self, newName, handler)
+        self.handlers[index] = ctx
+        old._removed = True
+        return old.handler
+
+    def fireChannelActive(self):
+        for ctx in list(self.handlers):
+            if hasattr(ctx.handler, "channelActive"):
+                ctx.handler.channelActive(ctx)
+
+    def fireChannelInactive(self):
+        for ctx in list(self.handlers):
+            if hasattr(ctx.handler, "channelInactive"):
+                ctx.handler.channelInactive(ctx)
+        # The connection is gone, tear the pipeline down like Netty does on deregister
+        for ctx in list(self.handlers):
+            self.remove(ctx.name)
+
+    def fireChannelRead(self, msg):
+        self._invokeFrom(0, "channelRead", msg)
+
+    def fireChannelReadComplete(self):
+        self._invokeFrom(0, "channelReadComplete")
+
+    def write(self, msg):
+        self._writeFrom(len(self.handlers) - 1, msg)
+
+    def _invokeNext(self, ctx, event, *args):
+        if ctx._removed:
+            # A handler that replaced itself mid-read forwards to the new head
+            self._invokeFrom(0, event, *args)
+            return
+        self._invokeFrom(self.handlers.index(ctx) + 1, event, *args)
+
+    def _invokeFrom(self, index, event, *args):
+        for i in range(index, len(self.handlers)):
+            ctx = self.handlers[i]
+            method = getattr(ctx.handler, event, None)
+            if method is None:
+                continue
+            try:
+                method(ctx, *args)
+            except Exception as e:
+                if event == "exceptionCaught":
+                    log.exception("exceptionCaught handler failed", remote=self.channel.remoteAddress())
+                else:
+                    self._invokeFrom(i + 1, "exceptionCaught", e)
+            return
+        if event == "exceptionCaught" and args:
+            # Reached the tail without a handler, log it and drop the connection
+            log.error("Unhandled exception in pipeline: %s", args[0], remote=self.channel.remoteAddress())
+            self.channel.close()
+
+    def _writePrev(self, ctx, msg):
+        if ctx._removed:
+            self.write(msg)
+            return
+        self._writeFrom(self.handlers.index(ctx) - 1, msg)
+
+    def _writeFrom(self, index, msg):
+        for i in range(index, -1, -1):
+            ctx = self.handlers[i]
+            if hasattr(ctx.handler, "write"):
+                ctx.handler.write(ctx, msg)
+                return
+        self.channel._outboundWrite(msg)
+
+# Asyncio-backed SocketChannel, one protocol instance per accepted connection
+class SocketChannel(asyncio.Protocol):
+    # Per-connection objects are slotted, a worker holds tens of thousands of idle devices
+    __slots__ = ("_initializer", "_child_options", "_pipeline", "_transport", "_remote_address", "_outbound",
+                 "_closing", "_loop", "_loopThread", "_flushHandle", "_writable", "_overflowPolicy")
+
+    def __init__(self, initializer, childOptions=None):
+        self._initializer = initializer
+        self._child_options = childOptions or {}
+        self._pipeline = Pipeline(self)
+        self._transport = None
+        self._remote_address = None
+        self._outbound = []
+        self._closing = False
+        self._loop = None
+        self._loopThread = None
+        self._flushHandle = None
+        self._writable = True
+        # What pause_writing() does: "close" or "drop" from WRITE_BUFFER_WATER_MARK, else
+        # "pause", which only reports the channel unwritable and keeps queueing
+        self._overflowPolicy = "pause"
+
     # Preserve method name exactly as in Java: pipeline()
     def pipeline(self):
         return self._pipeline
 
+    def remoteAddress(self):
+        return self._remote_address
+
+    def isActive(self):
+        return self._transport is not None and not self._closing
+
+    def isWritable(self):
+        return self._writable and self.isActive()
+
+    def inEventLoop(self):
+        return threading.get_ident() == self._loopThread
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+        self._remote_address = transport.get_extra_info("peername")
+        sock = transport.get_extra_info("socket")
+        if sock is not None and self._child_options.get(ChannelOption.SO_KEEPALIVE):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        waterMark = self._child_options.get(ChannelOption.WRITE_BUFFER_WATER_MARK)
+        if waterMark is not None:
+            # The transport calls pause_writing() once its buffer passes the high mark
+            transport.set_write_buffer_limits(high=waterMark[0], low=waterMark[1])
+            self._overflowPolicy = waterMark[2]
+        try:
+            self._initializer.initChannel(self)
+            self._pipeline.fireChannelActive()
+        except Exception:
+            log.exception("Channel initialization failed", remote=self._remote_address)
+            self.close()
+
+    def data_received(self, data):
+        self._pipeline.fireChannelRead(data)
+        self._pipeline.fireChannelReadComplete()
+
+    def eof_received(self):
+        # Returning None lets asyncio close the transport
+        return None
+
+    def connection_lost(self, exc):
+        self._closing = True
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        self._outbound.clear()
+        self._pipeline.fireChannelInactive()
+        self._transport = None
+
+    def pause_writing(self):
+        # The device reads slower than it is written to, as Netty's channelWritabilityChanged
+        self._writable = False
+        if self._overflowPolicy == "close" and not self._closing:
+            outboundEvictions.inc()
+            log.warning("Write buffer over %d bytes, closing the connection",
+                        self._transport.get_write_buffer_limits()[1], remote=self._remote_address)
+            self._closing = True
+            self._outbound.clear()
+            self._transport.abort()
+
+    def resume_writing(self):
+        self._writable = True
+
+    # Writes from other threads (e.g. the keep alive executor) are handed to the
+    # channel's loop, as Netty does for writes outside the channel's EventLoop.
+    def write(self, msg):
+        if not self.inEventLoop():
+            return self._submitToLoop(self.write, msg)
+        self._pipeline.write(msg)
+        return ChannelFuture(success=self.isActive())
+
+    def flush(self):
+        if not self.inEventLoop():
+            return self._submitToLoop(self.flush)
+        # Everything flushed in this loop iteration leaves in one transport write
+        if self._outbound and self._flushHandle is None and self._transport is not None:
+            self._flushHandle = self._loop.call_soon(self._writeOutbound)
+        return ChannelFuture(success=self._transport is not None)
+
+    def _writeOutbound(self):
+        self._flushHandle = None
+        if self._outbound and self._transport is not None and not self._closing:
+            outboundWrites.inc()
+            outboundFrames.inc(len(self._outbound))
+            self._transport.writelines(self._outbound)
+        # The transport keeps the buffers, not the list, so it is reused
+        self._outbound.clear()
+
+    def writeAndFlush(self, msg):
+        if not self.inEventLoop():
+            return self._submitToLoop(self.writeAndFlush, msg)
+        self.write(msg)
+        return self.flush()
+
+    def _submitToLoop(self, fn, *args):
+        if self._loop is None or self._loop.is_closed():
+            return ChannelFuture(success=False)
+        self._loop.call_soon_threadsafe(fn, *args)
+        return ChannelFuture(success=self.isActive())
+
+    def _outboundWrite(self, msg):
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        if not isinstance(msg, (bytes, bytearray, memoryview)):
+            raise TypeError("Unsupported message type reached the head of the pipeline: %r" % type(msg))
+        if not self._writable and self._overflowPolicy == "drop":
+            # "close" has aborted the transport, "pause" leaves the buffering to asyncio
+            outboundDropped.inc()
+            return
+        self._outbound.append(msg)
+
+    def send(self, payload):
+        """
+        Text frame to the device from outside the pipeline (LapiEngine.push), from any
+        thread. False when the channel is closed or over its write buffer high-water mark.
+        """
+        writable = self.isWritable()
+        if writable:
+            self.writeAndFlush(TextWebSocketFrame(payload))
+        return writable
+
+    def close(self):
+        if not self.inEventLoop():
+            return self._submitToLoop(self.close)
+        if self._transport is None or self._closing:
+            return ChannelFuture(success=False)
+        # Whatever is still waiting for the deferred flush goes out before the close
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+        self._writeOutbound()
+        self._closing = True
+        self._transport.close()
+        return ChannelFuture(success=True)
+
+    def upgradeToWebSocket(self, maxFramePayloadLength, deflate=None):
+        # Called by WebSocketServerHandshaker once the 101 response is queued,
+        # mirrors Netty replacing the HTTP codec with the WebSocket frame codec.
+        if self._pipeline.get("aggregator") is not None:
+            self._pipeline.remove("aggregator")
+        self._pipeline.replace("http-codec", "ws-codec", WebSocketFrameCodec(maxFramePayloadLength, deflate))
+
+    def __str__(self):
+        return "SocketChannel(%s)" % (self._remote_address,)
+
 # Implementation of ChannelInitializer used to set up channel pipeline
 class ChannelInitializer:
     def __init__(self, init_func):
         self.init_func = init_func
-    async def initChannel(self, ch):
-        await self.init_func(ch)
+    def initChannel(self, ch):
+        self.init_func(ch)
 
 # Dummy implementation of the ServerBootstrap class to simulate Netty's behavior
 class ServerBootstrap:
@@ -66,44 +393,35 @@ class ServerBootstrap:
         return self
 
     def bind(self, ip, port):
-        # Simulate binding by creating a Channel instance that internally starts an asyncio server.
-        return Channel(ip, port, self._child_handler)
+        # Binding creates a server Channel that starts the asyncio server on sync().
+        return Channel(ip, port, self._child_handler, self._options, self._child_options)
 
 # Implementation of Channel to simulate Netty's Channel behavior
 class Channel:
-    def __init__(self, ip, port, child_handler):
+    def __init__(self, ip, port, child_handler, options=None, child_options=None):
         self.ip = ip
         self.port = port
         self.child_handler = child_handler
+        self.options = options or {}
+        self.child_options = child_options or {}
         self.server = None
+        self.loop = None
 
-    async def start_server(self):
-        self.server = await asyncio.start_server(self.handle_client, self.ip, self.port)
+    def protocolFactory(self):
+        return SocketChannel(self.child_handler, self.child_options)
 
-    async def handle_client(self, reader, writer):
-        # When a client connects, create a new SocketChannel instance and initialize its pipeline.
-        channel = SocketChannel(reader, writer)
-        try:
-            # Call the child handler to initialize channel pipeline
-            await self.child_handler.initChannel(channel)
-        except Exception as e:
-            traceback.print_exc()
-        # For demonstration, we simply read some data and then close the connection.
-        try:
-            data = await reader.read(1024)
-            # Here, normally the pipeline handlers would process the data.
-        except Exception as e:
-            traceback.print_exc()
-        writer.close()
-        await writer.wait_closed()
+    async def start_server(self):
+        self.server = await asyncio.get_running_loop().create_server(
+            self.protocolFactory, self.ip, self.port,
+            backlog=self.options.get(ChannelOption.SO_BACKLOG, 100),
+            reuse_port=self.options.get(ChannelOption.SO_REUSEPORT))
 
     # To mimic .sync() chain in Java, we define sync() to start the server and return self.
     def sync(self):
-        loop = asyncio.get_event_loop()
-        try:
-            loop.run_until_complete(self.start_server())
-        except Exception as e:
-            traceback.print_exc()
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_server())
         return self
 
     # Mimic channel() method as in Java (returns self)
@@ -112,91 +430,535 @@ class Channel:
 
     # Mimic closeFuture().sync() behavior by waiting for server closure.
     def closeFuture(self):
-        # Return a future that waits for the server to close.
-        return self.server.wait_closed()
+        # serve_forever only returns once the server is closed
+        return self.server.serve_forever()
+
+    def __str__(self):
+        return "Channel(%s:%s)" % (self.ip, self.port)
+
+# HTTP messages produced by HttpServerCodec before aggregation
+class HttpRequest:
+    def __init__(self, method, uri, version, headers, decoder_success=True):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        self.decoder_success = decoder_success
+
+class HttpContent:
+    def __init__(self, content, last=False):
+        self.content = content
+        self.last = last
 
-# Dummy implementations for the HTTP and WebSocket handlers to preserve pipeline structure
+# Case-insensitive header map, HTTP header names are not case sensitive
+class HttpHeaders(dict):
+    def __init__(self):
+        super().__init__()
+        self._names = {}
+
+    def __setitem__(self, key, value):
+        lower = key.lower()
+        if lower in self._names:
+            super().__delitem__(self._names[lower])
+        self._names[lower] = key
+        super().__setitem__(key, value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(self._names[key.lower()])
+
+    def __contains__(self, key):
+        return isinstance(key, str) and key.lower() in self._names
+
+    def get(self, key, default=None):
+        name = self._names.get(key.lower())
+        return default if name is None else super().get(name, default)
 
 # Handler: HttpServerCodec
 class HttpServerCodec:
     # Set up a decoder to encode or decode request and response messages into HTTP messages.
+    MAX_HEADER_SIZE = 8192
+    __slots__ = ("_buf", "_remaining", "_chunked", "_chunk_remaining")
+
     def __init__(self):
-        pass
+        self._buf = bytearray()
+        self._remaining = 0       # body bytes left for Content-Length bodies
+        self._chunked = False
+        self._chunk_remaining = 0
+
+    def channelRead(self, ctx, data):
+        self._buf += data
+        while self._buf:
+            if self._remaining == 0 and not self._chunked:
+                if not self._decodeHead(ctx):
+                    return
+            elif self._chunked:
+                if not self._decodeChunk(ctx):
+                    return
+            else:
+                take = min(self._remaining, len(self._buf))
+                body = bytes(self._buf[:take])
+                del self._buf[:take]
+                self._remaining -= take
+                ctx.fireChannelRead(HttpContent(body, last=self._remaining == 0))
+            if ctx.isRemoved():
+                # Upgraded to WebSocket, remaining bytes belong to the frame codec
+                leftover = bytes(self._buf)
+                self._buf.clear()
+                if leftover:
+                    ctx.fireChannelRead(leftover)
+                return
+
+    def _decodeHead(self, ctx):
+        end = self._buf.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self._buf) > self.MAX_HEADER_SIZE:
+                self._fail(ctx)
+            return False
+        head = bytes(self._buf[:end]).decode("latin-1")
+        del self._buf[:end + 4]
+        lines = head.split("\r\n")
+        parts = lines[0].split(" ")
+        headers = HttpHeaders()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            self._fail(ctx)
+            return False
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep:
+                self._fail(ctx)
+                return False
+            headers[name.strip()] = value.strip()
+        try:
+            length = int(headers.get("Content-Length", "0"))
+        except ValueError:
+            self._fail(ctx)
+            return False
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        self._remaining = 0 if self._chunked else length
+        ctx.fireChannelRead(HttpRequest(parts[0], parts[1], parts[2], headers))
+        if not self._chunked and length == 0:
+            ctx.fireChannelRead(HttpContent(b"", last=True))
+        return True
+
+    def _decodeChunk(self, ctx):
+        if self._chunk_remaining == 0:
+            end = self._buf.find(b"\r\n")
+            if end < 0:
+                return False
+            try:
+                size = int(bytes(self._buf[:end]).split(b";")[0], 16)
+            except ValueError:
+                self._fail(ctx)
+                return False
+            if size == 0:
+                # Last chunk, skip the (empty) trailer section
+                trailer = self._buf.find(b"\r\n\r\n", end)
+                if trailer < 0:
+                    return False
+                del self._buf[:trailer + 4]
+                self._chunked = False
+                ctx.fireChannelRead(HttpContent(b"", last=True))
+                return True
+            del self._buf[:end + 2]
+            self._chunk_remaining = size
+        # Chunk data is followed by CRLF
+        if len(self._buf) < self._chunk_remaining + 2:
+            return False
+        body = bytes(self._buf[:self._chunk_remaining])
+        del self._buf[:self._chunk_remaining + 2]
+        self._chunk_remaining = 0
+        ctx.fireChannelRead(HttpContent(body))
+        return True
+
+    def _fail(self, ctx):
+        self._buf.clear()
+        ctx.fireChannelRead(HttpRequest("GET", "/bad-request", "HTTP/1.1", HttpHeaders(), decoder_success=False))
+        ctx.fireChannelRead(HttpContent(b"", last=True))
+
+    def write(self, ctx, msg):
+        if isinstance(msg, FullHttpResponse):
+            msg = self.encodeResponse(msg)
+        ctx.write(msg)
+
+    @staticmethod
+    def encodeResponse(res):
+        content = res.content or b""
+        headers = dict(res.headers())
+        if "Content-Length" not in headers and not str(res.status).startswith("101"):
+            headers["Content-Length"] = str(len(content))
+        lines = ["%s %s" % (res.http_version, res.status)]
+        lines.extend("%s: %s" % (k, v) for k, v in headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content
 
 # Handler: HttpObjectAggregator
 class HttpObjectAggregator:
     # Set the file size for a single request to convert multiple messages into a single HTTP request or response.
+    __slots__ = ("maxContentLength", "_request", "_content", "_size", "_tooLarge")
+
     def __init__(self, maxContentLength):
         self.maxContentLength = maxContentLength
+        self._request = None
+        self._content = []
+        self._size = 0
+        self._tooLarge = False
+
+    def channelRead(self, ctx, msg):
+        if isinstance(msg, HttpRequest):
+            self._request = msg
+            self._content = []
+            self._size = 0
+            self._tooLarge = False
+        elif isinstance(msg, HttpContent) and self._request is not None:
+            self._size += len(msg.content)
+            if self._size > self.maxContentLength:
+                if not self._tooLarge:
+                    self._tooLarge = True
+                    res = FullHttpResponse("HTTP/1.1", "413 Request Entity Too Large")
+                    ctx.channel().writeAndFlush(res)
+                    ctx.channel().close()
+                return
+            self._content.append(msg.content)
+            if msg.last:
+                req = self._request
+                self._request = None
+                ctx.fireChannelRead(FullHttpRequest(req.uri, req.headers, req.decoder_success,
+                                                    req.method, b"".join(self._content)))
+        else:
+            ctx.fireChannelRead(msg)
 
 # Handler: ChunkedWriteHandler
 class ChunkedWriteHandler:
     # Used for partitioned transmission of big data,
     # sending HTML5 files to clients to support WebSocket communication between browsers and servers.
-    def __init__(self):
-        pass
+    __slots__ = ()
 
-# Custom business handler: WebSocketHandler
-class WebSocketHandler:
     def __init__(self):
         pass
-    # Dummy handler method to simulate processing of WebSocket events.
-    async def handle(self, channel, message):
-        # Here you would implement the custom business logic.
-        pass
+
+    def write(self, ctx, msg):
+        # Iterables of byte chunks are written one chunk at a time, everything else passes through
+        if hasattr(msg, "__next__"):
+            for chunk in msg:
+                ctx.write(chunk)
+        else:
+            ctx.write(msg)
+
+# Handler: WebSocket frame decoder/encoder installed by the handshake (RFC 6455)
+class WebSocketFrameCodec:
+    OPCODE_CONTINUATION = 0x0
+    OPCODE_TEXT = 0x1
+    OPCODE_BINARY = 0x2
+    OPCODE_CLOSE = 0x8
+    OPCODE_PING = 0x9
+    OPCODE_PONG = 0xA
+
+    CLOSE_PROTOCOL_ERROR = 1002
+    CLOSE_INVALID_PAYLOAD = 1007
+    CLOSE_MESSAGE_TOO_BIG = 1009
+
+    # Single-frame messages up to this size are decoded once the whole frame is in, larger
+    # frames and fragmented messages are passed on chunk by chunk as their payload arrives
+    STREAM_THRESHOLD = 64 * 1024
+
+    __slots__ = ("maxFramePayloadLength", "deflate", "_buf", "_message", "_closed")
+
+    def __init__(self, maxFramePayloadLength, deflate=None):
+        # Largest message, checked against frame headers before their payload is read
+        self.maxFramePayloadLength = maxFramePayloadLength
+        # PerMessageDeflate when the handshake negotiated permessage-deflate
+        self.deflate = deflate
+        self._buf = bytearray()
+        # _StreamedMessage while a message is passed on in chunks
+        self._message = None
+        self._closed = False
+
+    def channelRead(self, ctx, data):
+        if not isinstance(data, (bytes, bytearray)):
+            ctx.fireChannelRead(data)
+            return
+        self._buf += data
+        while not self._closed:
+            message = self._message
+            if message is not None and message.mask is not None:
+                # Inside the payload of a streamed frame
+                if not self._streamPayload(ctx, message):
+                    return
+                continue
+            frame = self._decodeFrame(ctx)
+            if frame is None:
+                return
+            if frame is not _FRAGMENT:
+                ctx.fireChannelRead(frame)
+
+    def _decodeFrame(self, ctx):
+        buf = self._buf
+        if len(buf) < 2:
+            return None
+        b0, b1 = buf[0], buf[1]
+        fin = b0 & 0x80
+        rsv1 = b0 & 0x40
+        opcode = b0 & 0x0F
+        if b0 & 0x30 or (rsv1 and (self.deflate is None or opcode >= 0x8 or opcode == self.OPCODE_CONTINUATION)):
+            # RSV1 only marks the first frame of a compressed message, RSV2 and RSV3 are never negotiated
+            return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+        length = b1 & 0x7F
+        offset = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length = struct.unpack_from("!H", buf, 2)[0]
+            offset = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length = struct.unpack_from("!Q", buf, 2)[0]
+            offset = 10
+        if not b1 & 0x80:
+            # Client to server frames must be masked
+            return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+
+        if opcode >= 0x8:
+            # Control frames may be interleaved with fragments and are never fragmented
+            if length > 125 or not fin:
+                return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+            if len(buf) < offset + 4 + length:
+                return None
+            payload = self._takePayload(offset, length)
+            if opcode == self.OPCODE_CLOSE:
+                self._closed = True
+                return CloseWebSocketFrame(payload)
+            if opcode == self.OPCODE_PING:
+                return PingWebSocketFrame(payload)
+            if opcode == self.OPCODE_PONG:
+                return PongWebSocketFrame(payload)
+            return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+        message = self._message
+        if opcode == self.OPCODE_CONTINUATION:
+            if message is None:
+                return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+        elif message is not None or opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return self._protocolViolation(ctx, self.CLOSE_PROTOCOL_ERROR)
+        # Refused from the header, before any of the payload is buffered. A compressed
+        # message is also held to the limit once inflated, as it is inflated.
+        received = message.size if message is not None and message.inflater is None else 0
+        if length > self.maxFramePayloadLength - received:
+            messagesRejected.labels("too_big").inc()
+            return self._protocolViolation(ctx, self.CLOSE_MESSAGE_TOO_BIG)
+
+        if message is None and fin and (length <= self.STREAM_THRESHOLD or len(buf) >= offset + 4 + length):
+            # The whole message is one frame: decoded once it is all in
+            if len(buf) < offset + 4 + length:
+                return None
+            payload = self._takePayload(offset, length)
+            if rsv1:
+                payload = self.deflate.decompress(payload, self.maxFramePayloadLength)
+                if payload is None:
+                    messagesRejected.labels("too_big").inc()
+                    return self._protocolViolation(ctx, self.CLOSE_MESSAGE_TOO_BIG)
+            if opcode == self.OPCODE_BINARY:
+                return BinaryWebSocketFrame(payload)
+            try:
+                return TextWebSocketFrame(payload.decode("utf-8"))
+            except UnicodeDecodeError:
+                return self._protocolViolation(ctx, self.CLOSE_INVALID_PAYLOAD)
+
+        if message is None:
+            message = self._message = _StreamedMessage(opcode, self.deflate.inflater() if rsv1 else None)
+        message.mask = bytes(buf[offset:offset + 4])
+        message.remaining = length
+        message.fin = fin
+        del buf[:offset + 4]
+        return _FRAGMENT
+
+    def _takePayload(self, offset, length):
+        buf = self._buf
+        payload = unmask(bytes(buf[offset + 4:offset + 4 + length]), bytes(buf[offset:offset + 4]))
+        del buf[:offset + 4 + length]
+        return payload
+
+    def _streamPayload(self, ctx, message):
+        buf = self._buf
+        n = min(len(buf), message.remaining)
+        if n == 0 and message.remaining:
+            return False
+        chunk = unmask(bytes(buf[:n]), message.mask)
+        del buf[:n]
+        message.remaining -= n
+        # The next byte of this frame is unmasked from where this chunk stopped in the key
+        shift = n % 4
+        message.mask = message.mask[shift:] + message.mask[:shift] if message.remaining else None
+        final = message.fin and not message.remaining
+        if message.inflater is not None:
+            chunk = message.inflater.inflate(chunk, self.maxFramePayloadLength - message.size, final)
+            if chunk is None:
+                messagesRejected.labels("too_big").inc()
+                self._protocolViolation(ctx, self.CLOSE_MESSAGE_TOO_BIG)
+                return False
+        if not chunk and not final:
+            return True
+        message.size += len(chunk)
+        if message.utf8 is not None:
+            try:
+                message.utf8.decode(chunk, final)
+            except UnicodeDecodeError:
+                self._protocolViolation(ctx, self.CLOSE_INVALID_PAYLOAD)
+                return False
+        if final:
+            self._message = None
+        if message.started:
+            ctx.fireChannelRead(ContinuationWebSocketFrame(chunk, final))
+        else:
+            message.started = True
+            frameClass = TextWebSocketFrame if message.opcode == self.OPCODE_TEXT else BinaryWebSocketFrame
+            ctx.fireChannelRead(frameClass(chunk, final))
+        return True
+
+    def _protocolViolation(self, ctx, code):
+        self._closed = True
+        self._buf.clear()
+        self._message = None
+        ctx.channel().writeAndFlush(CloseWebSocketFrame(struct.pack("!H", code)))
+        ctx.channel().close()
+        return None
+
+    def write(self, ctx, msg):
+        if isinstance(msg, str):
+            msg = self._encodeData(self.OPCODE_TEXT, msg.encode("utf-8"))
+        elif isinstance(msg, TextWebSocketFrame):
+            msg = self._encodeData(self.OPCODE_TEXT, msg.content)
+        elif isinstance(msg, BinaryWebSocketFrame):
+            msg = self._encodeData(self.OPCODE_BINARY, msg.content)
+        elif isinstance(msg, CloseWebSocketFrame):
+            msg = encodeFrame(self.OPCODE_CLOSE, msg.content)
+        elif isinstance(msg, PingWebSocketFrame):
+            msg = encodeFrame(self.OPCODE_PING, msg.content)
+        elif isinstance(msg, PongWebSocketFrame):
+            msg = encodeFrame(self.OPCODE_PONG, msg.content)
+        ctx.write(msg)
+
+    def _encodeData(self, opcode, payload):
+        deflate = self.deflate
+        if deflate is None or deflate.mustSkip(payload):
+            return encodeFrame(opcode, payload)
+        return encodeFrame(opcode, deflate.compress(payload), rsv1=True)
+
+# Marker returned by the frame decoder for a frame whose payload is streamed from here
+_FRAGMENT = object()
+
+class _StreamedMessage:
+    # A data message passed on in chunks: its size so far, the inflater of a compressed one,
+    # the UTF-8 check of a text one, and the mask and unread length of the current frame
+    __slots__ = ("opcode", "size", "inflater", "utf8", "started", "mask", "remaining", "fin")
+
+    def __init__(self, opcode, inflater=None):
+        self.opcode = opcode
+        self.size = 0
+        self.inflater = inflater
+        self.utf8 = codecs.getincrementaldecoder("utf-8")() if opcode == WebSocketFrameCodec.OPCODE_TEXT else None
+        self.started = False
+        self.mask = None
+        self.remaining = 0
+        self.fin = False
+
+def unmask(payload, mask):
+    # XOR the whole payload at once through Python ints instead of byte by byte
+    n = len(payload)
+    if n == 0:
+        return payload
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+
+def encodeFrame(opcode, payload, fin=True, rsv1=False):
+    # Server to client frames are never masked, RSV1 marks a permessage-deflate message
+    b0 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", b0, n)
+    elif n < 65536:
+        header = struct.pack("!BBH", b0, 126, n)
+    else:
+        header = struct.pack("!BBQ", b0, 127, n)
+    return header + payload
 
 # Main Websocket class preserving the original structure and method names
 class Websocket:
-    def run(self, ip, port):
-        print("Starting websocket server...")
-        # Main thread group
+    def run(self, ip, port, workers=1):
+        log.info("Starting websocket server...")
+        # Main thread group, accepts are balanced by the kernel across SO_REUSEPORT workers
         bossGroup = "NioEventLoopGroup_boss"  # Dummy placeholder for boss group
-        # Work Thread Group
-        workerGroup = "NioEventLoopGroup_worker"  # Dummy placeholder for worker group
+        # Work group, one process with its own event loop per worker
+        workerGroup = WorkerGroup(workers)
         try:
             # Server startup auxiliary class, used to set TCP related parameters
             b = ServerBootstrap()
-            # Set as primary and secondary thread model
+            # Set as primary and secondary thread model. The accept backlog has to absorb every
+            # camera reconnecting after a restart, RegistrationAdmission paces them from there
             b.group(bossGroup, workerGroup) \
              .channel(NioServerSocketChannel) \
-             .option(ChannelOption.SO_BACKLOG, 5) \
-             .childOption(ChannelOption.SO_KEEPALIVE, True)  # 2-hour no data activation of heartbeat mechanism
+             .option(ChannelOption.SO_BACKLOG, 1024) \
+             .option(ChannelOption.SO_REUSEPORT, workerGroup.workers > 1) \
+             .childOption(ChannelOption.SO_KEEPALIVE, True) \
+             .childOption(ChannelOption.WRITE_BUFFER_WATER_MARK, outboundLimits())
+            # SO_KEEPALIVE: 2-hour no data activation of heartbeat mechanism. WRITE_BUFFER_WATER_MARK:
+            # LAPI_OUTBOUND_HIGH_WATER and LAPI_OUTBOUND_POLICY for devices that stop reading
             # Set up a ChannelPipeline, which is a business responsibility chain composed
-            # of handlers that are concatenated and processed by the thread pool
-            def init_func(ch):
-                # Add handlers for processing, usually including message encoding and decoding,
-                # business processing, as well as logs, permissions, filtering, etc
-                ch.pipeline().addLast("http-codec", HttpServerCodec())  # Set up a decoder to encode or decode request and response messages into HTTP messages.
-                ch.pipeline().addLast("aggregator", HttpObjectAggregator(65535))  # Set the file size for a single request to convert multiple messages into a single HTTP request or response.
-                ch.pipeline().addLast("http-chunked", ChunkedWriteHandler())  # Used for partitioned transmission of big data,
-                # sending HTML5 files to clients to support WebSocket communication between browsers and servers.
-                # ch.pipeline().addLast("adapter", new FunWebSocketServerHandler()); //Pre interceptor
-                ch.pipeline().addLast("handler", WebSocketHandler())  # Custom business handler
-                return asyncio.sleep(0)  # Return an awaitable dummy
-            # Wrap the initializer function in ChannelInitializer
-            initializer = ChannelInitializer(init_func)
+            # of handlers that are concatenated and processed by the event loop
+            initializer = ChannelInitializer(self.initChannel)
             b.childHandler(initializer)
-            channel = None
-            try:
-                # Bind the port, start the select thread, poll and listen for channel events,
-                # and once an event is detected, it will be handed over to the thread pool for processing.
-                channel = b.bind(ip, port).sync().channel()
-                print("WebSocket server started successfully:" + str(channel) + "\n")
-            except Exception as e:
-                traceback.print_exc()
-                print("The webSocket server failed to start, the port is occupied or a service is already running on that port. Please check the IP port settings\n")
-            try:
-                # Wait for the channel's close future to complete
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(channel.closeFuture())
-            except Exception as e:
-                traceback.print_exc()
+            # Challenges must verify on whichever worker gets the signed Register
+            WebSocketHandler.engine.useWorkers(workerGroup.workers)
+            if workerGroup.workers > 1:
+                # Every forked worker binds the same port and runs serve() on its own loop
+                workerGroup.run(self.serve, b, ip, port)
+            else:
+                self.serve(b, ip, port)
+        finally:
+            # Exit, release worker resources
+            workerGroup.shutdown()
+            log.info("Websocket Server closed.")
+
+    # Pipeline of every accepted channel
+    @staticmethod
+    def initChannel(ch):
+        # Add handlers for processing, usually including message encoding and decoding,
+        # business processing, as well as logs, permissions, filtering, etc
+        ch.pipeline().addLast("http-codec", HttpServerCodec())  # Set up a decoder to encode or decode request and response messages into HTTP messages.
+        ch.pipeline().addLast("aggregator", HttpObjectAggregator(65535))  # Set the file size for a single request to convert multiple messages into a single HTTP request or response.
+        ch.pipeline().addLast("http-chunked", ChunkedWriteHandler())  # Used for partitioned transmission of big data,
+        # sending HTML5 files to clients to support WebSocket communication between browsers and servers.
+        # ch.pipeline().addLast("adapter", new FunWebSocketServerHandler()); //Pre interceptor
+        ch.pipeline().addLast("handler", WebSocketHandler())  # Custom business handler
+
+    def serve(self, b, ip, port):
+        channel = None
+        try:
+            # Bind the port and start accepting on the event loop; every accepted
+            # socket is a SocketChannel protocol driven by that same loop.
+            channel = b.bind(ip, port).sync().channel()
+            log.info("WebSocket server started successfully: %s", channel)
+            # Pick up edits to the secrets file without blocking the loop
+            secretTable = WebSocketHandler.engine.secretTable
+            watcher = channel.loop.create_task(secretTable.watch()) if secretTable.path else None
+            # GET /metrics on the same loop (LAPI_METRICS_HOST, LAPI_METRICS_PORT, 0 disables)
+            channel.loop.run_until_complete(startMetricsServer())
+            # Reports callbacks that block the loop, on /metrics and /debug/stalls (LAPI_WATCHDOG_THRESHOLD)
+            startWatchdog(channel.loop)
+        except Exception as e:
+            log.error("The webSocket server failed to start, the port is occupied or a service is already running on that port. Please check the IP port settings")
+            raise
+        try:
+            # Wait for the channel's close future to complete
+            channel.loop.run_until_complete(channel.closeFuture())
+        except KeyboardInterrupt:
+            pass
         finally:
-            # Exit, release thread pool resources
-            # In this dummy implementation, we simply print as we do not have real thread pools.
-            print("Websocket Server closed.")
+            if watcher is not None:
+                watcher.cancel()
+                # Let the cancellation land, a task left pending is reported as destroyed
+                channel.loop.run_until_complete(asyncio.gather(watcher, return_exceptions=True))
 
-# Example usage (uncomment the following lines to run the server)
+# Example usage (run from the repository root: python -m Websocket.websocket [workers])
 if __name__ == '__main__':
+    import sys
     server = Websocket()
-    server.run("127.0.0.1", 8080) 
+    server.run("127.0.0.1", 8080, int(sys.argv[1]) if len(sys.argv) > 1 else 1)
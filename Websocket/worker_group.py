@@ -0,0 +1,116 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+
+from Websocket.log import getLogger, shutdownLogging
+
+log = getLogger("workers")
+
+# Multi-process worker mode: N forked processes each run their own event loop
+# on a SO_REUSEPORT listening socket and the kernel balances accepts between them.
+class WorkerGroup:
+    # Backoff before restarting a worker that crashed, doubled on every quick crash
+    RESTART_BACKOFF = 1.0
+    MAX_RESTART_BACKOFF = 30.0
+    # A worker that lived longer than this is considered healthy again
+    STABLE_AFTER = 10.0
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._procs = {}      # worker index -> Process
+        self._started = {}    # worker index -> start time
+        self._backoff = {}    # worker index -> current restart backoff
+        self._restartAt = {}  # worker index -> time the worker is due to be restarted
+        self._stopping = False
+
+    @staticmethod
+    def supportsReusePort():
+        return hasattr(socket, "SO_REUSEPORT")
+
+    def run(self, target, *args):
+        """
+        Fork the workers, each calling target(*args), and supervise them until
+        SIGINT/SIGTERM. Workers that exit with a non-zero code are restarted.
+        """
+        if self.workers > 1 and not self.supportsReusePort():
+            raise RuntimeError("SO_REUSEPORT is not available on this platform, run with a single worker")
+        self._context = multiprocessing.get_context("fork")
+        previous = {sig: signal.signal(sig, self._onSignal) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            for index in range(self.workers):
+                self._spawn(index, target, args)
+            self._supervise(target, args)
+        finally:
+            self.shutdown()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def _spawn(self, index, target, args):
+        proc = self._context.Process(target=self._workerMain, args=(index, target, args),
+                                     name="LapiWorker-%d" % index, daemon=True)
+        proc.start()
+        self._procs[index] = proc
+        self._started[index] = time.monotonic()
+        log.info("Worker %d started, pid=%d", index, proc.pid)
+
+    @staticmethod
+    def _workerMain(index, target, args):
+        # The supervisor owns Ctrl-C, workers only stop on SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.environ["LAPI_WORKER_INDEX"] = str(index)
+        try:
+            target(*args)
+        except Exception:
+            log.exception("Worker %d failed", index)
+            # os._exit() skips atexit, write the queued lines first
+            shutdownLogging()
+            os._exit(1)
+
+    def _supervise(self, target, args):
+        while not self._stopping and (self._procs or self._restartAt):
+            timeout = 1.0
+            if self._restartAt:
+                timeout = max(0.0, min(min(self._restartAt.values()) - time.monotonic(), timeout))
+            sentinels = {proc.sentinel: index for index, proc in self._procs.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=timeout):
+                self._reap(sentinels[sentinel])
+            now = time.monotonic()
+            for index, due in list(self._restartAt.items()):
+                if due <= now and not self._stopping:
+                    del self._restartAt[index]
+                    self._spawn(index, target, args)
+
+    def _reap(self, index):
+        proc = self._procs.pop(index)
+        proc.join()
+        if self._stopping or proc.exitcode == 0:
+            log.info("Worker %d exited, code=%s", index, proc.exitcode)
+            return
+        lived = time.monotonic() - self._started[index]
+        if lived >= self.STABLE_AFTER:
+            self._backoff[index] = self.RESTART_BACKOFF
+        else:
+            self._backoff[index] = min(self._backoff.get(index, self.RESTART_BACKOFF / 2) * 2, self.MAX_RESTART_BACKOFF)
+        log.error("Worker %d crashed, code=%s, restarting in %.1fs", index, proc.exitcode, self._backoff[index])
+        self._restartAt[index] = time.monotonic() + self._backoff[index]
+
+    def _onSignal(self, signum, frame):
+        self._stopping = True
+
+    def shutdown(self, timeout=5.0):
+        self._stopping = True
+        self._restartAt.clear()
+        for proc in self._procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        deadline = time.monotonic() + timeout
+        for proc in self._procs.values():
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+        self._procs.clear()
@@ -1,60 +1,123 @@
 import asyncio
+import os
 import websockets
 import json
 import hmac
-import hashlib
-import base64
-import time
-import random
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
+from Websocket.route_peek import peekRequest
+from Websocket.nonce_store import getNonceStore, remoteHost
+from Websocket.device_secrets import getSecretTable
+from Websocket.registry import DeviceRegistry
+from Websocket.resumption import ResumptionTickets
+from Websocket.admission import AdmissionRejected, RegistrationAdmission
+from Websocket.routes import RouteTable
+from Websocket.keepalive import KeepAliveStage
+from Websocket.liveness import DeviceLivenessTracker
+from Websocket.worker_group import WorkerGroup
+from Websocket.log import getLogger
+from Websocket.metrics import startMetricsServer
+from Websocket.watchdog import startWatchdog
+
+log = getLogger("abin")
 
 class WebSocketHandler:
-    SECRET = "123456"
+    # Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+    secret_table = getSecretTable()
     LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
     LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
     LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+    keep_alive_stage = KeepAliveStage()
+    # Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+    nonce_store = getNonceStore()
+    # Lets a registered device reconnect in one round trip (LAPI_TICKET_KEY, LAPI_TICKET_LIFETIME)
+    resumption_tickets = ResumptionTickets()
+    # Registered devices of this process by DeviceCode, Vendor, DeviceType and IP
+    device_registry = DeviceRegistry()
+    # Missed-heartbeat detection by DeviceCode, a silent device's connection is closed
+    liveness = DeviceLivenessTracker()
+    liveness.addListener(lambda event, key: log.info("Device liveness: %s", event, device=key))
+    # Paces Register storms per IP and overall, shed devices are told to come back later
+    register_admission = RegistrationAdmission()
+    # Connection paths and frame RequestURLs, each resolved with one dict lookup
+    http_routes = RouteTable()
+    frame_routes = RouteTable()
 
     def __init__(self):
-        self.keep_alive_executor = ThreadPoolExecutor(max_workers=3)
+        self.device_code = None
+        self.close_connection = None
+        # True from a successful Register until the device's keepalive connection takes over
+        self.awaiting_keepalive = False
+        # Ticket this Register returned, the keepalive connection presents it to take over
+        self.keepalive_ticket = None
 
     async def channelRead(self, websocket, path):
         try:
-            print(f"New connection from {websocket.remote_address}")
+            log.debug("New connection", route=path, remote=websocket.remote_address)
             
             if not path:
-                print(f"Invalid WebSocket request: Missing path from {websocket.remote_address}")
+                log.warning("Invalid WebSocket request: Missing path", remote=websocket.remote_address)
                 await websocket.close(code=4001, reason="Invalid request path")
                 return
 
-            parsed_url = urllib.parse.urlparse(path)
-            valid_paths = [self.LAPI_REGISTER, self.LAPI_KEEPALIVE, self.LAPI_UNREGISTER]
-            
-            if parsed_url.path not in valid_paths:
-                print(f"Invalid path {parsed_url.path} from {websocket.remote_address}")
+            match = self.http_routes.match(path)
+            if match is None:
+                log.warning("Invalid path", route=path, remote=websocket.remote_address)
                 await websocket.close(code=4002, reason="Invalid path")
                 return
-            
-            if parsed_url.path == self.LAPI_REGISTER:
-                await self.handle_http_register(websocket)
-            elif parsed_url.path.startswith(self.LAPI_REGISTER):
-                query_params = urllib.parse.parse_qs(parsed_url.query)
-                await self.handle_http_register_vendor(websocket, query_params)
-            else:
-                async for message in websocket:
-                    await self.handleWebSocketRequest(websocket, message)
+
+            await match.handler(self, websocket, match)
         
         except websockets.exceptions.ConnectionClosedError as e:
-            print(f"Connection closed abruptly: {e}")
+            log.info("Connection closed abruptly: %s", e)
         except Exception as e:
             self.exceptionCaught(websocket, e)
         finally:
             self.handlerRemoved(websocket)
 
+    @http_routes.route(LAPI_REGISTER)
+    async def on_register_path(self, websocket, match):
+        if not await self.admit_registration(websocket):
+            return
+        query_params = match.parameters()
+        if "Ticket" in query_params:
+            await self.handle_resumption(websocket, query_params)
+        elif "Vendor" in query_params:
+            await self.handle_http_register_vendor(websocket, query_params)
+        else:
+            await self.handle_http_register(websocket)
+
+    @http_routes.route(LAPI_KEEPALIVE)
+    @http_routes.route(LAPI_UNREGISTER)
+    async def on_message_path(self, websocket, match):
+        if not self.bind_device(websocket, match):
+            await websocket.close(code=4003, reason="Unregistered device")
+            return
+        async for message in websocket:
+            await self.handleWebSocketRequest(websocket, message)
+
     async def handle_http_register(self, websocket):
-        response_body = json.dumps({"Nonce": self.getCnonce()})
+        response_body = json.dumps({"Nonce": self.new_nonce(websocket)})
         await websocket.send(response_body)
-        print(f"Sent initial registration challenge to {websocket.remote_address}")
+        log.info("Sent initial registration challenge", remote=websocket.remote_address)
+
+    async def handle_resumption(self, websocket, query_params):
+        """
+        Reconnect with a resumption ticket: admitted in one round trip with a fresh ticket,
+        an invalid or expired one gets the Nonce challenge instead.
+        """
+        device_code = query_params.get("DeviceCode", [""])[0]
+        claims = self.resumption_tickets.verify(query_params["Ticket"][0], device_code)
+        if claims is None:
+            log.info("Resumption ticket rejected, full registration required",
+                     device=device_code, remote=websocket.remote_address)
+            await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, device_code)}))
+            return
+        log.info("Device resumed its session", device=claims.deviceCode, remote=websocket.remote_address)
+        ticket = self.resumption_tickets.issue(claims.deviceCode, claims.vendor, claims.deviceType)
+        await websocket.send(json.dumps({"Ticket": ticket}))
+        self.register_device(websocket, claims.deviceCode, claims.vendor, claims.deviceType)
+        self.await_keepalive(ticket)
+        self.handlerAdded(websocket)
 
     async def handle_http_register_vendor(self, websocket, query_params):
         try:
@@ -67,100 +130,216 @@ class WebSocketHandler:
             Sign = query_params.get("Sign", [None])[0]
 
             if None in (Vendor, DeviceType, DeviceCode, Algorithm, Nonce, Sign):
-                print("Missing parameters in registration request")
+                log.warning("Missing parameters in registration request", remote=websocket.remote_address)
                 await websocket.close(code=4000, reason="Missing parameters")
                 return
 
+            # The Nonce must be one this server issued to the device and not used yet
+            if not self.nonce_store.consume(remoteHost(websocket.remote_address), Nonce, DeviceCode):
+                log.warning("Unknown or expired Nonce: %s", Nonce, device=DeviceCode, remote=websocket.remote_address)
+                await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, DeviceCode)}))
+                return
+            # The challenge paid for this registration, a made-up Nonce keeps costing its IP
+            self.register_admission.refund(remoteHost(websocket.remote_address))
+
             decoded_url = urllib.parse.unquote(Sign).replace(" ", "+")
-            pstr = f"{Vendor}/{DeviceType}/{DeviceCode}/{Algorithm}/{Nonce}"
 
-            sha256_HMAC = hmac.new(self.SECRET.encode(), pstr.encode(), hashlib.sha256)
-            encodeStr = base64.b64encode(sha256_HMAC.digest()).decode()
+            encodeStr = self.secret_table.sign(Vendor, DeviceType, DeviceCode, Algorithm, Nonce)
 
             if not hmac.compare_digest(encodeStr, decoded_url):
-                print("Authentication failed")
-                await websocket.send(json.dumps({"Nonce": self.getCnonce()}))
+                log.warning("Authentication failed", device=DeviceCode, remote=websocket.remote_address)
+                await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, DeviceCode)}))
                 return
 
-            print("Authentication successful")
-            await websocket.send(json.dumps({"Cnonce": Cnonce, "Resign": encodeStr}))
+            log.info("Authentication successful", device=DeviceCode, remote=websocket.remote_address)
+            ticket = self.resumption_tickets.issue(DeviceCode, Vendor, DeviceType)
+            await websocket.send(json.dumps({"Cnonce": Cnonce, "Resign": encodeStr, "Ticket": ticket}))
+            self.register_device(websocket, DeviceCode, Vendor, DeviceType)
+            self.await_keepalive(ticket)
             self.handlerAdded(websocket)
         except Exception as e:
-            print(f"Error during vendor registration: {e}")
+            log.exception("Error during vendor registration", remote=websocket.remote_address)
             await websocket.close(code=5000, reason="Internal server error")
 
     async def handleWebSocketRequest(self, websocket, message):
         try:
-            jsonObject = json.loads(message)
-            request_url = jsonObject.get("requestURL")
-
-            if request_url == self.LAPI_KEEPALIVE:
-                print(f"Received keep-alive request: {request_url}")
-                asyncio.create_task(self.keep_alive_task(websocket, jsonObject))
-            elif request_url == self.LAPI_UNREGISTER:
-                print(f"Device {websocket.remote_address} disconnected")
-                await websocket.close()
+            websocketReq = peekRequest(message)
+            request_url = websocketReq.RequestURL
+
+            match = self.frame_routes.match(request_url)
+            if match is None:
+                log.warning("Unknown request", route=request_url, remote=websocket.remote_address)
             else:
-                print(f"Unknown request: {request_url}")
+                await match.handler(self, websocket, websocketReq)
         except json.JSONDecodeError:
-            print("Invalid JSON received")
+            log.warning("Invalid JSON received")
         except Exception as e:
             self.exceptionCaught(websocket, e)
 
-    async def keep_alive_task(self, websocket, jsonObject):
+    @frame_routes.route(LAPI_KEEPALIVE)
+    async def on_keepalive(self, websocket, websocketReq):
+        log.info("Received keep-alive request",
+                 route=websocketReq.RequestURL, cseq=websocketReq.Cseq, device=self.device_code, remote=websocket.remote_address)
+        if self.device_code is not None:
+            self.liveness.keepalive(self.device_code)
+        await self.keep_alive_task(websocket, websocketReq)
+
+    @frame_routes.route(LAPI_UNREGISTER)
+    async def on_unregister(self, websocket, websocketReq):
+        log.info("Device disconnected", remote=websocket.remote_address)
+        await websocket.close()
+
+    async def keep_alive_task(self, websocket, websocketReq):
         try:
-            print(f"Processing Keep-Alive from {websocket.remote_address}: {jsonObject}")
-            await asyncio.sleep(2)
-            print(f"Keep-Alive processing complete for {websocket.remote_address}")
+            await self.keep_alive_stage.handle(websocket.send, websocketReq)
         except Exception as e:
-            print(f"Error during keep-alive processing {websocket.remote_address}: {e}")
+            log.error("Error during keep-alive processing: %s", e, remote=websocket.remote_address)
 
     def handlerAdded(self, websocket):
-        print(f"{websocket.remote_address} Device connected")
+        log.info("Device connected", remote=websocket.remote_address)
         self.channelActive(websocket)
 
     def handlerRemoved(self, websocket):
-        print(f"{websocket.remote_address} Device removed")
+        log.info("Device removed", remote=websocket.remote_address)
+        # A Register connection closes before the keepalive one opens, the device stays registered in between
+        if self.device_code is not None and not self.awaiting_keepalive:
+            self.device_registry.remove(self.device_code, websocket)
+            # A no-op when the device already reconnected on another connection
+            self.liveness.remove(self.device_code, self.close_connection)
         self.channelInactive(websocket)
 
     def channelActive(self, websocket):
-        print(f"Client joined connection: {websocket.remote_address}")
+        log.debug("Client joined connection", remote=websocket.remote_address)
 
     def channelInactive(self, websocket):
-        print(f"Client disconnected: {websocket.remote_address}")
+        log.debug("Client disconnected", remote=websocket.remote_address)
 
     def exceptionCaught(self, websocket, error):
-        print(f"Exception occurred: {error}")
+        log.error("Exception occurred: %s", error, exc_info=error, remote=websocket.remote_address)
+        asyncio.create_task(websocket.close())
+
+    def register_device(self, websocket, device_code, vendor, device_type):
+        """
+        Indexes the registered device by DeviceCode; a previous connection of the same device is stale and closed.
+        """
+        if self.device_code is not None and self.device_code != device_code:
+            self.device_registry.remove(self.device_code, websocket)
+            self.liveness.remove(self.device_code, self.close_connection)
+        self.device_code = device_code
+        if self.close_connection is None:
+            self.close_connection = lambda: self.expire(websocket)
+        self.liveness.register(device_code, self.close_connection)
+        previous = self.device_registry.add(device_code, websocket, vendor, device_type, websocket.remote_address, self)
+        if previous is not None:
+            log.info("Device reconnected, closing its old connection from %s:%s", previous.ip, previous.port,
+                     device=device_code, remote=websocket.remote_address)
+            asyncio.create_task(previous.connection.close())
+
+    def await_keepalive(self, ticket):
+        """
+        Keeps the device registered after this Register connection closes, until a keepalive
+        connection presents the ticket it was just given.
+        """
+        self.awaiting_keepalive = True
+        self.keepalive_ticket = ticket
+
+    def bind_device(self, websocket, match):
+        """
+        Ties a keepalive connection to its device. It must carry the DeviceCode and the Ticket
+        its Register returned, and the device must still be waiting for that connection.
+        False for anything else, the connection is then refused.
+        """
+        query_params = match.parameters()
+        device_code = query_params.get("DeviceCode", [None])[0]
+        ticket = query_params.get("Ticket", [None])[0]
+        session = self.device_registry.get(device_code) if device_code and ticket else None
+        handler = session.handler if session is not None else None
+        if handler is None or not handler.awaiting_keepalive or handler.keepalive_ticket is None \
+                or not hmac.compare_digest(handler.keepalive_ticket.encode(), ticket.encode()):
+            log.warning("Keepalive connection without a valid Register ticket",
+                        device=device_code, remote=websocket.remote_address)
+            return False
+        # Single use, the device registers again for another keepalive connection
+        handler.awaiting_keepalive = False
+        handler.keepalive_ticket = None
+        self.register_device(websocket, session.deviceCode, session.vendor, session.deviceType)
+        return True
+
+    def expire(self, websocket):
+        """
+        Liveness timeout: closes the connection, and unregisters a device that never opened its keepalive one.
+        """
+        if self.awaiting_keepalive:
+            self.awaiting_keepalive = False
+            self.keepalive_ticket = None
+            self.device_registry.remove(self.device_code, websocket)
         asyncio.create_task(websocket.close())
 
-    def getCnonce(self):
-        return str(int(random.random() * time.time()))
+    async def admit_registration(self, websocket):
+        """
+        Waits for a registration slot. A shed device is closed with 1013 Try Again Later.
+        """
+        try:
+            await self.register_admission.acquire(remoteHost(websocket.remote_address))
+            return True
+        except AdmissionRejected as e:
+            log.warning("Registration shed: %s", e, remote=websocket.remote_address)
+            await websocket.close(code=1013, reason=f"Try again in {e.retryAfter}s")
+            return False
+
+    def new_nonce(self, websocket, device_code=""):
+        """
+        Issues a challenge Nonce and remembers it for the device's IP (and DeviceCode once known).
+        """
+        return self.nonce_store.issue(remoteHost(websocket.remote_address), device_code)
     
 
 
     
-async def websocket_server(ip, port):
+async def websocket_server(ip, port, reuse_port=False):
     """
     Runs the WebSocket server.
     """
-    print(f"Starting WebSocket server on {ip}:{port}...")
+    log.info("Starting WebSocket server on %s:%s...", ip, port)
 
     async def handler(websocket, path=None):  # 🔹 Allow path to be optional
         websocket_handler = WebSocketHandler()
+        # websockets 13+ no longer passes the path, it is on the handshake request
+        path = path or getattr(websocket, "path", None) or websocket.request.path
         await websocket_handler.channelRead(websocket, path if path else "/")  # 🔹 Ensure path is always a string
 
+    # Pick up edits to the secrets file without blocking the loop
+    secret_table = WebSocketHandler.secret_table
+    watcher = asyncio.create_task(secret_table.watch()) if secret_table.path else None
+    # Keep alive and executor metrics on GET /metrics (LAPI_METRICS_PORT, 0 disables)
+    await startMetricsServer()
+    # Reports callbacks that block the loop, on /metrics and /debug/stalls (LAPI_WATCHDOG_THRESHOLD)
+    startWatchdog()
+
     try:
-        server = await websockets.serve(handler, ip, port)  # 🔹 Ensure correct parameters
-        print(f"WebSocket server started on {ip}:{port}")
+        server = await websockets.serve(handler, ip, port, reuse_port=reuse_port)  # 🔹 Ensure correct parameters
+        log.info("WebSocket server started on %s:%s", ip, port)
         await server.wait_closed()  # 🔹 Keep the server running
     except OSError as e:
-        print(f"WebSocket server failed to start: {e}")
+        log.error("WebSocket server failed to start: %s", e)
     except Exception as e:
-        print(f"Unexpected error occurred: {e}")
+        log.exception("Unexpected error occurred")
     finally:
-        print("WebSocket Server closed.")
+        if watcher is not None:
+            watcher.cancel()
+        log.info("WebSocket Server closed.")
+
+def serve(ip, port, reuse_port=False):
+    """
+    Runs one server process with its own event loop.
+    """
+    asyncio.run(websocket_server(ip, port, reuse_port))
 
 if __name__ == "__main__":
     IP = "localhost"
     PORT = 9090
-    asyncio.run(websocket_server(IP, PORT))
+    WORKERS = int(os.environ.get("LAPI_WORKERS", "1"))  # processes sharing the port via SO_REUSEPORT
+    if WORKERS > 1:
+        WorkerGroup(WORKERS).run(serve, IP, PORT, True)
+    else:
+        serve(IP, PORT)
@@ -0,0 +1,389 @@
+"""
+Camera fleet simulator: N devices against a running LAPI server, for sizing it before a rollout.
+
+    python -m benchmarks.fleet --url ws://127.0.0.1:8080 --devices 5000 --ramp 60 --duration 300
+
+Every camera performs the real two-step Register: a bare GET answered with a 401 Nonce
+challenge, then the WebSocket upgrade carrying Vendor, DeviceType, DeviceCode, Algorithm,
+Nonce and the HMAC Sign. It then sends keepalives with an incrementing Cseq every
+--keepalive seconds (+/- --jitter) and waits for each reply. At the end a camera
+unregisters, or with probability --drop-ratio just drops its connection.
+
+Load shapes: --ramp spreads the first connections over that many seconds (0 connects
+everyone at once); --storm-every drops every connection at once, periodically, and the
+fleet reconnects, with the resumption Ticket when --resume is given. Shed registrations
+(503 Retry-After or close 1013) are retried after the delay the server asked for.
+
+Handshake time, keepalive round trip and errors are reported every --report seconds and
+summarized at the end with p50/p90/p99. One IP is paced by the server's per-IP admission,
+--sources spreads the cameras over several local addresses (127.0.0.2-127.0.0.200).
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import quote, urlsplit
+
+import websockets
+
+from Websocket.device_secrets import DEFAULT_SECRET, DeviceSecret
+
+LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
+LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
+LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+ALGORITHM = "HmacSHA256"
+# Seconds to wait for a handshake step or a keepalive reply before counting a timeout
+REPLY_TIMEOUT = 10
+# Ceiling of the reconnect backoff after failures the server gave no Retry-After for
+MAX_BACKOFF = 30
+
+class FleetStats:
+    """
+    Samples and counters of the whole fleet, touched only from the simulator's loop.
+    """
+
+    def __init__(self):
+        self.handshakes = []   # seconds, challenge and upgrade together
+        self.resumptions = []  # seconds, ticket upgrades
+        self.keepalives = []   # round trip seconds
+        self.errors = Counter()
+        self.connected = 0
+        self.registered = 0
+        self.resumed = 0
+        self.sent = 0
+        self.unregistered = 0
+        self.dropped = 0
+        self.storms = 0
+
+    def progress(self, elapsed):
+        return ("%6.1fs connected=%d registered=%d resumed=%d keepalives=%d ka_p99=%s errors=%d" % (
+            elapsed, self.connected, self.registered, self.resumed, len(self.keepalives),
+            _ms(percentile(self.keepalives, 99)), sum(self.errors.values())))
+
+    def summary(self, elapsed):
+        lines = ["Fleet ran %.1fs: %d registered, %d resumed, %d keepalives (%.0f/s), %d unregistered, %d dropped, %d storms"
+                 % (elapsed, self.registered, self.resumed, len(self.keepalives), len(self.keepalives) / max(elapsed, 1e-9),
+                    self.unregistered, self.dropped, self.storms),
+                 "%-14s %8s %10s %10s %10s %10s" % ("", "samples", "p50", "p90", "p99", "max")]
+        for name, samples in (("handshake", self.handshakes), ("resumption", self.resumptions),
+                              ("keepalive rtt", self.keepalives)):
+            lines.append("%-14s %8d %10s %10s %10s %10s" % (
+                name, len(samples), _ms(percentile(samples, 50)), _ms(percentile(samples, 90)),
+                _ms(percentile(samples, 99)), _ms(max(samples) if samples else None)))
+        if self.errors:
+            lines.append("errors: " + ", ".join("%s=%d" % item for item in self.errors.most_common()))
+        return "\n".join(lines)
+
+class Shed(Exception):
+    def __init__(self, retryAfter):
+        super().__init__("shed, retry after %ss" % retryAfter)
+        self.retryAfter = retryAfter
+
+class Camera:
+    """
+    One simulated device: registers, heartbeats until the run ends or a storm hits, and
+    reconnects until the run is over.
+    """
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.config = fleet.config
+        self.deviceCode = "%s%07d" % (self.config.prefix, index)
+        self.source = fleet.sources[index % len(fleet.sources)] if fleet.sources else None
+        self.ticket = None
+        self.cseq = 0
+        self.websocket = None
+
+    async def run(self):
+        stats = self.fleet.stats
+        backoff = 1.0
+        while not self.fleet.finished.is_set():
+            try:
+                await self.connect()
+            except Shed as e:
+                stats.errors["shed"] += 1
+                await self.fleet.sleep(e.retryAfter * random.uniform(1, 1.5))
+                continue
+            except Exception as e:
+                stats.errors[_errorName(e)] += 1
+                await self.fleet.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            stats.connected += 1
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                stats.errors[_errorName(e)] += 1
+            finally:
+                stats.connected -= 1
+                await self.close()
+
+    async def connect(self):
+        if self.ticket and self.config.resume:
+            started = time.perf_counter()
+            try:
+                result = await self.upgrade({"DeviceCode": self.deviceCode, "Ticket": self.ticket})
+            except Rejected:
+                self.fleet.stats.errors["ticket_rejected"] += 1
+                self.ticket = None
+            else:
+                self.fleet.stats.resumptions.append(time.perf_counter() - started)
+                self.fleet.stats.resumed += 1
+                self.ticket = result.get("Ticket", self.ticket)
+                return
+        started = time.perf_counter()
+        nonce = await self.challenge()
+        sign = self.fleet.secret.sign(self.config.vendor, self.config.device_type, self.deviceCode, ALGORITHM, nonce)
+        result = await self.upgrade({
+            "Vendor": self.config.vendor, "DeviceType": self.config.device_type, "DeviceCode": self.deviceCode,
+            "Algorithm": ALGORITHM, "Nonce": nonce, "Cnonce": uuid.uuid4().hex, "Sign": sign,
+        })
+        if result.get("Resign") != sign:
+            raise Rejected("Resign mismatch")
+        self.fleet.stats.handshakes.append(time.perf_counter() - started)
+        self.fleet.stats.registered += 1
+        self.ticket = result.get("Ticket")
+
+    async def challenge(self):
+        """
+        First Register step, a bare GET answered with 401 {"Nonce": ...}.
+        """
+        url = self.fleet.url
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            url.hostname, url.port or 80, local_addr=(self.source, 0) if self.source else None), REPLY_TIMEOUT)
+        try:
+            writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                          % (LAPI_REGISTER, url.netloc, "dGhlIHNhbXBsZSBub25jZQ==")).encode("ascii"))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REPLY_TIMEOUT)
+            lines = head.decode("latin-1").split("\r\n")
+            status = int(lines[0].split()[1])
+            headers = {name.strip().lower(): value.strip() for name, _, value in
+                       (line.partition(":") for line in lines[1:] if line)}
+            if status == 503:
+                raise Shed(int(headers.get("retry-after", "1")))
+            body = await asyncio.wait_for(reader.readexactly(int(headers.get("content-length", "0"))), REPLY_TIMEOUT)
+            if status != 401:
+                raise Rejected("challenge status %d" % status)
+            return json.loads(body)["Nonce"]
+        finally:
+            writer.close()
+
+    async def upgrade(self, parameters):
+        """
+        WebSocket upgrade on Register with the given query, returns the first frame's JSON.
+        """
+        query = "&".join("%s=%s" % (name, quote(str(value), safe="")) for name, value in parameters.items())
+        try:
+            self.websocket = await websockets.connect(
+                "%s%s?%s" % (self.fleet.base, LAPI_REGISTER, query), open_timeout=REPLY_TIMEOUT, ping_interval=None,
+                compression=None, max_queue=4, local_addr=(self.source, 0) if self.source else None)
+        except Exception as e:
+            response = getattr(e, "response", None)
+            status = getattr(response, "status_code", None) or getattr(e, "status_code", None)
+            if status == 503:
+                headers = getattr(response, "headers", None) or getattr(e, "headers", {})
+                raise Shed(int(headers.get("Retry-After", "1")))
+            if status is not None:
+                raise Rejected("upgrade status %d" % status)
+            raise
+        try:
+            return json.loads(await asyncio.wait_for(self.websocket.recv(), REPLY_TIMEOUT))
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is not None and e.rcvd.code == 1013:
+                raise Shed(_retryAfter(e.rcvd.reason))
+            raise
+
+    async def heartbeat(self):
+        config = self.config
+        storm = self.fleet.storm
+        while True:
+            delay = config.keepalive * random.uniform(1 - config.jitter, 1 + config.jitter)
+            if await self.fleet.wait(storm, delay):
+                if self.fleet.finished.is_set():
+                    await self.leave()
+                else:
+                    # Reconnect storm: vanish without a close handshake, like a power cut
+                    self.fleet.stats.dropped += 1
+                    self.websocket.transport.abort()
+                return
+            self.cseq += 1
+            started = time.perf_counter()
+            await self.websocket.send(json.dumps({"RequestURL": LAPI_KEEPALIVE, "Method": "POST", "Cseq": self.cseq,
+                                                  "Data": {}}))
+            reply = json.loads(await asyncio.wait_for(self.websocket.recv(), REPLY_TIMEOUT))
+            if reply.get("Cseq") != self.cseq or reply.get("ResponseCode") != 0:
+                self.fleet.stats.errors["bad_keepalive_reply"] += 1
+            else:
+                self.fleet.stats.keepalives.append(time.perf_counter() - started)
+            self.fleet.stats.sent += 1
+
+    async def leave(self):
+        if random.random() < self.config.drop_ratio:
+            self.fleet.stats.dropped += 1
+            self.websocket.transport.abort()
+            return
+        self.cseq += 1
+        await self.websocket.send(json.dumps({"RequestURL": LAPI_UNREGISTER, "Method": "POST", "Cseq": self.cseq}))
+        self.fleet.stats.unregistered += 1
+
+    async def close(self):
+        websocket, self.websocket = self.websocket, None
+        if websocket is not None:
+            try:
+                await asyncio.wait_for(websocket.close(), 2)
+            except Exception:
+                websocket.transport.abort()
+
+class Rejected(Exception):
+    pass
+
+class Fleet:
+    def __init__(self, config):
+        self.config = config
+        self.base = config.url.rstrip("/")
+        self.url = urlsplit(self.base)
+        self.secret = DeviceSecret(config.secret)
+        self.sources = _sources(config.sources)
+        self.stats = FleetStats()
+        self.finished = asyncio.Event()
+        self.storm = asyncio.Event()
+
+    async def sleep(self, delay):
+        await self.wait(self.finished, delay)
+
+    async def wait(self, event, delay):
+        """
+        True if event (or the end of the run) came first, False after delay seconds.
+        """
+        if event.is_set() or self.finished.is_set():
+            return True
+        waiters = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.finished.wait())]
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            return bool(done)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def run(self):
+        config = self.config
+        started = time.monotonic()
+        cameras = []
+        reporter = asyncio.ensure_future(self.report(started))
+        storms = asyncio.ensure_future(self.storms()) if config.storm_every else None
+        ramp = config.ramp / config.devices if config.ramp else 0
+        for index in range(config.devices):
+            cameras.append(asyncio.ensure_future(Camera(self, index).run()))
+            if ramp:
+                await asyncio.sleep(ramp)
+        await asyncio.sleep(max(config.duration - (time.monotonic() - started), 0))
+        self.finished.set()
+        await asyncio.gather(*cameras, return_exceptions=True)
+        reporter.cancel()
+        if storms is not None:
+            storms.cancel()
+        return time.monotonic() - started
+
+    async def storms(self):
+        while True:
+            await asyncio.sleep(self.config.storm_every)
+            self.stats.storms += 1
+            print("Reconnect storm: dropping %d connections" % self.stats.connected, file=sys.stderr)
+            # Cameras still heartbeating hold the old event, new connections wait on a fresh one
+            storm, self.storm = self.storm, asyncio.Event()
+            storm.set()
+
+    async def report(self, started):
+        while True:
+            await asyncio.sleep(self.config.report)
+            print(self.stats.progress(time.monotonic() - started), file=sys.stderr)
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.1fms" % (seconds * 1000)
+
+def _retryAfter(reason):
+    # "Try again in Ns" from the websockets based servers
+    digits = "".join(c for c in reason or "" if c.isdigit())
+    return int(digits) if digits else 1
+
+def _errorName(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, websockets.ConnectionClosed):
+        return "closed"
+    if isinstance(error, Rejected):
+        return "rejected"
+    if isinstance(error, OSError):
+        return "connect_failed"
+    return type(error).__name__
+
+def _sources(spec):
+    """
+    Local addresses from "a.b.c.d,a.b.c.e" or a range "a.b.c.d-a.b.c.e".
+    """
+    sources = []
+    for item in filter(None, (spec or "").split(",")):
+        first, _, last = item.partition("-")
+        if not last:
+            sources.append(first.strip())
+            continue
+        start, end = ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip())
+        sources.extend(str(ipaddress.ip_address(address)) for address in range(int(start), int(end) + 1))
+    return sources
+
+def _raiseFileLimit(devices):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = devices * 2 + 64
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fleet", description="Simulate a fleet of LAPI cameras.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8080", help="server base URL")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="seconds before the fleet leaves")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which cameras first connect, 0 for all at once")
+    parser.add_argument("--keepalive", type=float, default=30, help="seconds between keepalives")
+    parser.add_argument("--jitter", type=float, default=0.1, help="keepalive interval jitter, as a fraction")
+    parser.add_argument("--storm-every", type=float, default=0, help="seconds between reconnect storms, 0 for none")
+    parser.add_argument("--resume", action="store_true", help="reconnect with the resumption Ticket")
+    parser.add_argument("--drop-ratio", type=float, default=0.0, help="share of cameras that drop instead of unregistering")
+    parser.add_argument("--sources", default="", help="local addresses to connect from, e.g. 127.0.0.2-127.0.0.200")
+    parser.add_argument("--secret", default=os.environ.get("LAPI_SECRET", DEFAULT_SECRET))
+    parser.add_argument("--vendor", default="Uniview")
+    parser.add_argument("--device-type", default="IPC")
+    parser.add_argument("--prefix", default="SIM", help="DeviceCode prefix, followed by the camera number")
+    parser.add_argument("--report", type=float, default=5, help="seconds between progress lines")
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    config = parseArgs(argv)
+    _raiseFileLimit(config.devices)
+
+    async def main():
+        fleet = Fleet(config)
+        elapsed = await fleet.run()
+        print(fleet.stats.summary(elapsed))
+
+    asyncio.run(main())
+
+if __name__ == "__main__":
+    run()
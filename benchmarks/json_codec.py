@@ -0,0 +1,62 @@
+"""
+JSON codec throughput for the LAPI message mix, for every backend installed here.
+
+    python -m benchmarks.json_codec [messages]
+
+Select the backend used by the servers with LAPI_JSON_CODEC=json|orjson|msgspec|ujson.
+"""
+import json
+import sys
+import time
+
+from Websocket.json_codec import CODECS
+from Websocket.keepalive import keepAliveResponse
+from Websocket.route_peek import peekRequest
+
+# Weighted like production traffic: heartbeats dominate, events are rare but large
+MIX = [
+    (80, json.dumps({"RequestURL": "/LAPI/V1.0/System/UpServer/Keepalive", "Method": "POST", "Cseq": 1024, "Data": {}})),
+    (10, json.dumps({"requestURL": "/LAPI/V1.0/System/UpServer/Keepalive", "Cseq": 7})),
+    (5, json.dumps({"RequestURL": "/LAPI/V1.0/System/UpServer/Unregister", "Method": "POST", "Cseq": 9, "Data": None})),
+    (5, json.dumps({
+        "RequestURL": "/LAPI/V1.0/System/Event/Notification/Alarm", "Method": "POST", "Cseq": 77,
+        "Data": {"AlarmType": "MotionDetectOn", "TimeStamp": 1741158917, "Seq": 3,
+                 "Objects": [{"Id": i, "Rect": [i, i + 10, i + 20, i + 30], "Score": 0.93} for i in range(40)]},
+    })),
+]
+
+def messages(count):
+    total = sum(weight for weight, _ in MIX)
+    out = []
+    for weight, text in MIX:
+        out.extend([text] * (count * weight // total))
+    return out
+
+def bench(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return len(items) / (time.perf_counter() - start)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    texts = messages(count)
+    frames = [text.encode("utf-8") for text in texts]
+    responses = [keepAliveResponse(i) for i in range(len(texts))]
+
+    print(f"{len(texts)} messages per run, best of 3, messages/s")
+    print(f"{'backend':<10}{'loads(str)':>14}{'loads(bytes)':>14}{'decodeRequest':>15}{'peekRequest':>14}{'dumps':>12}")
+    for name, codecClass in CODECS.items():
+        codec = codecClass()
+        row = [
+            max(bench(codec.loads, texts) for _ in range(3)),
+            max(bench(codec.loads, frames) for _ in range(3)),
+            max(bench(codec.decodeRequest, frames) for _ in range(3)),
+            # Routing only: heartbeats never reach the JSON decoder
+            max(bench(lambda frame: peekRequest(frame, codec), frames) for _ in range(3)),
+            max(bench(codec.dumps, responses) for _ in range(3)),
+        ]
+        print(f"{name:<10}" + "".join(f"{value:>14,.0f}" for value in row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Keep alive response microbenchmark: json.dumps per heartbeat vs the pre-rendered template.
+
+    python -m benchmarks.keepalive_template [iterations]
+"""
+import json
+import sys
+import time
+import timeit
+from dataclasses import asdict, dataclass
+
+from Websocket.keepalive import KeepAliveResponseTemplate, keepAliveResponse
+
+# Same shapes demo.py builds for every heartbeat
+@dataclass
+class KeepAliveRspAO:
+    Timestamp: int
+    Timeout: int
+
+@dataclass
+class WebsocketRsp:
+    ResponseURL: str
+    ResponseCode: int
+    ResponseString: str
+    Cseq: int
+    Data: KeepAliveRspAO
+
+def dictDumps(cseq):
+    return json.dumps(keepAliveResponse(cseq))
+
+def dataclassDumps(cseq):
+    response = WebsocketRsp("/LAPI/V1.0/System/UpServer/Keepalive", 0, "Succeed", cseq,
+                            KeepAliveRspAO(int(time.time()), 60))
+    return json.dumps(asdict(response))
+
+template = KeepAliveResponseTemplate.get()
+
+def templateText(cseq):
+    return template.renderText(cseq)
+
+def templateBytes(cseq):
+    return template.render(cseq)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    # Every path must produce the same document
+    reference = json.loads(dictDumps(42))
+    for fn in (dataclassDumps, templateText, templateBytes):
+        assert json.loads(fn(42)) == reference, fn.__name__
+
+    results = []
+    for fn in (dictDumps, dataclassDumps, templateText, templateBytes):
+        best = min(timeit.repeat(lambda: fn(12345), number=iterations, repeat=5))
+        results.append((fn.__name__, best / iterations * 1e9))
+    baseline = results[0][1]
+    print(f"{'path':<16}{'ns/op':>10}{'speedup':>10}")
+    for name, ns in results:
+        print(f"{name:<16}{ns:>10.0f}{baseline / ns:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Register Sign verification: a fresh hmac.new per request vs the pre-keyed copy kept by
+SecretTable, and verifyBatch over captured registrations.
+
+    python -m benchmarks.register_sign [registrations]
+"""
+import base64
+import hashlib
+import hmac
+import sys
+import time
+
+from Websocket.device_secrets import SecretTable, signMessage
+
+def registrations(table, count):
+    out = []
+    for i in range(count):
+        fields = ("Uniview", "IPC", "210235C3%06d" % i, "HMAC-SHA256", "%032x" % i)
+        out.append(fields + (table.sign(*fields),))
+    return out
+
+def rebuild(table, captured):
+    # What the handlers did before: derive the key pads again for every request
+    secret = table.default.encode("utf-8")
+    for vendor, deviceType, deviceCode, algorithm, nonce, sign in captured:
+        digest = hmac.new(secret, signMessage(vendor, deviceType, deviceCode, algorithm, nonce), hashlib.sha256).digest()
+        hmac.compare_digest(base64.b64encode(digest).decode("utf-8"), sign)
+
+def cached(table, captured):
+    for registration in captured:
+        table.verify(*registration)
+
+def bench(fn, table, captured):
+    start = time.perf_counter()
+    fn(table, captured)
+    return len(captured) / (time.perf_counter() - start)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    table = SecretTable()
+    captured = registrations(table, count)
+    assert all(table.verifyBatch(captured))
+
+    print(f"{count} registrations per run, best of 3, verifications/s")
+    for name, fn in (("hmac.new", rebuild), ("verify", cached), ("verifyBatch", SecretTable.verifyBatch)):
+        print(f"{name:<14}{max(bench(fn, table, captured) for _ in range(3)):>14,.0f}")
+
+if __name__ == "__main__":
+    main()
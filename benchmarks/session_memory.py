@@ -0,0 +1,107 @@
+"""
+Memory per idle registered connection of the Netty-style server, measured with tracemalloc.
+
+    python -m benchmarks.session_memory [devices ...]
+
+Every simulated device is a SocketChannel on a fake transport that resumes a session with
+a ticket through the real handshake path: pipeline, handlers, handshaker, admission
+bucket, registry session and liveness entry are all counted, the transport is not.
+Exits with status 1 when a run needs more than BYTES_PER_DEVICE_BUDGET bytes per device.
+"""
+import asyncio
+import gc
+import sys
+import tracemalloc
+
+from Websocket.admission import RegistrationAdmission
+from Websocket.log import setupLogging
+from Websocket.outbound import outboundLimits
+from Websocket.websocket import ChannelInitializer, ChannelOption, SocketChannel, Websocket
+from Websocket.WebSocketHandler import WebSocketHandler
+
+DEVICES = (1000, 10000, 50000)
+# Raise only together with a change that has to cost memory per connection
+BYTES_PER_DEVICE_BUDGET = 2300
+
+class FakeTransport:
+    __slots__ = ("peername", "closed")
+
+    def __init__(self, peername):
+        self.peername = peername
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == "peername" else default
+
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+def resumeRequest(deviceCode):
+    ticket = WebSocketHandler.engine.resumptionTickets.issue(deviceCode, "Uniview", "IPC")
+    return ("GET /LAPI/V1.0/System/UpServer/Register?DeviceCode=%s&Ticket=%s HTTP/1.1\r\n"
+            "Host: lapi\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+            % (deviceCode, ticket)).encode("ascii")
+
+async def measure(count, childHandler, childOptions):
+    transports = [FakeTransport(("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), 40000 + i % 20000))
+                  for i in range(count)]
+    requests = [resumeRequest("BENCH%07d" % i) for i in range(count)]
+    channels = []
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    for transport, request in zip(transports, requests):
+        channel = SocketChannel(childHandler, childOptions)
+        channel.connection_made(transport)
+        channel.data_received(request)
+        channels.append(channel)
+    # Let the deferred flushes of the handshake responses run
+    await asyncio.sleep(0)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    registered = len(WebSocketHandler.engine.deviceRegistry)
+    perDevice = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / count
+    for channel in channels:
+        channel.connection_lost(None)
+    return perDevice, registered
+
+async def main(counts):
+    # Measure the steady state, not the pacing of a reconnect storm
+    WebSocketHandler.engine.registerAdmission = RegistrationAdmission(rate=1e9, burst=1e9, ipRate=1e9, ipBurst=1e9)
+    # Queued log events would be counted as connection memory
+    setupLogging(level="WARNING")
+    childHandler = ChannelInitializer(Websocket.initChannel)
+    childOptions = {ChannelOption.WRITE_BUFFER_WATER_MARK: outboundLimits()}
+    tracemalloc.start()
+    results = []
+    for count in counts:
+        perDevice, registered = await measure(count, childHandler, childOptions)
+        results.append((count, registered, perDevice))
+    tracemalloc.stop()
+    return results
+
+def run():
+    counts = [int(arg) for arg in sys.argv[1:]] or DEVICES
+    results = asyncio.run(main(counts))
+    print(f"{'devices':>8}{'registered':>12}{'bytes/device':>14}   budget {BYTES_PER_DEVICE_BUDGET}")
+    failed = False
+    for count, registered, perDevice in results:
+        over = perDevice > BYTES_PER_DEVICE_BUDGET or registered != count
+        failed = failed or over
+        print(f"{count:>8}{registered:>12}{perDevice:>14,.0f}" + ("   REGRESSION" if over else ""))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    run()
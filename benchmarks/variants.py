@@ -0,0 +1,463 @@
+"""
+The same scripted workload against every server implementation in the repository, one
+after the other on localhost, for a comparable report.
+
+    python -m benchmarks.variants [--variants netty,wbs,...] [--duration 5] [--concurrency 32] [--connections 200]
+
+Each variant is started in its own process with logging at WARNING, metrics off and
+registration admission unlimited (the benchmark measures the handlers, not the pacing),
+then driven through three phases:
+
+    challenge   first Register step only, a new connection per request
+    register    challenge then the signed Register, a new connection per request
+    keepalive   --connections registered devices heartbeating back to back
+
+Reported per variant: operations/s and p99 latency of every phase, peak RSS and
+thread count of the server process (from /proc, Linux only) and errors by kind. The
+*-workers variants run two SO_REUSEPORT workers, so Register only passes when a challenge
+issued by one worker verifies on the other; their RSS and threads are the supervisor's.
+
+The variants do not speak quite the same dialect of the protocol, each is driven the way
+its handlers expect:
+
+    netty   Websocket/websocket.py and the engine's websockets and aiohttp transports
+            (Websocket/transports.py): 401 Nonce over HTTP, signed WebSocket upgrade, frames on it
+    frames  wbs.py: Register steps as frames, RequestURL carrying the query, one connection
+    paths   abin.py, websockethandel.py, test3.py: one WebSocket per Register step, heartbeats
+            on a separate connection to the Keepalive path, carrying the DeviceCode and the
+            Ticket the Register returned
+    http    demo.py, demo1.py, demo2.py: both Register steps over HTTP, heartbeats on /ws
+
+Client and server share the machine, so absolute numbers are a floor; the ranking is what
+this is for. Keep --concurrency the same between runs that are compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from urllib.parse import quote
+
+import websockets
+
+from benchmarks.fleet import percentile
+from Websocket.device_secrets import DEFAULT_SECRET, DeviceSecret
+
+LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
+LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
+ALGORITHM = "HmacSHA256"
+VENDOR = "Uniview"
+DEVICE_TYPE = "IPC"
+REPLY_TIMEOUT = 10
+# Seconds a variant gets to start listening
+START_TIMEOUT = 15
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_UNLIMITED = ("from Websocket.admission import RegistrationAdmission\n"
+              "unlimited = RegistrationAdmission(rate=1e9, burst=1e9, ipRate=1e9, ipBurst=1e9)\n"
+              "host, port = sys.argv[1], int(sys.argv[2])\n")
+
+# name -> (dialect, server code run with host and port as argv)
+VARIANTS = {
+    "netty": ("netty", "from Websocket.engine import ENGINE\n"
+                       "ENGINE.registerAdmission = unlimited\n"
+                       "from Websocket.transports import serve\n"
+                       "serve(host, port, backend='native')\n"),
+    "engine-websockets": ("netty", "from Websocket.engine import ENGINE\n"
+                                   "ENGINE.registerAdmission = unlimited\n"
+                                   "from Websocket.transports import serve\n"
+                                   "serve(host, port, backend='websockets')\n"),
+    "engine-aiohttp": ("netty", "from Websocket.engine import ENGINE\n"
+                                "ENGINE.registerAdmission = unlimited\n"
+                                "from Websocket.transports import serve\n"
+                                "serve(host, port, backend='aiohttp')\n"),
+    # Two SO_REUSEPORT workers: a challenge and its signed Register land on either one
+    "netty-workers": ("netty", "from Websocket.engine import ENGINE\n"
+                               "ENGINE.registerAdmission = unlimited\n"
+                               "from Websocket.transports import serve\n"
+                               "serve(host, port, 2, backend='native')\n"),
+    "websockets-workers": ("netty", "from Websocket.engine import ENGINE\n"
+                                    "ENGINE.registerAdmission = unlimited\n"
+                                    "from Websocket.transports import serve\n"
+                                    "serve(host, port, 2, backend='websockets')\n"),
+    "wbs": ("frames", "import wbs\n"
+                      "wbs.register_admission = unlimited\n"
+                      "wbs.serve(host, port)\n"),
+    "abin": ("paths", "import abin\n"
+                      "abin.WebSocketHandler.register_admission = unlimited\n"
+                      "abin.serve(host, port)\n"),
+    "websockethandel": ("paths", "import websockethandel\n"
+                                 "websockethandel.WebSocketHandler.register_admission = unlimited\n"
+                                 "websockethandel.serve(host, port)\n"),
+    "test3": ("paths", "import asyncio, test3\n"
+                       "asyncio.run(test3.websocket_server(host, port))\n"),
+    "demo": ("http", "import demo\n"
+                     "from aiohttp import web\n"
+                     "web.run_app(demo.app, host=host, port=port, print=None)\n"),
+    "demo1": ("http", "import demo1\n"
+                      "from aiohttp import web\n"
+                      "web.run_app(demo1.app, host=host, port=port, print=None)\n"),
+    "demo2": ("http", "import demo2\n"
+                      "demo2.serve(host, port)\n"),
+}
+
+class Failed(Exception):
+    pass
+
+class Client:
+    """
+    Register and keepalive steps of one dialect against one server.
+    """
+
+    def __init__(self, dialect, host, port, secret):
+        self.dialect = dialect
+        self.host = host
+        self.port = port
+        self.base = "ws://%s:%d" % (host, port)
+        self.secret = DeviceSecret(secret)
+        self.devices = 0
+
+    async def challenge(self):
+        """
+        First Register step, returns the Nonce.
+        """
+        if self.dialect in ("netty", "http"):
+            status, _, body = await httpGet(self.host, self.port, LAPI_REGISTER)
+            if status != 401:
+                raise Failed("challenge_status_%d" % status)
+            return json.loads(body)["Nonce"]
+        if self.dialect == "frames":
+            async with self.connect("/") as websocket:
+                return await self.frameChallenge(websocket)
+        async with self.connect(LAPI_REGISTER) as websocket:
+            return _nonce(await _recv(websocket))
+
+    async def register(self, keep=False):
+        """
+        Both Register steps for a new device. With keep, returns the connection its
+        heartbeats go on, already open.
+        """
+        deviceCode = "BENCH%08d" % self.devices
+        self.devices += 1
+        if self.dialect == "frames":
+            websocket = await self.connect("/")
+            try:
+                nonce = await self.frameChallenge(websocket)
+                await websocket.send(json.dumps({"RequestURL": self.signedTarget(deviceCode, nonce), "Method": "GET"}))
+                self.checkResign(await _recv(websocket))
+            except BaseException:
+                await _close(websocket)
+                raise
+            if keep:
+                return websocket
+            await _close(websocket)
+            return None
+        nonce = await self.challenge()
+        target = self.signedTarget(deviceCode, nonce)
+        if self.dialect == "netty":
+            websocket = await self.connect(target)
+            try:
+                self.checkResign(await _recv(websocket))
+            except BaseException:
+                await _close(websocket)
+                raise
+            if keep:
+                return websocket
+            await _close(websocket)
+            return None
+        if self.dialect == "paths":
+            async with self.connect(target) as websocket:
+                reply = await _recv(websocket)
+                self.checkResign(reply)
+            if not keep:
+                return None
+            # abin binds the keepalive connection to the device with the Ticket its Register returned
+            ticket = json.loads(reply).get("Ticket")
+            query = "?DeviceCode=%s&Ticket=%s" % (quote(deviceCode, safe=""), quote(ticket, safe="")) if ticket else ""
+            return await self.connect(LAPI_KEEPALIVE + query)
+        status, _, body = await httpGet(self.host, self.port, target)
+        # demo1/demo2 answer with the Resign, demo upgrades straight away
+        if status == 200:
+            self.checkResign(body)
+        elif status != 101:
+            raise Failed("register_status_%d" % status)
+        return await self.connect("/ws") if keep else None
+
+    async def keepalive(self, websocket, cseq):
+        await websocket.send(json.dumps({"RequestURL": LAPI_KEEPALIVE, "Method": "POST", "Cseq": cseq, "Data": {}}))
+        reply = json.loads(await asyncio.wait_for(websocket.recv(), REPLY_TIMEOUT))
+        if reply.get("Cseq") != cseq:
+            raise Failed("keepalive_cseq")
+
+    async def frameChallenge(self, websocket):
+        await websocket.send(json.dumps({"RequestURL": LAPI_REGISTER, "Method": "GET"}))
+        return _nonce(await _recv(websocket))
+
+    def signedTarget(self, deviceCode, nonce):
+        sign = self.secret.sign(VENDOR, DEVICE_TYPE, deviceCode, ALGORITHM, nonce)
+        parameters = (("Vendor", VENDOR), ("DeviceType", DEVICE_TYPE), ("DeviceCode", deviceCode),
+                      ("Algorithm", ALGORITHM), ("Nonce", nonce), ("Cnonce", uuid.uuid4().hex), ("Sign", sign))
+        return LAPI_REGISTER + "?" + "&".join("%s=%s" % (name, quote(value, safe="")) for name, value in parameters)
+
+    def checkResign(self, message):
+        if "Resign" not in json.loads(message):
+            raise Failed("register_rejected")
+
+    def connect(self, target):
+        return websockets.connect(self.base + target, open_timeout=REPLY_TIMEOUT, close_timeout=1,
+                                  ping_interval=None, compression=None)
+
+class PhaseResult:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.latencies = []
+        self.errors = Counter()
+        self.elapsed = 0.0
+
+    def rate(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+class ProcessSampler:
+    """
+    Peak RSS and thread count of a process, read from /proc/<pid>/status.
+    """
+
+    def __init__(self, pid):
+        self.path = "/proc/%d/status" % pid
+        self.rss = None
+        self.threads = None
+
+    def sample(self):
+        try:
+            with open(self.path) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        self.rss = max(self.rss or 0, int(line.split()[1]) * 1024)
+                    elif line.startswith("Threads:"):
+                        self.threads = max(self.threads or 0, int(line.split()[1]))
+        except (OSError, ValueError):
+            pass
+
+    async def run(self, period=0.2):
+        while True:
+            self.sample()
+            await asyncio.sleep(period)
+
+async def runPhase(name, operation, workers, duration):
+    """
+    Closed loop: workers coroutines repeat operation() back to back for duration seconds.
+    """
+    result = PhaseResult(name)
+    deadline = time.perf_counter() + duration
+
+    async def worker(index):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(operation(index), REPLY_TIMEOUT)
+            except Exception as e:
+                result.errors[_errorName(e)] += 1
+                await asyncio.sleep(0.01)
+                continue
+            result.latencies.append(time.perf_counter() - started)
+            result.count += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(workers)))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+async def benchmark(name, dialect, port, config, sampler):
+    client = Client(dialect, "127.0.0.1", port, config.secret)
+    monitor = asyncio.ensure_future(sampler.run())
+    results = []
+    try:
+        results.append(await runPhase("challenge", lambda index: client.challenge(), config.concurrency, config.duration))
+        results.append(await runPhase("register", lambda index: client.register(), config.concurrency, config.duration))
+        sessions, failures = [], Counter()
+        for start in range(0, config.connections, config.concurrency):
+            opened = await asyncio.gather(*(client.register(keep=True) for _ in range(
+                min(config.concurrency, config.connections - start))), return_exceptions=True)
+            for session in opened:
+                if isinstance(session, BaseException):
+                    failures[_errorName(session)] += 1
+                else:
+                    sessions.append(session)
+        cseqs = [0] * len(sessions)
+
+        async def heartbeat(index):
+            cseqs[index] += 1
+            await client.keepalive(sessions[index], cseqs[index])
+
+        keepalive = await runPhase("keepalive", heartbeat, len(sessions), config.duration) if sessions \
+            else PhaseResult("keepalive")
+        keepalive.errors.update({"session_" + kind: count for kind, count in failures.items()})
+        results.append(keepalive)
+        await asyncio.gather(*(_close(session) for session in sessions))
+    finally:
+        monitor.cancel()
+        sampler.sample()
+    return results
+
+def startVariant(name, port, logFile):
+    dialect, code = VARIANTS[name]
+    env = dict(os.environ, LAPI_LOG_LEVEL="WARNING", LAPI_METRICS_PORT="0", LAPI_WORKERS="1",
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    return subprocess.Popen([sys.executable, "-c", "import sys\n" + _UNLIMITED + code, "127.0.0.1", str(port)],
+                            cwd=ROOT, env=env, stdout=logFile, stderr=subprocess.STDOUT)
+
+def stopVariant(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def waitListening(process, port):
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def freePort():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def runVariant(name, config):
+    """
+    Start one variant, benchmark it and stop it. Returns (results, sampler) or raises Failed.
+    """
+    port = freePort()
+    with tempfile.TemporaryFile("w+") as logFile:
+        process = startVariant(name, port, logFile)
+        try:
+            if not waitListening(process, port):
+                stopVariant(process)
+                logFile.seek(0)
+                tail = logFile.read().strip().splitlines()[-3:]
+                raise Failed("did not start: %s" % (" | ".join(tail) or "no output"))
+            sampler = ProcessSampler(process.pid)
+            results = asyncio.run(benchmark(name, VARIANTS[name][0], port, config, sampler))
+            return results, sampler
+        finally:
+            stopVariant(process)
+
+def report(rows):
+    header = "%-18s %-7s %11s %9s %11s %9s %12s %9s %8s %8s  %s" % (
+        "variant", "dialect", "challenge/s", "p99", "register/s", "p99", "keepalive/s", "p99", "RSS MB", "threads", "errors")
+    lines = [header, "-" * len(header)]
+    for name, outcome in rows:
+        dialect = VARIANTS[name][0]
+        if isinstance(outcome, Exception):
+            lines.append("%-18s %-7s %s" % (name, dialect, outcome))
+            continue
+        results, sampler = outcome
+        cells = []
+        errors = Counter()
+        for result in results:
+            cells.append("%.0f" % result.rate())
+            cells.append(_ms(percentile(result.latencies, 99)))
+            errors.update({"%s:%s" % (result.name, kind): count for kind, count in result.errors.items()})
+        lines.append("%-18s %-7s %11s %9s %11s %9s %12s %9s %8s %8s  %s" % tuple(
+            [name, dialect] + cells + [
+                "%.1f" % (sampler.rss / 1048576) if sampler.rss else "-",
+                sampler.threads or "-",
+                ", ".join("%s=%d" % item for item in errors.most_common()) or "-"]))
+    return "\n".join(lines)
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.variants",
+                                     description="Benchmark every server implementation with the same workload.")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="comma separated, from: " + ", ".join(VARIANTS))
+    parser.add_argument("--duration", type=float, default=5, help="seconds per phase")
+    parser.add_argument("--concurrency", type=int, default=32, help="clients running the Register phases at once")
+    parser.add_argument("--connections", type=int, default=200, help="devices heartbeating in the keepalive phase")
+    parser.add_argument("--secret", default=os.environ.get("LAPI_SECRET", DEFAULT_SECRET))
+    config = parser.parse_args(argv)
+    config.variants = [name.strip() for name in config.variants.split(",") if name.strip()]
+    unknown = [name for name in config.variants if name not in VARIANTS]
+    if unknown:
+        parser.error("unknown variants: %s" % ", ".join(unknown))
+    return config
+
+def run(argv=None):
+    config = parseArgs(argv)
+    rows = []
+    for name in config.variants:
+        print("Benchmarking %s..." % name, file=sys.stderr)
+        try:
+            rows.append((name, runVariant(name, config)))
+        except Failed as e:
+            rows.append((name, e))
+    print(report(rows))
+
+async def httpGet(host, port, target):
+    """
+    GET with the WebSocket upgrade headers a camera sends, (status, headers, body).
+    A 101 is closed without reading further.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(("GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                      % (target, host, port)).encode("ascii"))
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        status = int(head[0].split()[1])
+        headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in head[1:] if line)}
+        body = b""
+        if status != 101 and "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        return status, headers, body
+    finally:
+        writer.close()
+
+async def _recv(websocket):
+    return await asyncio.wait_for(websocket.recv(), REPLY_TIMEOUT)
+
+async def _close(websocket):
+    try:
+        await websocket.close()
+    except Exception:
+        websocket.transport.abort()
+
+def _nonce(message):
+    try:
+        return json.loads(message)["Nonce"]
+    except (ValueError, KeyError, TypeError):
+        raise Failed("no_nonce")
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.1fms" % (seconds * 1000)
+
+def _errorName(error):
+    if isinstance(error, Failed):
+        return str(error)
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, websockets.ConnectionClosed):
+        return "closed_%s" % (error.rcvd.code if error.rcvd is not None else "abnormal")
+    response = getattr(error, "response", None)
+    if response is not None and hasattr(response, "status_code"):
+        return "status_%d" % response.status_code
+    if isinstance(error, OSError):
+        return "connect_failed"
+    return type(error).__name__
+
+if __name__ == "__main__":
+    run()
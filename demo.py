@@ -1,26 +1,20 @@
 import asyncio
-import base64
-import hmac
-import hashlib
 import json
-import math
-import time
-from dataclasses import dataclass
 from enum import Enum
-from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web, WSMsgType
+from Websocket.route_peek import peekRequest
+from Websocket.keepalive import KeepAliveStage
+from Websocket.nonce_store import getNonceStore
+from Websocket.device_secrets import getSecretTable
+from Websocket.log import getLogger
 
 # Constants and Configurations
-SECRET = "123456"
 LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
 LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
 LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
 KEEP_ALIVE_INTERVAL = 60
 
-# Thread Pool Configuration
-CORE_POOL_SIZE = 50
-MAX_POOL_SIZE = 100
-executor = ThreadPoolExecutor(max_workers=MAX_POOL_SIZE)
+log = getLogger("demo")
 
 # Enums
 class CodeEnum(Enum):
@@ -31,37 +25,18 @@ class WebsocketCodeEnum(Enum):
     SUCCESS = (0, "Succeed")
     # ... other codes ...
 
-# Data Classes
-@dataclass
-class KeepAliveRspAO:
-    timestamp: int
-    timeout: int
-
-@dataclass
-class WebsocketReq:
-    RequestURL: str
-    Method: str
-    Cseq: int
-    Data: dict
-
-@dataclass
-class WebsocketRsp:
-    ResponseURL: str
-    ResponseCode: int
-    ResponseString: str
-    Cseq: int
-    Data: KeepAliveRspAO
+# Heartbeats are answered inline on the event loop
+keep_alive_stage = KeepAliveStage(timeout=KEEP_ALIVE_INTERVAL, responseString=WebsocketCodeEnum.SUCCESS.value[1])
 
-# Helper Functions
-def get_cnonce():
-    d = time.time()
-    return str(math.floor((time.time() % 1) * d))
+# Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+secret_table = getSecretTable()
+
+# Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+nonce_store = getNonceStore()
 
+# Helper Functions
 def validate_signature(vendor, device_type, device_code, algorithm, nonce, received_sign):
-    message = f"{vendor}/{device_type}/{device_code}/{algorithm}/{nonce}".encode()
-    secret = SECRET.encode()
-    signature = base64.b64encode(hmac.new(secret, message, hashlib.sha256).digest()).decode()
-    return signature == received_sign
+    return secret_table.verify(vendor, device_type, device_code, algorithm, nonce, received_sign)
 
 # WebSocket Handler
 async def websocket_handler(request):
@@ -69,50 +44,41 @@ async def websocket_handler(request):
     await ws.prepare(request)
     
     remote_addr = request.remote
-    print(f"Connection from {remote_addr}")
+    log.info("Connection", remote=remote_addr)
 
     async for msg in ws:
         if msg.type == WSMsgType.TEXT:
-            data = json.loads(msg.data)
-            req = WebsocketReq(**data)
+            # Slotted WebsocketReq, unknown or missing fields do not raise
+            req = peekRequest(msg.data)
             
             if req.RequestURL == LAPI_KEEPALIVE:
-                print(f"Keep-alive received from {remote_addr}")
-                response = WebsocketRsp(
-                    ResponseURL=req.RequestURL,
-                    ResponseCode=WebsocketCodeEnum.SUCCESS.value[0],
-                    ResponseString=WebsocketCodeEnum.SUCCESS.value[1],
-                    Cseq=req.Cseq,
-                    Data=KeepAliveRspAO(
-                        timestamp=int(time.time()),
-                        timeout=KEEP_ALIVE_INTERVAL
-                    )
-                )
-                await ws.send_str(json.dumps(response.__dict__))
+                log.info("Keep-alive received", route=req.RequestURL, cseq=req.Cseq, remote=remote_addr)
+                await keep_alive_stage.handle(ws.send_str, req)
                 
             elif req.RequestURL == LAPI_UNREGISTER:
-                print(f"Unregister request from {remote_addr}")
+                log.info("Unregister request", route=req.RequestURL, remote=remote_addr)
                 await ws.close()
                 
         elif msg.type == WSMsgType.ERROR:
-            print(f"WebSocket error: {ws.exception()}")
+            log.error("WebSocket error: %s", ws.exception(), remote=remote_addr)
 
-    print(f"Connection closed with {remote_addr}")
+    log.info("Connection closed", remote=remote_addr)
     return ws
 
 # HTTP Handler for WebSocket Upgrade
 async def http_handler(request):
     path = request.path
-    print(f"Handshake request for {path} from {request.remote}")
+    log.info("Handshake request", route=path, remote=request.remote)
 
-    if path == LAPI_REGISTER:
+    # request.path carries no query string, the second Register is told apart by Vendor
+    if path == LAPI_REGISTER and "Vendor" not in request.query:
         # Handle registration logic
-        return web.Response(text=json.dumps({"Nonce": get_cnonce()}), status=401)
+        return web.Response(text=json.dumps({"Nonce": nonce_store.issue(request.remote)}), status=401)
     
     elif path.startswith(LAPI_REGISTER):
         params = request.query
-        # Validate parameters and signature
-        if validate_signature(params.get("Vendor"), params.get("DeviceType"),
+        # Validate the Nonce was issued here and is unused, then the signature
+        if nonce_store.consume(request.remote, params.get("Nonce"), params.get("DeviceCode")) and validate_signature(params.get("Vendor"), params.get("DeviceType"),
                             params.get("DeviceCode"), params.get("Algorithm"),
                             params.get("Nonce"), params.get("Sign")):
             # Create WebSocket connection
@@ -120,7 +86,7 @@ async def http_handler(request):
             await ws.prepare(request)
             return ws
         else:
-            return web.Response(text=json.dumps({"Nonce": get_cnonce()}), status=401)
+            return web.Response(text=json.dumps({"Nonce": nonce_store.issue(request.remote, params.get("DeviceCode"))}), status=401)
 
     return web.Response(status=404)
 
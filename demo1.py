@@ -1,23 +1,29 @@
 import asyncio
-import base64
-import hmac
-import hashlib
 import json
 import time
 from aiohttp import web, WSMsgType
 from urllib.parse import unquote, parse_qs
+from Websocket.route_peek import peekRequest
+from Websocket.keepalive import KeepAliveStage
+from Websocket.nonce_store import getNonceStore
+from Websocket.device_secrets import getSecretTable
+from Websocket.log import getLogger
 
-SECRET = "123456"
 REGISTER_PATH = "/LAPI/V1.0/System/UpServer/Register"
 KEEP_ALIVE_INTERVAL = 10
+log = getLogger("demo1")
+keep_alive_stage = KeepAliveStage(timeout=KEEP_ALIVE_INTERVAL, responseString="Success")
 
-# In-memory storage for nonces (use proper DB in production)
-registrations = {}
+# Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+secret_table = getSecretTable()
+
+# Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+nonce_store = getNonceStore()
 
 async def handle_http(request):
     path = request.path
     remote_ip = "request.remote"
-    print(f"HTTP request from {remote_ip}: {path}")
+    log.info("HTTP request", route=path, remote=remote_ip)
 
     if path == REGISTER_PATH:
         return await handle_registration(request)
@@ -30,8 +36,7 @@ async def handle_registration(request):
     
     # First registration attempt (no parameters)
     if not any(params):
-        nonce = str(int(time.time()))
-        registrations[remote_ip] = {"nonce": nonce}
+        nonce = nonce_store.issue(remote_ip)
         return web.Response(
             status=401,
             content_type="application/json",
@@ -48,30 +53,22 @@ async def handle_registration(request):
         received_sign = unquote(params["Sign"][0]).replace(" ", "+")
         
         # Validate client nonce
-        if registrations.get(remote_ip, {}).get("nonce") != client_nonce:
+        if not nonce_store.consume(remote_ip, client_nonce, device_code):
             return web.Response(status=401, text="Invalid nonce")
         
         # Generate server signature
-        message = f"{vendor}/{device_type}/{device_code}/{algorithm}/{client_nonce}"
-        signature = hmac.new(
-            SECRET.encode("utf-8"),
-            message.encode("utf-8"),
-            hashlib.sha256
-        ).digest()
-        server_sign = base64.b64encode(signature).decode()
-        print(server_sign)
+        server_sign = secret_table.sign(vendor, device_type, device_code, algorithm, client_nonce)
+        log.debug("Server signature: %s", server_sign, device=device_code)
         
         if server_sign != received_sign:
             return web.Response(status=401, text="Invalid signature")
         
-        # Store successful registration
-        registrations[remote_ip]["registered"] = True
-        registrations[remote_ip]["cnonce"] = str(int(time.time()))
+        cnonce = str(int(time.time()))
         
         return web.Response(
             content_type="application/json",
             text=json.dumps({
-                "Cnonce": registrations[remote_ip]["cnonce"],
+                "Cnonce": cnonce,
                 "Resign": server_sign
             })
         )
@@ -87,41 +84,31 @@ async def websocket_handler(request):
     await ws.prepare(request)
     remote_ip = request.remote
     
-    print(f"WebSocket connection from {remote_ip}")
+    log.info("WebSocket connection", remote=remote_ip)
     
     try:
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
-                data = json.loads(msg.data)
-                await handle_websocket_message(ws, remote_ip, data)
+                req = peekRequest(msg.data)
+                await handle_websocket_message(ws, remote_ip, req)
             elif msg.type == WSMsgType.ERROR:
-                print(f"WebSocket error: {ws.exception()}")
+                log.error("WebSocket error: %s", ws.exception(), remote=remote_ip)
                 
     finally:
-        print(f"WebSocket closed for {remote_ip}")
+        log.info("WebSocket closed", remote=remote_ip)
         await ws.close()
     
     return ws
 
-async def handle_websocket_message(ws, remote_ip, data):
-    request_url = data.get("RequestURL")
+async def handle_websocket_message(ws, remote_ip, req):
+    request_url = req.RequestURL
     
     if request_url == "/LAPI/V1.0/System/UpServer/Keepalive":
-        print(f"Keep-alive from {remote_ip}")
-        response = {
-            "ResponseURL": request_url,
-            "ResponseCode": 0,
-            "ResponseString": "Success",
-            "Cseq": data.get("Cseq"),
-            "Data": {
-                "Timestamp": int(time.time()),
-                "Timeout": KEEP_ALIVE_INTERVAL
-            }
-        }
-        await ws.send_str(json.dumps(response))
+        log.info("Keep-alive", route=request_url, remote=remote_ip)
+        await keep_alive_stage.handle(ws.send_str, req)
         
     elif request_url == "/LAPI/V1.0/System/UpServer/Unregister":
-        print(f"Unregister request from {remote_ip}")
+        log.info("Unregister request", route=request_url, remote=remote_ip)
         await ws.close()
 
 app = web.Application()
@@ -1,34 +1,43 @@
 import asyncio
-import base64
-import hmac
-import hashlib
 import json
+import os
 import time
-from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web, WSMsgType
 from urllib.parse import unquote, parse_qs
+from Websocket.route_peek import peekRequest
+from Websocket.keepalive import KeepAliveStage
+from Websocket.liveness import DeviceLivenessTracker
+from Websocket.nonce_store import getNonceStore
+from Websocket.device_secrets import getSecretTable
+from Websocket.worker_group import WorkerGroup
+from Websocket.log import getLogger
 
 # Configuration matching Java constants
-SECRET = "123456"
 LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
 LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
 LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
-CORE_POOL_SIZE = 50
-MAX_POOL_SIZE = 100
-QUEUE_SIZE = 1000
 KEEP_ALIVE_TIME = 60  # Seconds
 
-# Thread pool matching Java's ThreadPoolExecutor
-executor = ThreadPoolExecutor(
-    max_workers=MAX_POOL_SIZE,
-    thread_name_prefix="KeepLiveThreadPool"
-)
+log = getLogger("demo2")
+
+# Matches KeepLiveThread, but answers on the connection's loop; blocking work
+# would go to the stage's blockingWork hook on the shared KeepLiveThreadPoolExecutor
+keep_alive_stage = KeepAliveStage(timeout=KEEP_ALIVE_TIME, responseString="Success")
+# Expires devices that stop sending keep-alives within KEEP_ALIVE_TIME
+liveness = DeviceLivenessTracker(timeout=KEEP_ALIVE_TIME)
+liveness.addListener(lambda event, key: log.info("Device liveness: %s", event, remote=key))
+
+# Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+secret_table = getSecretTable()
+
+# Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+nonce_store = getNonceStore()
 
 async def handle_http(request):
     """Handles HTTP registration requests"""
     path = request.path
     remote = request.remote
-    print(f"HTTP request from {remote}: {path}")
+    log.info("HTTP request", route=path, remote=remote)
 
     if path == LAPI_REGISTER:
         return await handle_registration(request)
@@ -42,8 +51,8 @@ async def handle_registration(request):
     
     # First registration attempt (no parameters)
     if not params:
-        response.status = 401
-        response.text = json.dumps({"Nonce": get_cnonce()})
+        response.set_status(401)
+        response.text = json.dumps({"Nonce": nonce_store.issue(request.remote)})
         return response
     
     # Second registration with parameters
@@ -55,11 +64,12 @@ async def handle_registration(request):
         nonce = params["Nonce"][0]
         sign = unquote(params["Sign"][0]).replace(" ", "+")
 
+        # The Nonce must be one this server issued to the device and not used yet
+        if not nonce_store.consume(request.remote, nonce, device_code):
+            raise ValueError("Unknown or expired Nonce")
+
         # Validate signature (matches Java's logic)
-        message = f"{vendor}/{device_type}/{device_code}/{algorithm}/{nonce}"
-        secret = SECRET.encode("utf-8")
-        mac = hmac.new(secret, message.encode("utf-8"), hashlib.sha256)
-        expected_sign = base64.b64encode(mac.digest()).decode()
+        expected_sign = secret_table.sign(vendor, device_type, device_code, algorithm, nonce)
         
         if expected_sign != sign:
             raise ValueError("Invalid signature")
@@ -72,9 +82,9 @@ async def handle_registration(request):
         return response
 
     except (KeyError, ValueError) as e:
-        print(f"Authentication failed: {str(e)}")
-        response.status = 401
-        response.text = json.dumps({"Nonce": get_cnonce()})
+        log.warning("Authentication failed: %s", e, remote=request.remote)
+        response.set_status(401)
+        response.text = json.dumps({"Nonce": nonce_store.issue(request.remote, params.get("DeviceCode", [""])[0])})
         return response
 
 async def websocket_handler(request):
@@ -82,54 +92,40 @@ async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     remote = request.remote
-    print(f"WebSocket connected: {remote}")
+    log.info("WebSocket connected", remote=remote)
+    # Peer address with port, several cameras can share one NAT address
+    peer = request.transport.get_extra_info("peername")
+    close = lambda: asyncio.create_task(ws.close())
+    liveness.register(peer, close)
 
     try:
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
-                data = json.loads(msg.data)
+                req = peekRequest(msg.data)
                 
                 # Handle keep-alive requests (matches KeepLiveThread)
-                if data.get("RequestURL") == LAPI_KEEPALIVE:
-                    executor.submit(
-                        handle_keepalive,
-                        ws,
-                        data,
-                        remote
-                    )
+                if req.RequestURL == LAPI_KEEPALIVE:
+                    liveness.keepalive(peer)
+                    await handle_keepalive(ws, req, remote)
                 
                 # Handle unregister requests
-                elif data.get("RequestURL") == LAPI_UNREGISTER:
+                elif req.RequestURL == LAPI_UNREGISTER:
                     await ws.close()
     
     finally:
-        print(f"Connection closed: {remote}")
+        liveness.remove(peer, close)
+        log.info("Connection closed", remote=remote)
         await ws.close()
 
-def handle_keepalive(ws, data, remote):
+async def handle_keepalive(ws, req, remote):
     """Matches KeepLiveThread.run() functionality"""
     try:
-        # Create response (matches Java's KeepAliveRspAO)
-        response = {
-            "ResponseURL": LAPI_KEEPALIVE,
-            "ResponseCode": 0,  # SUCCESS
-            "ResponseString": "Success",
-            "Cseq": data.get("Cseq"),
-            "Data": {
-                "Timestamp": int(time.time()),
-                "Timeout": KEEP_ALIVE_TIME
-            }
-        }
-        
-        # Thread-safe send
-        asyncio.run_coroutine_threadsafe(
-            ws.send_str(json.dumps(response)),
-            asyncio.get_event_loop()
-        )
-        print(f"Sent keep-alive response to {remote}")
+        # Create response (matches Java's KeepAliveRspAO) and send it on this connection's loop
+        await keep_alive_stage.handle(ws.send_str, req)
+        log.info("Sent keep-alive response", route=req.RequestURL, cseq=req.Cseq, remote=remote)
 
     except Exception as e:
-        print(f"Error handling keep-alive: {str(e)}")
+        log.error("Error handling keep-alive: %s", e, remote=remote)
 
 def get_cnonce():
     """Matches Java's getCnonce() implementation"""
@@ -142,6 +138,14 @@ app.add_routes([
     web.get("/ws", websocket_handler)
 ])
 
+def serve(host, port, reuse_port=False):
+    """Runs one server process with its own event loop"""
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port)
+
 if __name__ == "__main__":
-    print("Starting server...")
-    web.run_app(app, host="localhost", port=82)
\ No newline at end of file
+    log.info("Starting server...")
+    WORKERS = int(os.environ.get("LAPI_WORKERS", "1"))  # processes sharing the port via SO_REUSEPORT
+    if WORKERS > 1:
+        WorkerGroup(WORKERS).run(serve, "localhost", 82, True)
+    else:
+        serve("localhost", 82)
\ No newline at end of file
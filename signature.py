@@ -1,15 +1,13 @@
-import hmac
-import hashlib
-import base64
+from Websocket.device_secrets import getSecretTable
 
-SECRET = "123456"
+# Same table as the server (LAPI_SECRETS, LAPI_SECRET), so the Sign matches its lookup
+secret_table = getSecretTable()
 vendor = "TestVendor"
 device_type = "TestDevice"
 device_code = "12345"
 algorithm = "HMAC-SHA256"
 nonce = "1741158917"  # Use the actual nonce from the first API response
 
-message = f"{vendor}/{device_type}/{device_code}/{algorithm}/{nonce}".encode()
-signature = base64.b64encode(hmac.new(SECRET.encode(), message, hashlib.sha256).digest()).decode()
+signature = secret_table.sign(vendor, device_type, device_code, algorithm, nonce)
 
 print("Generated Sign:", signature)
@@ -7,6 +7,10 @@ import base64
 import time
 import random
 from urllib.parse import urlparse, parse_qs
+from Websocket.route_peek import peekRequest
+from Websocket.log import getLogger
+
+log = getLogger("test")
 
 class WebSocketHandler:
     SECRET = "123456"
@@ -22,7 +26,7 @@ class WebSocketHandler:
             async for message in websocket:
                 await self.handle_message(websocket, message)
         finally:
-            print(f"Client disconnected: {websocket.remote_address}")
+            log.debug("Client disconnected", remote=websocket.remote_address)
 
     async def handle_message(self, websocket, message):
         if isinstance(message, str):
@@ -32,22 +36,21 @@ class WebSocketHandler:
 
     async def handle_text_message(self, websocket, message):
         try:
-            data = json.loads(message)
-            request_url = data.get('requestURL')
+            request_url = peekRequest(message).RequestURL
 
             if request_url == self.LAPI_KEEPALIVE:
-                print(f"Received keep-alive request from {websocket.remote_address}")
+                log.info("Received keep-alive request", route=request_url, remote=websocket.remote_address)
                 # Handle keep-alive logic here
             elif request_url == self.LAPI_UNREGISTER:
-                print(f"Device disconnected: {websocket.remote_address}")
+                log.info("Device disconnected", remote=websocket.remote_address)
                 await websocket.close()
             else:
-                print(f"Received unknown request: {request_url}")
+                log.warning("Received unknown request", route=request_url, remote=websocket.remote_address)
         except json.JSONDecodeError:
-            print("Invalid JSON received")
+            log.warning("Invalid JSON received")
 
     async def handle_binary_message(self, websocket, message):
-        print("Binary messages are not supported")
+        log.warning("Binary messages are not supported", remote=websocket.remote_address)
 
     @staticmethod
     def get_cnonce():
@@ -2,45 +2,49 @@ import asyncio
 import websockets
 import json
 import hmac
-import hashlib
-import base64
-import time
-import random
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor  # For KeepAliveThread equivalent
+from Websocket.route_peek import peekRequest
+from Websocket.nonce_store import getNonceStore, remoteHost
+from Websocket.device_secrets import getSecretTable
+from Websocket.routes import RouteTable
+from Websocket.keepalive import KeepAliveStage  # For KeepAliveThread equivalent
+from Websocket.log import getLogger
+
+log = getLogger("test3")
 
 class WebSocketHandler:
     """
     Python version of the WebSocketHandler.java class
     """
 
-    SECRET = "123456"
+    # Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+    secret_table = getSecretTable()
     LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
     LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
     LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+    # Stateless, shared by every connection
+    keep_alive_stage = KeepAliveStage()
+    # Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+    nonce_store = getNonceStore()
+    # Registration path and frame RequestURLs, each resolved with one dict lookup
+    http_routes = RouteTable()
+    frame_routes = RouteTable()
 
     def __init__(self):
         self.handshaker = None
-        self.keep_alive_executor = ThreadPoolExecutor(max_workers=3) # thread pool for the keep alive threads
 
     async def channelRead(self, websocket, path):
         """
         Handles incoming WebSocket messages.  Mimics the channelRead function from Java.
         """
         try:
-            print(f"New connection from {websocket.remote_address}")
+            log.debug("New connection", route=path, remote=websocket.remote_address)
             # Parse the URL to determine whether this is a registration request or a websocket connection
             # parsed_url = urllib.parse.urlparse(path)  ----->Problem here so i change this
-            if path:
-                parsed_url = urllib.parse.urlparse(path)
-            else:
-                parsed_url = None  # Handle case where path is None
-
-            if parsed_url and parsed_url.path == self.LAPI_REGISTER:
-                await self.handle_http_register(websocket)
-            elif parsed_url and parsed_url.path.startswith(self.LAPI_REGISTER):
-                query_params = urllib.parse.parse_qs(parsed_url.query)
-                await self.handle_http_register_vendor(websocket, query_params)
+            # The route table returns None for a missing path as well
+            match = self.http_routes.match(path)
+            if match is not None:
+                await match.handler(self, websocket, match)
             else:
                 async for message in websocket:
                     await self.handleWebSocketRequest(websocket, message)
@@ -63,7 +67,7 @@ class WebSocketHandler:
             #         await self.handleWebSocketRequest(websocket, message)
 
         except websockets.exceptions.ConnectionClosedError as e:
-            print(f"Connection closed abruptly: {e}")  # Handle disconnections more gracefully.
+            log.info("Connection closed abruptly: %s", e)  # Handle disconnections more gracefully.
         except Exception as e:
             self.exceptionCaught(websocket, e) # call the exception handling function
         finally:
@@ -73,11 +77,11 @@ class WebSocketHandler:
         """
         Handles the initial HTTP registration request.
         """
-        object = {"Nonce": self.getCnonce()}
+        object = {"Nonce": self.new_nonce(websocket)}
         response_body = json.dumps(object)
         #Cannot directly send an HTTP response using websockets.  Need to send a message
         await websocket.send(response_body)
-        print(f"Sent initial registration challenge to {websocket.remote_address}")
+        log.info("Sent initial registration challenge", remote=websocket.remote_address)
 
 
     async def handle_http_register_vendor(self, websocket, query_params):
@@ -94,132 +98,144 @@ class WebSocketHandler:
             Sign = query_params.get("Sign", [None])[0]
 
             if None in (Vendor, DeviceType, Devicecode, Algorithm, Nonce, Sign):
-                print("Missing parameters in registration request")
+                log.warning("Missing parameters in registration request", remote=websocket.remote_address)
                 await websocket.close(code=4000, reason="Missing parameters")
                 return
 
+            # The Nonce must be one this server issued to the device and not used yet
+            if not self.nonce_store.consume(remoteHost(websocket.remote_address), Nonce, Devicecode):
+                log.warning("Unknown or expired Nonce: %s", Nonce, device=Devicecode, remote=websocket.remote_address)
+                await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, Devicecode)}))
+                return
+
             decoded_url = urllib.parse.unquote(Sign)
             decoded_url = decoded_url.replace(" ", "+")
-            print(f"Certified Signature: {decoded_url}")
-
-            pstr = f"{Vendor}/{DeviceType}/{Devicecode}/{Algorithm}/{Nonce}"
+            log.debug("Certified Signature: %s", decoded_url, device=Devicecode)
 
             # Generate server-side signature
-            sha256_HMAC = hmac.new(self.SECRET.encode("utf-8"), pstr.encode("utf-8"), hashlib.sha256)
-            encodeStr = base64.b64encode(sha256_HMAC.digest()).decode("utf-8")
+            encodeStr = self.secret_table.sign(Vendor, DeviceType, Devicecode, Algorithm, Nonce)
 
             if not hmac.compare_digest(encodeStr, decoded_url): # hmac.compare_digest to prevent timing attacks
-                print(f"Authentication failed: {encodeStr}")
-                object = {"Nonce": self.getCnonce()}
+                log.warning("Authentication failed", device=Devicecode, remote=websocket.remote_address)
+                object = {"Nonce": self.new_nonce(websocket, Devicecode)}
                 await websocket.send(json.dumps(object))  # Send back a challenge
                 return
 
-            print("Authentication successful")
+            log.info("Authentication successful", device=Devicecode, remote=websocket.remote_address)
             object = {"Cnonce": Cnonce, "Resign": encodeStr}
             await websocket.send(json.dumps(object)) # send back the Cnonce and Resign values
             self.handlerAdded(websocket) # now that the handshake is complete, add the handler
 
         except Exception as e:
-            print(f"Error during vendor registration: {e}")
+            log.exception("Error during vendor registration", remote=websocket.remote_address)
             await websocket.close(code=5000, reason="Internal server error")
 
 
+    @http_routes.route(LAPI_REGISTER)
+    async def on_register_path(self, websocket, match):
+        query_params = match.parameters()
+        if "Vendor" in query_params:
+            # Mimicking the second registration handshake
+            await self.handle_http_register_vendor(websocket, query_params)
+        else:
+            # Mimicking the initial registration handshake
+            await self.handle_http_register(websocket)
+
     async def handleWebSocketRequest(self, websocket, message):
         """
         Handles incoming WebSocket frames.
         """
         try:
-            jsonObject = json.loads(message)
-            request_url = jsonObject.get("requestURL")
-
-            if request_url == self.LAPI_KEEPALIVE:
-                print(f"The server received a device's keep alive request: {request_url}")
-                # Use threads to receive keep alive information
-                # NOTE: The KeepLiveThread needs to be adapted to run in Python.
-                # The example uses a basic thread pool to execute the logic asynchronously
-                self.keep_alive_executor.submit(self.keep_alive_task, websocket, jsonObject)
-
-            elif request_url == self.LAPI_UNREGISTER:
-                print(f"{websocket.remote_address} Device disconnected")
-                await websocket.close()
+            websocketReq = peekRequest(message)
+            request_url = websocketReq.RequestURL
 
+            match = self.frame_routes.match(request_url)
+            if match is None:
+                log.warning("Received unknown request", route=request_url, remote=websocket.remote_address)
             else:
-                print(f"Received unknown request: {request_url}")
+                await match.handler(self, websocket, websocketReq)
 
         except json.JSONDecodeError:
-            print("Invalid JSON received")
+            log.warning("Invalid JSON received")
         except Exception as e:
             self.exceptionCaught(websocket, e)
 
-    def keep_alive_task(self, websocket, jsonObject):
+    @frame_routes.route(LAPI_KEEPALIVE)
+    async def on_keepalive(self, websocket, websocketReq):
+        log.info("The server received a device's keep alive request",
+                 route=websocketReq.RequestURL, cseq=websocketReq.Cseq, remote=websocket.remote_address)
+        # Answered on this connection's loop, no thread is involved
+        await self.keep_alive_task(websocket, websocketReq)
+
+    @frame_routes.route(LAPI_UNREGISTER)
+    async def on_unregister(self, websocket, websocketReq):
+        log.info("Device disconnected", remote=websocket.remote_address)
+        await websocket.close()
+
+    async def keep_alive_task(self, websocket, websocketReq):
       '''
       This is the logic previously performed by the keepAliveThread.
-      Since we cannot directly translate the Java thread, this simulates
-      the thread with a task submitted to the threadpool.
+      The KeepAliveRspAO response is built and sent on the connection's own loop,
+      blocking work belongs in the stage's blockingWork hook, which runs on the shared executor.
       '''
       try:
-        print(f"Processing Keep-Alive from {websocket.remote_address}: {jsonObject}")
-        #Simulate some processing
-        time.sleep(2)
-        print(f"Keep-Alive processing complete for {websocket.remote_address}")
-
+        await self.keep_alive_stage.handle(websocket.send, websocketReq)
       except Exception as e:
-        print(f"Error during keep-alive processing {websocket.remote_address}: {e}")
+        log.error("Error during keep-alive processing: %s", e, remote=websocket.remote_address)
 
 
     def handlerAdded(self, websocket):
         """
         Called when a handler is added to the pipeline (connection established).
         """
-        print(f"{websocket.remote_address} The device is connected")
+        log.info("The device is connected", remote=websocket.remote_address)
         self.channelActive(websocket) # call channel active
 
     def handlerRemoved(self, websocket):
         """
         Called when a handler is removed from the pipeline (connection closed).
         """
-        print(f"{websocket.remote_address} The device has been removed")
+        log.info("The device has been removed", remote=websocket.remote_address)
         self.channelInactive(websocket) # call channel inactive
 
     def channelActive(self, websocket):
         """
         Called when a channel becomes active (connection is ready for communication).
         """
-        print(f"Client joined connection: {websocket.remote_address}")
+        log.debug("Client joined connection", remote=websocket.remote_address)
 
     def channelInactive(self, websocket):
         """
         Called when a channel becomes inactive (connection is closed).
         """
-        print(f"Client disconnected: {websocket.remote_address}")
+        log.debug("Client disconnected", remote=websocket.remote_address)
 
     def exceptionCaught(self, websocket, error):
         """
         Handles exceptions that occur during channel processing.
         """
-        print(f"Exception occurred: {error}")
+        log.error("Exception occurred: %s", error, exc_info=error, remote=websocket.remote_address)
         asyncio.create_task(websocket.close())  # Close the connection
 
-    def getCnonce(self):
+    def new_nonce(self, websocket, device_code=""):
         """
-        Calculates a cnonce value (client nonce).
+        Issues a challenge Nonce and remembers it for the device's IP (and DeviceCode once known).
         """
-        d = random.random()
-        d1 = time.time()
-        x = d * d1
-        return str(int(x))
+        return self.nonce_store.issue(remoteHost(websocket.remote_address), device_code)
 
 
 async def websocket_server(ip, port):
     """
     Main function to run the WebSocket server.  Mimics the Websocket.java class
     """
-    print("Starting websocket server...")
+    log.info("Starting websocket server...")
 
-    async def handler(websocket, path):
+    async def handler(websocket, path=None):
         """
         The handler that will be called for each new websocket.
         """
+        # websockets 13+ no longer passes the path, it is on the handshake request
+        path = path or getattr(websocket, "path", None) or websocket.request.path
         websocket_handler = WebSocketHandler() #Create an instance for each connection.
         await websocket_handler.channelRead(websocket, path)
 
@@ -227,14 +243,14 @@ async def websocket_server(ip, port):
     try:
         # Start the WebSocket server
         async with websockets.serve(handler, ip, port) as server:
-            print(f"WebSocket server started successfully on {ip}:{port}")
+            log.info("WebSocket server started successfully on %s:%s", ip, port)
             await asyncio.Future()  # Run forever
     except OSError as e:
-        print(f"The webSocket server failed to start: {e}.  Please check the IP/port settings")
+        log.error("The webSocket server failed to start: %s.  Please check the IP/port settings", e)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        log.exception("An unexpected error occurred")
     finally:
-        print("Websocket Server closed.")
+        log.info("Websocket Server closed.")
 
 
 if __name__ == "__main__":
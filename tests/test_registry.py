@@ -0,0 +1,40 @@
+from Websocket.registry import DeviceRegistry
+
+def test_discard_evicts_every_device_of_the_connection():
+    registry = DeviceRegistry()
+    connection = object()
+    registry.add("CAM-1", connection, "Uniview", "IPC", ("10.0.0.1", 5000))
+    registry.add("CAM-2", connection, "Uniview", "IPC", ("10.0.0.1", 5000))
+    assert {entry.deviceCode for entry in registry.byConnection(connection)} == {"CAM-1", "CAM-2"}
+
+    removed = registry.discard(connection)
+
+    assert {entry.deviceCode for entry in removed} == {"CAM-1", "CAM-2"}
+    assert len(registry) == 0
+    assert registry.byConnection(connection) == ()
+    assert registry.byVendor("Uniview") == ()
+    assert registry.byIp("10.0.0.1") == ()
+
+def test_discard_keeps_a_device_that_moved_to_a_new_connection():
+    registry = DeviceRegistry()
+    old, new = object(), object()
+    registry.add("CAM-1", old, remoteAddress=("10.0.0.1", 5000))
+    registry.add("CAM-2", old, remoteAddress=("10.0.0.1", 5000))
+    previous = registry.add("CAM-1", new, remoteAddress=("10.0.0.1", 5001))
+
+    assert previous.connection is old
+    assert [entry.deviceCode for entry in registry.discard(old)] == ["CAM-2"]
+    assert registry.connection("CAM-1") is new
+    assert registry.discard(old) == ()
+
+def test_remove_leaves_the_other_devices_of_the_connection():
+    registry = DeviceRegistry()
+    connection = object()
+    registry.add("CAM-1", connection)
+    registry.add("CAM-2", connection)
+
+    registry.remove("CAM-1", connection)
+
+    assert [entry.deviceCode for entry in registry.byConnection(connection)] == ["CAM-2"]
+    assert [entry.deviceCode for entry in registry.discard(connection)] == ["CAM-2"]
+    assert len(registry) == 0
@@ -1,80 +1,105 @@
 import asyncio
+import os
 import websockets
 import json
 import hmac
-import hashlib
-import base64
-import time
-import random
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
+from Websocket.route_peek import peekRequest
+from Websocket.routes import RouteTable
+from Websocket.keepalive import KeepAliveStage
+from Websocket.liveness import DeviceLivenessTracker
+from Websocket.nonce_store import getNonceStore, remoteHost
+from Websocket.device_secrets import getSecretTable
+from Websocket.registry import DeviceRegistry
+from Websocket.resumption import ResumptionTickets
+from Websocket.admission import AdmissionRejected, RegistrationAdmission
+from Websocket.worker_group import WorkerGroup
+from Websocket.log import getLogger
+from Websocket.metrics import startMetricsServer
+from Websocket.watchdog import startWatchdog
 
 # Constants
-SECRET = "123456"
 LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
 LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
 LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
 
-executor = ThreadPoolExecutor(max_workers=3)  # Thread pool for keep-alive tasks
+log = getLogger("wbs")  # Queued to a writer thread, LAPI_LOG_LEVEL and LAPI_LOG_RATE tune it
 
-def getCnonce():
-    """Generates a unique client nonce (Cnonce)."""
-    return str(int(random.random() * time.time()))
+keep_alive_stage = KeepAliveStage()  # Answers heartbeats on the loop, offloads blocking work to the shared pool
+liveness = DeviceLivenessTracker()  # Missed-heartbeat detection for every registered DeviceCode
+liveness.addListener(lambda event, key: log.info("Device liveness: %s", event, device=key))
+resumption_tickets = ResumptionTickets()  # One round trip reconnects (LAPI_TICKET_KEY, LAPI_TICKET_LIFETIME)
+secret_table = getSecretTable()  # Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+nonce_store = getNonceStore()  # Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+device_registry = DeviceRegistry()  # Registered devices by DeviceCode, Vendor, DeviceType and IP
+register_admission = RegistrationAdmission()  # Paces Register storms per IP and overall
+
+async def admit_registration(websocket):
+    """Waits for a registration slot, a shed device is closed with 1013 Try Again Later."""
+    try:
+        await register_admission.acquire(remoteHost(websocket.remote_address))
+        return True
+    except AdmissionRejected as e:
+        log.warning("Registration shed: %s", e, remote=websocket.remote_address)
+        await websocket.close(code=1013, reason=f"Try again in {e.retryAfter}s")
+        return False
+
+def register_device(websocket, device_code, vendor, device_type):
+    """Indexes a registered device by DeviceCode; a previous connection of the same device is stale and closed."""
+    previous = device_registry.add(device_code, websocket, vendor, device_type, websocket.remote_address)
+    # Tracked by DeviceCode, a device reconnecting from a new port keeps one deadline
+    liveness.register(device_code, lambda: asyncio.create_task(websocket.close()))
+    if previous is not None:
+        log.info("Device reconnected, closing its old connection from %s:%s", previous.ip, previous.port,
+                 device=device_code, remote=websocket.remote_address)
+        asyncio.create_task(previous.connection.close())
+
+def new_nonce(websocket, device_code=""):
+    """Issues a challenge Nonce and remembers it for the device's IP (and DeviceCode once known)."""
+    return nonce_store.issue(remoteHost(websocket.remote_address), device_code)
 
 async def handle_websocket(websocket):
     """Handles WebSocket connections."""
-    print(f"Device connected: {websocket.remote_address}")
+    log.info("Device connected", remote=websocket.remote_address)
 
     try:
         async for message in websocket:
-            print(f"Received message: {message}")  # Debugging: Log the full message
+            log.debug("Received message: %s", message, remote=websocket.remote_address)
             
             try:
-                # Attempt to parse JSON
-                data = json.loads(message)
-                request_url = data.get("requestURL")
+                # Attempt to parse JSON straight into a WebsocketReq
+                websocketReq = peekRequest(message)
+                request_url = websocketReq.RequestURL
 
                 if not request_url:
-                    print("Error: requestURL is missing or None")
+                    log.warning("Error: requestURL is missing or None", remote=websocket.remote_address)
                     continue  # Skip this iteration and wait for a valid message
 
-                # Handle keep-alive messages
-                if request_url == LAPI_KEEPALIVE:
-                    print(f"Keep-alive received from {websocket.remote_address}")
-                    executor.submit(keep_alive_task, websocket, data)
-
-                # Handle registration messages
-                elif request_url.startswith(LAPI_REGISTER + "?Vendor"):
-                    print(f"Handling registration from {websocket.remote_address}")
-                    await handle_registration(websocket, request_url)
-
-                # Handle unregistration messages
-                elif request_url == LAPI_UNREGISTER:
-                    print(f"Device {websocket.remote_address} unregistered")
-                    await websocket.close()
-
+                match = routes.match(request_url)
+                if match is None:
+                    log.warning("Unknown request", route=request_url, remote=websocket.remote_address)
                 else:
-                    print(f"Unknown request: {request_url}")
+                    await match.handler(websocket, websocketReq, match)
 
             except json.JSONDecodeError:
-                print("Error: Received invalid JSON")
+                log.warning("Error: Received invalid JSON", remote=websocket.remote_address)
 
             except Exception as e:
-                print(f"Unexpected error while processing message: {e}")
+                log.exception("Unexpected error while processing message", remote=websocket.remote_address)
 
     except websockets.exceptions.ConnectionClosedError:
-        print(f"Device {websocket.remote_address} disconnected unexpectedly")
+        log.info("Device disconnected unexpectedly", remote=websocket.remote_address)
 
     except Exception as e:
-        print(f"Unexpected error in WebSocket handler: {e}")
+        log.exception("Unexpected error in WebSocket handler", remote=websocket.remote_address)
 
     finally:
-        print(f"Device disconnected: {websocket.remote_address}")
-async def handle_registration(websocket, request_url):
+        # Only the devices still registered on this connection, one that reconnected stays tracked
+        for session in device_registry.discard(websocket):
+            liveness.remove(session.deviceCode)
+        log.info("Device disconnected", remote=websocket.remote_address)
+async def handle_registration(websocket, query_params):
     """Handles device registration."""
-    parsed_url = urllib.parse.urlparse(request_url)
-    query_params = urllib.parse.parse_qs(parsed_url.query)
-
     Vendor = query_params.get("Vendor", [None])[0]
     DeviceType = query_params.get("DeviceType", [None])[0]
     DeviceCode = query_params.get("DeviceCode", [None])[0]
@@ -84,39 +109,112 @@ async def handle_registration(websocket, request_url):
     Sign = query_params.get("Sign", [None])[0]
 
     if None in (Vendor, DeviceType, DeviceCode, Algorithm, Nonce, Sign):
-        print("Missing parameters in registration request")
+        log.warning("Missing parameters in registration request", remote=websocket.remote_address)
         await websocket.close(code=4000, reason="Missing parameters")
         return
 
+    # The Nonce must be one this server issued to the device and not used yet
+    if not nonce_store.consume(remoteHost(websocket.remote_address), Nonce, DeviceCode):
+        log.warning("Unknown or expired Nonce: %s", Nonce, device=DeviceCode, remote=websocket.remote_address)
+        await websocket.send(json.dumps({"Nonce": new_nonce(websocket, DeviceCode)}))
+        return
+    # The challenge paid for this registration, a made-up Nonce keeps costing its IP
+    register_admission.refund(remoteHost(websocket.remote_address))
+
     decoded_url = urllib.parse.unquote(Sign).replace(" ", "+")
-    print(f"Certified Signature: {decoded_url}")
+    log.debug("Certified Signature: %s", decoded_url, device=DeviceCode)
 
-    pstr = f"{Vendor}/{DeviceType}/{DeviceCode}/{Algorithm}/{Nonce}"
-    sha256_HMAC = hmac.new(SECRET.encode("utf-8"), pstr.encode("utf-8"), hashlib.sha256)
-    encodeStr = base64.b64encode(sha256_HMAC.digest()).decode("utf-8")
+    encodeStr = secret_table.sign(Vendor, DeviceType, DeviceCode, Algorithm, Nonce)
 
     if not hmac.compare_digest(encodeStr, decoded_url):
-        print(f"Authentication failed: {encodeStr}")
-        await websocket.send(json.dumps({"Nonce": getCnonce()}))
+        log.warning("Authentication failed", device=DeviceCode, remote=websocket.remote_address)
+        await websocket.send(json.dumps({"Nonce": new_nonce(websocket, DeviceCode)}))
         return
 
-    print("Authentication successful")
-    await websocket.send(json.dumps({"Cnonce": Cnonce, "Resign": encodeStr}))
+    log.info("Authentication successful", device=DeviceCode, remote=websocket.remote_address)
+    ticket = resumption_tickets.issue(DeviceCode, Vendor, DeviceType)
+    await websocket.send(json.dumps({"Cnonce": Cnonce, "Resign": encodeStr, "Ticket": ticket}))
+    register_device(websocket, DeviceCode, Vendor, DeviceType)
+
+async def handle_resumption(websocket, query_params):
+    """Admits a device presenting a resumption ticket, an invalid one gets a Nonce challenge."""
+    device_code = query_params.get("DeviceCode", [""])[0]
+    claims = resumption_tickets.verify(query_params["Ticket"][0], device_code)
+    if claims is None:
+        log.info("Resumption ticket rejected, full registration required",
+                 device=device_code, remote=websocket.remote_address)
+        await websocket.send(json.dumps({"Nonce": new_nonce(websocket, device_code)}))
+        return
+    log.info("Device resumed its session", device=claims.deviceCode, remote=websocket.remote_address)
+    ticket = resumption_tickets.issue(claims.deviceCode, claims.vendor, claims.deviceType)
+    await websocket.send(json.dumps({"Ticket": ticket}))
+    register_device(websocket, claims.deviceCode, claims.vendor, claims.deviceType)
+
+# Frame dispatch: RequestURL path -> handler(websocket, websocketReq, match)
+routes = RouteTable()
+
+@routes.route(LAPI_KEEPALIVE)
+async def on_keepalive(websocket, websocketReq, match):
+    """Handles keep-alive messages."""
+    log.info("Keep-alive received",
+             route=websocketReq.RequestURL, cseq=websocketReq.Cseq, remote=websocket.remote_address)
+    for session in device_registry.byConnection(websocket):
+        liveness.keepalive(session.deviceCode)
+    await keep_alive_task(websocket, websocketReq)
+
+@routes.route(LAPI_REGISTER)
+async def on_register(websocket, websocketReq, match):
+    """Handles registration messages."""
+    if not await admit_registration(websocket):
+        return
+    query_params = match.parameters()
+    if "Ticket" in query_params:
+        await handle_resumption(websocket, query_params)
+        return
+    if "Vendor" not in query_params:
+        # First step, challenge the device with a Nonce to sign
+        log.info("Sending registration challenge", remote=websocket.remote_address)
+        await websocket.send(json.dumps({"Nonce": new_nonce(websocket)}))
+        return
+    log.debug("Handling registration", remote=websocket.remote_address)
+    await handle_registration(websocket, query_params)
 
-def keep_alive_task(websocket, jsonObject):
-    """Handles keep-alive requests in a separate thread."""
+@routes.route(LAPI_UNREGISTER)
+async def on_unregister(websocket, websocketReq, match):
+    """Handles unregistration messages."""
+    log.info("Device unregistered", remote=websocket.remote_address)
+    await websocket.close()
+
+async def keep_alive_task(websocket, websocketReq):
+    """Handles keep-alive requests on the connection's event loop."""
     try:
-        print(f"Processing Keep-Alive from {websocket.remote_address}: {jsonObject}")
-        time.sleep(2)
-        print(f"Keep-Alive processing complete for {websocket.remote_address}")
+        await keep_alive_stage.handle(websocket.send, websocketReq)
     except Exception as e:
-        print(f"Error during keep-alive processing: {e}")
+        log.error("Error during keep-alive processing: %s", e, remote=websocket.remote_address)
 
-async def websocket_server(ip, port):
+async def websocket_server(ip, port, reuse_port=False):
     """Starts the WebSocket server."""
-    print(f"WebSocket Server running on ws://{ip}:{port}")
-    async with websockets.serve(handle_websocket, ip, port):
-        await asyncio.Future()  # Run forever
+    log.info("WebSocket Server running on ws://%s:%s", ip, port)
+    # Pick up edits to the secrets file without blocking the loop
+    watcher = asyncio.create_task(secret_table.watch()) if secret_table.path else None
+    # Keep alive and executor metrics on GET /metrics (LAPI_METRICS_PORT, 0 disables)
+    await startMetricsServer()
+    # Reports callbacks that block the loop, on /metrics and /debug/stalls (LAPI_WATCHDOG_THRESHOLD)
+    startWatchdog()
+    try:
+        async with websockets.serve(handle_websocket, ip, port, reuse_port=reuse_port):
+            await asyncio.Future()  # Run forever
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+def serve(ip, port, reuse_port=False):
+    """Runs one server process with its own event loop."""
+    asyncio.run(websocket_server(ip, port, reuse_port))
 
 if __name__ == "__main__":
-    asyncio.run(websocket_server("0.0.0.0", 8765))
+    WORKERS = int(os.environ.get("LAPI_WORKERS", "1"))  # processes sharing the port via SO_REUSEPORT
+    if WORKERS > 1:
+        WorkerGroup(WORKERS).run(serve, "0.0.0.0", 8765, True)
+    else:
+        serve("0.0.0.0", 8765)
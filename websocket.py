@@ -2,6 +2,10 @@ import asyncio
 import websockets
 import json
 
+from Websocket.log import getLogger
+
+log = getLogger("echo")
+
 clients = set()  # Track connected clients
 
 async def handler(websocket, path):
@@ -9,17 +13,17 @@ async def handler(websocket, path):
     try:
         async for message in websocket:
             data = json.loads(message)
-            print(f"Received: {data}")
+            log.debug("Received: %s", data, remote=websocket.remote_address)
             response = {"message": "Hello from server!"}
             await websocket.send(json.dumps(response))
     except websockets.exceptions.ConnectionClosed:
-        print("Client disconnected")
+        log.info("Client disconnected", remote=websocket.remote_address)
     finally:
         clients.remove(websocket)
 
 async def main():
     server = await websockets.serve(handler, "0.0.0.0", 8765)
-    print("WebSocket server started on ws://0.0.0.0:8765")
+    log.info("WebSocket server started on ws://0.0.0.0:8765")
     await server.wait_closed()
 
 if __name__ == "__main__":
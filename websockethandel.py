@@ -1,46 +1,62 @@
 import asyncio
+import os
 import websockets
 import json
 import hmac
-import hashlib
-import base64
-import time
-import random
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor  # For KeepAliveThread equivalent
+from Websocket.route_peek import peekRequest
+from Websocket.nonce_store import getNonceStore, remoteHost
+from Websocket.device_secrets import getSecretTable
+from Websocket.registry import DeviceRegistry
+from Websocket.resumption import ResumptionTickets
+from Websocket.admission import AdmissionRejected, RegistrationAdmission
+from Websocket.routes import RouteTable
+from Websocket.keepalive import KeepAliveStage  # For KeepAliveThread equivalent
+from Websocket.worker_group import WorkerGroup
+from Websocket.log import getLogger
+from Websocket.metrics import startMetricsServer
+from Websocket.watchdog import startWatchdog
+
+log = getLogger("websockethandel")
 
 class WebSocketHandler:
     """
     Python version of the WebSocketHandler.java class
     """
 
-    SECRET = "123456"
+    # Register secrets by DeviceCode, then Vendor (LAPI_SECRETS, LAPI_SECRET)
+    secret_table = getSecretTable()
     LAPI_REGISTER = "/LAPI/V1.0/System/UpServer/Register"
     LAPI_KEEPALIVE = "/LAPI/V1.0/System/UpServer/Keepalive"
     LAPI_UNREGISTER = "/LAPI/V1.0/System/UpServer/Unregister"
+    # Stateless, shared by every connection
+    keep_alive_stage = KeepAliveStage()
+    # Register challenges, held per process or stateless HMAC nonces (LAPI_NONCE_MODE)
+    nonce_store = getNonceStore()
+    # Lets a registered device reconnect in one round trip (LAPI_TICKET_KEY, LAPI_TICKET_LIFETIME)
+    resumption_tickets = ResumptionTickets()
+    # Registered devices of this process by DeviceCode, Vendor, DeviceType and IP
+    device_registry = DeviceRegistry()
+    # Paces Register storms per IP and overall, shed devices are told to come back later
+    register_admission = RegistrationAdmission()
+    # Registration path and frame RequestURLs, each resolved with one dict lookup
+    http_routes = RouteTable()
+    frame_routes = RouteTable()
 
     def __init__(self):
         self.handshaker = None
-        self.keep_alive_executor = ThreadPoolExecutor(max_workers=3) # thread pool for the keep alive threads
+        self.device_code = None
 
     async def channelRead(self, websocket, path):
         """
         Handles incoming WebSocket messages.  Mimics the channelRead function from Java.
         """
         try:
-            print(f"New connection from {websocket.remote_address}")
+            log.debug("New connection", route=path, remote=websocket.remote_address)
             # Parse the URL to determine whether this is a registration request or a websocket connection
-            path =str(path)
-            parsed_url = urllib.parse.urlparse(path)
-
-            if parsed_url.path == self.LAPI_REGISTER:
-                # Mimicking the initial registration handshake
-                await self.handle_http_register(websocket)
-
-            elif parsed_url.path.startswith(self.LAPI_REGISTER):
-                # Mimicking the second registration handshake
-                query_params = urllib.parse.parse_qs(parsed_url.query)
-                await self.handle_http_register_vendor(websocket, query_params)
+            match = self.http_routes.match(str(path))
+            if match is not None:
+                await match.handler(self, websocket, match)
 
             else:
                 #Handle a normal websocket connection
@@ -48,7 +64,7 @@ class WebSocketHandler:
                     await self.handleWebSocketRequest(websocket, message)
 
         except websockets.exceptions.ConnectionClosedError as e:
-            print(f"Connection closed abruptly: {e}")  # Handle disconnections more gracefully.
+            log.info("Connection closed abruptly: %s", e)  # Handle disconnections more gracefully.
         except Exception as e:
             self.exceptionCaught(websocket, e) # call the exception handling function
         finally:
@@ -58,13 +74,31 @@ class WebSocketHandler:
         """
         Handles the initial HTTP registration request.
         """
-        object = {"Nonce": self.getCnonce()}
+        object = {"Nonce": self.new_nonce(websocket)}
         response_body = json.dumps(object)
         #Cannot directly send an HTTP response using websockets.  Need to send a message
         await websocket.send(response_body)
-        print(f"Sent initial registration challenge to {websocket.remote_address}")
+        log.info("Sent initial registration challenge", remote=websocket.remote_address)
 
 
+    async def handle_resumption(self, websocket, query_params):
+        """
+        Reconnect with a resumption ticket: admitted in one round trip with a fresh ticket,
+        an invalid or expired one gets the Nonce challenge instead.
+        """
+        device_code = query_params.get("DeviceCode", [""])[0]
+        claims = self.resumption_tickets.verify(query_params["Ticket"][0], device_code)
+        if claims is None:
+            log.info("Resumption ticket rejected, full registration required",
+                     device=device_code, remote=websocket.remote_address)
+            await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, device_code)}))
+            return
+        log.info("Device resumed its session", device=claims.deviceCode, remote=websocket.remote_address)
+        ticket = self.resumption_tickets.issue(claims.deviceCode, claims.vendor, claims.deviceType)
+        await websocket.send(json.dumps({"Ticket": ticket}))
+        self.register_device(websocket, claims.deviceCode, claims.vendor, claims.deviceType)
+        self.handlerAdded(websocket)
+
     async def handle_http_register_vendor(self, websocket, query_params):
         """
         Handles the second HTTP registration request with vendor information.
@@ -79,154 +113,222 @@ class WebSocketHandler:
             Sign = query_params.get("Sign", [None])[0]
 
             if None in (Vendor, DeviceType, Devicecode, Algorithm, Nonce, Sign):
-                print("Missing parameters in registration request")
+                log.warning("Missing parameters in registration request", remote=websocket.remote_address)
                 await websocket.close(code=4000, reason="Missing parameters")
                 return
 
+            # The Nonce must be one this server issued to the device and not used yet
+            if not self.nonce_store.consume(remoteHost(websocket.remote_address), Nonce, Devicecode):
+                log.warning("Unknown or expired Nonce: %s", Nonce, device=Devicecode, remote=websocket.remote_address)
+                await websocket.send(json.dumps({"Nonce": self.new_nonce(websocket, Devicecode)}))
+                return
+            # The challenge paid for this registration, a made-up Nonce keeps costing its IP
+            self.register_admission.refund(remoteHost(websocket.remote_address))
+
             decoded_url = urllib.parse.unquote(Sign)
             decoded_url = decoded_url.replace(" ", "+")
-            print(f"Certified Signature: {decoded_url}")
-
-            pstr = f"{Vendor}/{DeviceType}/{Devicecode}/{Algorithm}/{Nonce}"
+            log.debug("Certified Signature: %s", decoded_url, device=Devicecode)
 
             # Generate server-side signature
-            sha256_HMAC = hmac.new(self.SECRET.encode("utf-8"), pstr.encode("utf-8"), hashlib.sha256)
-            encodeStr = base64.b64encode(sha256_HMAC.digest()).decode("utf-8")
+            encodeStr = self.secret_table.sign(Vendor, DeviceType, Devicecode, Algorithm, Nonce)
 
             if not hmac.compare_digest(encodeStr, decoded_url): # hmac.compare_digest to prevent timing attacks
-                print(f"Authentication failed: {encodeStr}")
-                object = {"Nonce": self.getCnonce()}
+                log.warning("Authentication failed", device=Devicecode, remote=websocket.remote_address)
+                object = {"Nonce": self.new_nonce(websocket, Devicecode)}
                 await websocket.send(json.dumps(object))  # Send back a challenge
                 return
 
-            print("Authentication successful")
-            object = {"Cnonce": Cnonce, "Resign": encodeStr}
+            log.info("Authentication successful", device=Devicecode, remote=websocket.remote_address)
+            object = {"Cnonce": Cnonce, "Resign": encodeStr,
+                      "Ticket": self.resumption_tickets.issue(Devicecode, Vendor, DeviceType)}
             await websocket.send(json.dumps(object)) # send back the Cnonce and Resign values
+            self.register_device(websocket, Devicecode, Vendor, DeviceType)
             self.handlerAdded(websocket) # now that the handshake is complete, add the handler
 
         except Exception as e:
-            print(f"Error during vendor registration: {e}")
+            log.exception("Error during vendor registration", remote=websocket.remote_address)
             await websocket.close(code=5000, reason="Internal server error")
 
 
+    @http_routes.route(LAPI_REGISTER)
+    async def on_register_path(self, websocket, match):
+        if not await self.admit_registration(websocket):
+            return
+        query_params = match.parameters()
+        if "Ticket" in query_params:
+            # Reconnect of a device that registered before
+            await self.handle_resumption(websocket, query_params)
+        elif "Vendor" in query_params:
+            # Mimicking the second registration handshake
+            await self.handle_http_register_vendor(websocket, query_params)
+        else:
+            # Mimicking the initial registration handshake
+            await self.handle_http_register(websocket)
+
     async def handleWebSocketRequest(self, websocket, message):
         """
         Handles incoming WebSocket frames.
         """
         try:
-            jsonObject = json.loads(message)
-            request_url = jsonObject.get("requestURL")
-
-            if request_url == self.LAPI_KEEPALIVE:
-                print(f"The server received a device's keep alive request: {request_url}")
-                # Use threads to receive keep alive information
-                # NOTE: The KeepLiveThread needs to be adapted to run in Python.
-                # The example uses a basic thread pool to execute the logic asynchronously
-                self.keep_alive_executor.submit(self.keep_alive_task, websocket, jsonObject)
-
-            elif request_url == self.LAPI_UNREGISTER:
-                print(f"{websocket.remote_address} Device disconnected")
-                await websocket.close()
+            websocketReq = peekRequest(message)
+            request_url = websocketReq.RequestURL
 
+            match = self.frame_routes.match(request_url)
+            if match is None:
+                log.warning("Received unknown request", route=request_url, remote=websocket.remote_address)
             else:
-                print(f"Received unknown request: {request_url}")
+                await match.handler(self, websocket, websocketReq)
 
         except json.JSONDecodeError:
-            print("Invalid JSON received")
+            log.warning("Invalid JSON received")
         except Exception as e:
             self.exceptionCaught(websocket, e)
 
-    def keep_alive_task(self, websocket, jsonObject):
+    @frame_routes.route(LAPI_KEEPALIVE)
+    async def on_keepalive(self, websocket, websocketReq):
+        log.info("The server received a device's keep alive request",
+                 route=websocketReq.RequestURL, cseq=websocketReq.Cseq, device=self.device_code, remote=websocket.remote_address)
+        # Answered on this connection's loop, no thread is involved
+        await self.keep_alive_task(websocket, websocketReq)
+
+    @frame_routes.route(LAPI_UNREGISTER)
+    async def on_unregister(self, websocket, websocketReq):
+        log.info("Device disconnected", remote=websocket.remote_address)
+        await websocket.close()
+
+    async def keep_alive_task(self, websocket, websocketReq):
       '''
       This is the logic previously performed by the keepAliveThread.
-      Since we cannot directly translate the Java thread, this simulates
-      the thread with a task submitted to the threadpool.
+      The KeepAliveRspAO response is built and sent on the connection's own loop,
+      blocking work belongs in the stage's blockingWork hook, which runs on the shared executor.
       '''
       try:
-        print(f"Processing Keep-Alive from {websocket.remote_address}: {jsonObject}")
-        #Simulate some processing
-        time.sleep(2)
-        print(f"Keep-Alive processing complete for {websocket.remote_address}")
-
+        await self.keep_alive_stage.handle(websocket.send, websocketReq)
       except Exception as e:
-        print(f"Error during keep-alive processing {websocket.remote_address}: {e}")
+        log.error("Error during keep-alive processing: %s", e, remote=websocket.remote_address)
 
 
     def handlerAdded(self, websocket):
         """
         Called when a handler is added to the pipeline (connection established).
         """
-        print(f"{websocket.remote_address} The device is connected")
+        log.info("The device is connected", remote=websocket.remote_address)
         self.channelActive(websocket) # call channel active
 
     def handlerRemoved(self, websocket):
         """
         Called when a handler is removed from the pipeline (connection closed).
         """
-        print(f"{websocket.remote_address} The device has been removed")
+        log.info("The device has been removed", remote=websocket.remote_address)
+        if self.device_code is not None:
+            self.device_registry.remove(self.device_code, websocket)
         self.channelInactive(websocket) # call channel inactive
 
     def channelActive(self, websocket):
         """
         Called when a channel becomes active (connection is ready for communication).
         """
-        print(f"Client joined connection: {websocket.remote_address}")
+        log.debug("Client joined connection", remote=websocket.remote_address)
 
     def channelInactive(self, websocket):
         """
         Called when a channel becomes inactive (connection is closed).
         """
-        print(f"Client disconnected: {websocket.remote_address}")
+        log.debug("Client disconnected", remote=websocket.remote_address)
 
     def exceptionCaught(self, websocket, error):
         """
         Handles exceptions that occur during channel processing.
         """
-        print(f"Exception occurred: {error}")
+        log.error("Exception occurred: %s", error, exc_info=error, remote=websocket.remote_address)
         asyncio.create_task(websocket.close())  # Close the connection
 
-    def getCnonce(self):
+    def register_device(self, websocket, device_code, vendor, device_type):
+        """
+        Indexes the registered device by DeviceCode; a previous connection of the same device is stale and closed.
+        """
+        self.device_code = device_code
+        previous = self.device_registry.add(device_code, websocket, vendor, device_type, websocket.remote_address, self)
+        if previous is not None:
+            log.info("Device reconnected, closing its old connection from %s:%s", previous.ip, previous.port,
+                     device=device_code, remote=websocket.remote_address)
+            asyncio.create_task(previous.connection.close())
+
+    async def admit_registration(self, websocket):
+        """
+        Waits for a registration slot. A shed device is closed with 1013 Try Again Later.
+        """
+        try:
+            await self.register_admission.acquire(remoteHost(websocket.remote_address))
+            return True
+        except AdmissionRejected as e:
+            log.warning("Registration shed: %s", e, remote=websocket.remote_address)
+            await websocket.close(code=1013, reason=f"Try again in {e.retryAfter}s")
+            return False
+
+    def new_nonce(self, websocket, device_code=""):
         """
-        Calculates a cnonce value (client nonce).
+        Issues a challenge Nonce and remembers it for the device's IP (and DeviceCode once known).
         """
-        d = random.random()
-        d1 = time.time()
-        x = d * d1
-        return str(int(x))
+        return self.nonce_store.issue(remoteHost(websocket.remote_address), device_code)
 
 
-async def websocket_server(ip, port):
+async def websocket_server(ip, port, reuse_port=False):
     """
     Main function to run the WebSocket server.  Mimics the Websocket.java class
     """
-    print("Starting websocket server...")
+    log.info("Starting websocket server...")
 
     async def handler(websocket,path=None):
         """
         The handler that will be called for each new websocket.
         """
+        # websockets 13+ no longer passes the path, it is on the handshake request
+        path = path or getattr(websocket, "path", None) or websocket.request.path
         websocket_handler = WebSocketHandler() #Create an instance for each connection.
         await websocket_handler.channelRead(websocket,path)
 
 
+    # Pick up edits to the secrets file without blocking the loop
+    secret_table = WebSocketHandler.secret_table
+    watcher = asyncio.create_task(secret_table.watch()) if secret_table.path else None
+    # Keep alive and executor metrics on GET /metrics (LAPI_METRICS_PORT, 0 disables)
+    await startMetricsServer()
+    # Reports callbacks that block the loop, on /metrics and /debug/stalls (LAPI_WATCHDOG_THRESHOLD)
+    startWatchdog()
+
     try:
         # Start the WebSocket server
-        async with websockets.serve(handler, ip, port): 
+        async with websockets.serve(handler, ip, port, reuse_port=reuse_port): 
             # as server:
-            print(f"WebSocket server started successfully on {ip}:{port}")
+            log.info("WebSocket server started successfully on %s:%s", ip, port)
             await asyncio.Future()  # Run forever
     except OSError as e:
-        print(f"The webSocket server failed to start: {e}.  Please check the IP/port settings")
+        log.error("The webSocket server failed to start: %s.  Please check the IP/port settings", e)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        log.exception("An unexpected error occurred")
     finally:
-        print("Websocket Server closed.")
+        if watcher is not None:
+            watcher.cancel()
+        log.info("Websocket Server closed.")
+
+
+def serve(ip, port, reuse_port=False):
+    """
+    Runs one server process with its own event loop.
+    """
+    asyncio.run(websocket_server(ip, port, reuse_port))
 
 
 if __name__ == "__main__":
     # Set the IP and port
     IP = "192.168.1.13"
     PORT = 8080
-
-    # Run the WebSocket server
-    asyncio.run(websocket_server(IP, PORT))
+    # Number of processes sharing the port via SO_REUSEPORT
+    WORKERS = int(os.environ.get("LAPI_WORKERS", "1"))
+
+    # Run the WebSocket server, supervised when running several workers
+    if WORKERS > 1:
+        WorkerGroup(WORKERS).run(serve, IP, PORT, True)
+    else:
+        serve(IP, PORT)